@@ -0,0 +1,146 @@
+"""
+Compares the throughput of the sync db layer with the async API
+(moneytracker.db.aio) on a mixed workload of reads and writes against a
+synthetic database (see benchmarks.generate). The sync API runs the
+operations one after another, the async API with N in flight at once.
+Both run inside an event loop alongside a ticker task, and the longest the
+ticker was kept waiting shows how much each blocks the loop
+
+Run from the repository root with:
+    python -m benchmarks.async_throughput [--expenses N] [--ops N] [--concurrency N] [--readers N]
+        [--write-share 0.1] [--output results.json]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.generate import generate
+from moneytracker.db import aio, db
+from moneytracker.model import Expense, ExpenseCategory, TimeFrame
+
+READS = {
+    "get_expenses": lambda api, acc: api.get_expenses(20),
+    "get_by_category": lambda api, acc: api.get_by_category(ExpenseCategory.FOOD, TimeFrame.MONTH),
+    "get_overview": lambda api, acc: api.get_overview(),
+    "get_account_by_name": lambda api, acc: api.get_account_by_name(acc.account_name),
+    "get_recurring_payments": lambda api, acc: api.get_recurring_payments(),
+}
+
+
+def write(api, acc):
+    return api.record_transaction(Expense(-1, "bench", ExpenseCategory.FOOD, datetime.datetime.now(), 1.5, acc))
+
+
+def workload(ops: int, write_share: float, seed: int = 0):
+    """
+    Picks the operations to run, the same for both APIs
+    :return: list of functions taking the API module and an account
+    """
+    rng = random.Random(seed)
+    reads = list(READS.values())
+    return [write if rng.random() < write_share else rng.choice(reads) for _ in range(ops)]
+
+
+def summarise(latencies: list, elapsed: float, lag: float):
+    latencies = sorted(latencies)
+    return {"ops_per_sec": len(latencies) / elapsed, "p50_ms": statistics.median(latencies),
+            "p99_ms": latencies[int(len(latencies) * 0.99) - 1], "max_loop_lag_ms": lag}
+
+
+async def ticker(interval: float = 0.001):
+    """
+    Sleeps in a loop, measuring how late the event loop wakes it
+    :return: longest delay in ms, once cancelled
+    """
+    lag = 0
+    try:
+        while True:
+            began = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = max(lag, time.perf_counter() - began - interval)
+    except asyncio.CancelledError:
+        return lag * 1000
+
+
+async def run_sync(ops: list, acc):
+    latencies = []
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    for op in ops:
+        began = time.perf_counter()
+        op(db, acc)
+        latencies.append((time.perf_counter() - began) * 1000)
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    tick.cancel()
+    return summarise(latencies, elapsed, await tick)
+
+
+async def run_async(ops: list, acc, concurrency: int):
+    latencies = []
+    in_flight = asyncio.Semaphore(concurrency)
+
+    async def timed(op):
+        async with in_flight:
+            began = time.perf_counter()
+            await op(aio, acc)
+            latencies.append((time.perf_counter() - began) * 1000)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*[timed(op) for op in ops])
+    elapsed = time.perf_counter() - start
+    tick.cancel()
+    return summarise(latencies, elapsed, await tick)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--expenses", type=int, default=100000, help="size of the generated database")
+    parser.add_argument("--ops", type=int, default=2000, help="operations run by each API")
+    parser.add_argument("--concurrency", type=int, default=16, help="async operations in flight at once")
+    parser.add_argument("--readers", type=int, default=aio.READERS, help="async reader threads")
+    parser.add_argument("--write-share", type=float, default=0.1, help="share of operations that write")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        generate(path, args.expenses)
+        db.set_db_path(path)
+        acc = db.get_accounts()[0]
+        ops = workload(args.ops, args.write_share)
+
+        results = {"meta": {"expenses": args.expenses, "ops": args.ops, "concurrency": args.concurrency,
+                            "readers": args.readers, "write_share": args.write_share, "cpus": os.cpu_count()},
+                   "sync": asyncio.run(run_sync(ops, acc))}
+        db.close_connection()
+
+        aio.configure(args.readers)
+        results["async"] = asyncio.run(run_async(ops, acc, args.concurrency))
+        aio.shutdown()
+
+    for api in ("sync", "async"):
+        res = results[api]
+        print("{api:<6}{ops:10.0f} ops/s  p50 {p50:.2f}ms  p99 {p99:.2f}ms  max loop lag {lag:.2f}ms"
+              .format(api=api, ops=res["ops_per_sec"], p50=res["p50_ms"], p99=res["p99_ms"],
+                      lag=res["max_loop_lag_ms"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
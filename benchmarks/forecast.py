@@ -0,0 +1,73 @@
+"""
+Times the cash-flow forecast (moneytracker.analytics.build_forecast) over
+growing horizons, with and without the category average model, against a
+synthetic database with many recurring payments (see benchmarks.generate)
+
+Run from the repository root with:
+    python -m benchmarks.forecast [--expenses N] [--recurring N] [--years N] [--average-months N]
+        [--repeat N] [--output results.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.generate import generate
+from moneytracker import analytics
+from moneytracker.db import db
+
+
+def time_forecast(days: int, average_days: int, repeat: int):
+    """
+    Loads the schedules and builds a forecast, repeat times
+    :return: dict of median ms and number of payments projected
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        schedules = analytics.load_schedules()
+        analytics.build_forecast(db.get_accounts(), schedules, days, average_days)
+        times.append((time.perf_counter() - start) * 1000)
+
+    payments = len(analytics.expand_schedules(schedules, int(time.time()) + days * 86400)[0])
+    return {"median_ms": statistics.median(times), "payments": payments}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--expenses", type=int, default=100000, help="size of the generated database")
+    parser.add_argument("--recurring", type=int, default=500, help="recurring payments in the generated database")
+    parser.add_argument("--years", type=int, default=5, help="longest horizon forecast")
+    parser.add_argument("--average-months", type=int, default=3, help="history the category averages are taken from")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each forecast")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        generate(path, args.expenses, recurring=args.recurring)
+        db.set_db_path(path)
+
+        results = {}
+        for years in range(1, args.years + 1):
+            for average_days in (0, round(args.average_months * 365 / 12)):
+                name = "{years}y{model}".format(years=years, model=" + averages" if average_days else "")
+                results[name] = time_forecast(years * 365, average_days, args.repeat)
+        db.close_connection()
+
+    for name, res in results.items():
+        print("{name:<16} {payments:>10} payments  {ms:8.1f}ms".format(name=name, payments=res["payments"],
+                                                                      ms=res["median_ms"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
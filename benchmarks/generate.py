@@ -0,0 +1,148 @@
+"""
+Fills a database with synthetic accounts, expenses, budgets and recurring
+payments. Expenses follow a fixed category mix with log-uniform amounts
+inside each category's range, are spread over the last N days weighted
+towards the daytime, and every account is paid a monthly wage
+
+Run from the repository root with:
+    python -m benchmarks.generate finances.db [--expenses N] [--accounts N] [--days N] [--recurring N] [--seed N]
+"""
+import argparse
+import datetime
+import math
+import os
+import random
+import sys
+import time
+
+from moneytracker.db import db
+from moneytracker.model import Expense, ExpenseCategory, TimeFrame
+
+# category: (share of expenses, lowest amount, highest amount)
+CATEGORY_MIX = {
+    ExpenseCategory.FOOD: (0.45, 2, 90),
+    ExpenseCategory.TREAT: (0.18, 4, 120),
+    ExpenseCategory.GENERAL: (0.17, 1, 150),
+    ExpenseCategory.UTILITY: (0.10, 15, 900),
+    ExpenseCategory.GIFT: (0.06, 5, 200),
+    ExpenseCategory.HAZARD: (0.04, 30, 1500),
+}
+WAGE = (1400, 4200)
+REASONS = {
+    ExpenseCategory.FOOD: ["tesco", "sainsburys", "aldi", "lunch", "takeaway", "coffee"],
+    ExpenseCategory.TREAT: ["cinema", "steam", "books", "concert", "clothes"],
+    ExpenseCategory.GENERAL: ["amazon", "post office", "pharmacy", "cash", ""],
+    ExpenseCategory.UTILITY: ["rent", "water", "gas", "electric", "internet", "phone"],
+    ExpenseCategory.GIFT: ["birthday", "wedding", "christmas"],
+    ExpenseCategory.HAZARD: ["car repair", "boiler", "vet", "dentist"],
+    ExpenseCategory.WAGE: ["salary"],
+}
+BUDGETS = {
+    ExpenseCategory.FOOD: (400, TimeFrame.MONTH),
+    ExpenseCategory.TREAT: (60, TimeFrame.WEEK),
+    ExpenseCategory.GENERAL: (250, TimeFrame.MONTH),
+    ExpenseCategory.UTILITY: (1500, TimeFrame.MONTH),
+    ExpenseCategory.GIFT: (800, TimeFrame.YEAR),
+    ExpenseCategory.HAZARD: (2000, TimeFrame.YEAR),
+}
+
+
+def account_names(accounts: int):
+    return ["account{n}".format(n=i) for i in range(accounts)]
+
+
+def random_amount(rng: random.Random, low: float, high: float):
+    return round(math.exp(rng.uniform(math.log(low), math.log(high))), 2)
+
+
+def random_expenses(rng: random.Random, accounts: list, expenses: int, days: int, now: datetime.datetime):
+    """
+    Yields synthetic expenses in a random order
+    :param rng: random number generator
+    :param accounts: accounts to spread the expenses across
+    :param expenses: number of expenses, monthly wages are included in this
+    :param days: number of days back from now the expenses cover
+    :param now: newest possible expense time
+    :return: generator of expenses
+    """
+    categories = list(CATEGORY_MIX)
+    weights = [CATEGORY_MIX[c][0] for c in categories]
+    wages = min(expenses, len(accounts) * (days // TimeFrame.MONTH.value))
+    start = now - datetime.timedelta(days=days)
+
+    for i in range(wages):
+        acc = accounts[i % len(accounts)]
+        day = start + datetime.timedelta(days=(i // len(accounts) + 1) * TimeFrame.MONTH.value, hours=9)
+        yield Expense(-1, "salary", ExpenseCategory.WAGE, min(day, now), -random_amount(rng, *WAGE), acc)
+
+    for _ in range(expenses - wages):
+        ecat = rng.choices(categories, weights)[0]
+        _, low, high = CATEGORY_MIX[ecat]
+        day = now - datetime.timedelta(days=rng.randrange(days))
+        at = day.replace(hour=min(23, int(rng.triangular(7, 24, 13))), minute=rng.randrange(60),
+                         second=rng.randrange(60), microsecond=0)
+        yield Expense(-1, rng.choice(REASONS[ecat]), ecat, min(at, now), random_amount(rng, low, high),
+                      rng.choice(accounts))
+
+
+def generate(path: str, expenses: int = 10000, accounts: int = 3, days: int = 730, recurring: int = 5,
+             seed: int = 0):
+    """
+    Creates a database full of synthetic data
+    :param path: database to create, it should not already exist
+    :param expenses: number of expenses
+    :param accounts: number of accounts
+    :param days: number of days of history
+    :param recurring: number of recurring payments
+    :param seed: random seed, the same seed gives the same data
+    :return: dict of what was generated
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.now().replace(microsecond=0)
+    db.set_db_path(path)
+
+    for name in account_names(accounts):
+        db.add_account(name, random_amount(rng, 100, 5000))
+    accs = db.get_accounts()
+
+    for ecat, (amount, tf) in BUDGETS.items():
+        db.set_budget(ecat, amount, tf)
+
+    start = time.perf_counter()
+    inserted = db.insert_expenses(random_expenses(rng, accs, expenses, days, now))
+    elapsed = time.perf_counter() - start
+
+    for _ in range(recurring):
+        ecat = rng.choice([ExpenseCategory.UTILITY, ExpenseCategory.GENERAL, ExpenseCategory.TREAT])
+        _, low, high = CATEGORY_MIX[ecat]
+        expense = Expense(-1, rng.choice(REASONS[ecat]), ecat, now, random_amount(rng, low, high),
+                          rng.choice(accs))
+        expense.id, _ = db.record_transaction(expense)
+        db.setup_recurring_payment(expense, rng.choice([TimeFrame.WEEK, TimeFrame.MONTH, TimeFrame.YEAR]))
+
+    db.close_connection()
+    return {"accounts": accounts, "expenses": inserted, "days": days, "recurring": recurring, "seed": seed,
+            "insert_rows_per_sec": inserted / elapsed if elapsed else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="database to create")
+    parser.add_argument("--expenses", type=int, default=10000)
+    parser.add_argument("--accounts", type=int, default=3)
+    parser.add_argument("--days", type=int, default=730, help="days of history")
+    parser.add_argument("--recurring", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        parser.error(f"{args.path} already exists")
+
+    res = generate(args.path, args.expenses, args.accounts, args.days, args.recurring, args.seed)
+    print("Generated {expenses} expenses over {days} days across {accounts} accounts "
+          "({insert_rows_per_sec:.0f} rows/s) and {recurring} recurring payments".format(**res))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
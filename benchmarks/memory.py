@@ -0,0 +1,96 @@
+"""
+Measures the memory held by large result sets of the db layer and how fast
+they are built: the size of the returned objects and the peak allocated
+while fetching them (from tracemalloc), and rows per second (timed
+separately, as tracing slows allocation down). Runs against a synthetic
+database with a single account (see benchmarks.generate)
+
+Run from the repository root with:
+    python -m benchmarks.memory [--expenses N] [--db existing.db] [--output results.json] [--baseline results.json]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.generate import generate
+from moneytracker.db import db
+
+CASES = {
+    "iter_expenses (all)": lambda: list(db.iter_expenses(10000)),
+    "get_expenses (all in time frame)": lambda: db.get_expenses(2**31),
+    "search_expenses (10k)": lambda: db.search_expenses("tesco OR aldi OR lunch", 10000),
+}
+
+
+def measure(call):
+    """
+    Runs a case once traced and once timed
+    :return: dict of rows, retained and peak bytes, and rows per second
+    """
+    gc.collect()
+    tracemalloc.start()
+    res = call()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = len(res)
+    del res
+
+    gc.collect()
+    start = time.perf_counter()
+    call()
+    elapsed = time.perf_counter() - start
+
+    return {"rows": rows, "retained_bytes": retained, "peak_bytes": peak,
+            "bytes_per_row": retained / rows if rows else 0, "rows_per_sec": rows / elapsed if elapsed else 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--expenses", type=int, default=100000, help="size of the generated database")
+    parser.add_argument("--db", help="measure against this database instead of generating one")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results from a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed growth before failing")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db
+        if path is None:
+            path = os.path.join(tmp, "bench.db")
+            generate(path, args.expenses, accounts=1)
+        db.set_db_path(path)
+        db.connection()
+
+        results = {name: measure(call) for name, call in CASES.items()}
+        db.close_connection()
+
+    for name, res in results.items():
+        print("{name:<34} {rows:>8} rows  {mb:8.1f}MB held ({per:.0f}B/row)  {peak:8.1f}MB peak  {rate:10.0f} rows/s"
+              .format(name=name, rows=res["rows"], mb=res["retained_bytes"] / 2**20, per=res["bytes_per_row"],
+                      peak=res["peak_bytes"] / 2**20, rate=res["rows_per_sec"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = [(name, baseline[name]["bytes_per_row"], res["bytes_per_row"])
+                       for name, res in results.items() if name in baseline
+                       and res["bytes_per_row"] > baseline[name]["bytes_per_row"] * (1 + args.tolerance)]
+        for name, old, new in regressions:
+            print(f"REGRESSION {name}: {old:.0f}B/row -> {new:.0f}B/row")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
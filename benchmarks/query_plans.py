@@ -0,0 +1,96 @@
+"""
+Checks that every query issued by moneytracker/db/db.py is answered with
+an index rather than a full scan of the expenses table
+
+Run from the repository root with:
+    python -m benchmarks.query_plans
+"""
+import os
+import sys
+import tempfile
+
+os.chdir(tempfile.mkdtemp())
+
+from moneytracker.db.db import *  # noqa: E402  (./finances.db is created in the temp dir)
+
+
+def capture_queries():
+    """
+    Runs the read/delete functions of the db layer and records the SQL
+    they execute
+    :return: list of (function name, sql) pairs
+    """
+    add_account("bench", 0)
+    acc = get_account_by_name("bench")
+    expense = Expense(-1, "bench", ExpenseCategory.FOOD, datetime.datetime.now(), 1, acc)
+    expense.id = insert_expense(expense)
+    setup_recurring_payment(expense, TimeFrame.MONTH)
+
+    calls = {
+        "get_expenses": lambda: get_expenses(10),
+        "get_expenses_by_category": lambda: get_expenses_by_category(10, ExpenseCategory.FOOD),
+        "iter_expenses": lambda: list(iter_expenses(10, (0, 0), in_time_frame=True)),
+        "iter_expenses (category)": lambda: list(iter_expenses(10, (0, 0), ExpenseCategory.FOOD)),
+        "get_expenses (categories)": lambda: get_expenses(10, categories=[ExpenseCategory.FOOD, ExpenseCategory.GIFT]),
+        "get_expenses (accounts)": lambda: get_expenses(10, account_ids=[acc.id, acc.id + 1]),
+        "iter_expenses (categories, account)": lambda: list(iter_expenses(10, (0, 0), categories=[
+            ExpenseCategory.FOOD, ExpenseCategory.GIFT], account_ids=[acc.id])),
+        "iter_expenses (range)": lambda: list(iter_expenses(10, start_date=datetime.datetime(2000, 1, 1),
+                                                            end_date=datetime.datetime(2000, 2, 1))),
+        "search_expenses": lambda: search_expenses("bench", categories=[ExpenseCategory.FOOD]),
+        "get_by_category": lambda: get_by_category(ExpenseCategory.FOOD, TimeFrame.MONTH),
+        "get_overview": get_overview,
+        "get_budget_status": get_budget_status,
+        "get_range_overview": lambda: get_range_overview(datetime.date(2000, 1, 1), datetime.date(2000, 1, 31)),
+        "get_period_totals": lambda: get_period_totals(TimeFrame.MONTH, datetime.date(2000, 1, 1),
+                                                       datetime.date(2001, 12, 31)),
+        "get_budget_by_category": lambda: get_budget_by_category(ExpenseCategory.FOOD),
+        "get_timeframe": lambda: get_timeframe(ExpenseCategory.FOOD),
+        "get_account_by_id": lambda: get_account_by_id(acc.id),
+        "get_account_by_name": lambda: get_account_by_name(acc.account_name),
+        "get_recurring_payments": get_recurring_payments,
+        "get_balance_at": lambda: get_balance_at(acc.id, datetime.datetime(2000, 1, 1)),
+        "get_balance_history": lambda: get_balance_history(acc.id, datetime.date.today()),
+        "reconcile_balances": reconcile_balances,
+        "clear_by_category": lambda: clear_by_category(ExpenseCategory.GIFT),
+    }
+
+    queries = []
+    for name, call in calls.items():
+        connection().set_trace_callback(lambda sql, name=name: queries.append((name, sql)))
+        call()
+        connection().set_trace_callback(None)
+
+    return [(name, sql) for name, sql in queries
+            if sql.lstrip().upper().startswith(("SELECT", "DELETE", "UPDATE", "WITH"))]
+
+
+def full_scans(sql: str):
+    """
+    Finds the steps of a query plan that scan the expenses table
+    :param sql: the query
+    :return: offending query plan lines
+    """
+    plan = connection().execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+    # ranked searches sort at most RANK_MAX_MATCHES rows, merged listings
+    # at most a page from each of their arms (see newest_expenses_sql)
+    bounded = "expenses_fts.rank" in sql or "AS picked" in sql
+    return [row[-1] for row in plan
+            if (row[-1].startswith("SCAN expenses") and "INDEX" not in row[-1])
+            or (row[-1].startswith("USE TEMP B-TREE FOR ORDER BY") and "expenses" in sql and not bounded)]
+
+
+def main():
+    failed = False
+    for name, sql in capture_queries():
+        scans = full_scans(sql)
+        print("{status}  {name}".format(status="FAIL" if scans else "ok  ", name=name))
+        for line in scans:
+            print(f"        {line}")
+        failed = failed or len(scans) > 0
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Measures CLI start up: the cumulative import time of moneytracker.cli
+(from python -X importtime) and the wall clock time of each command, run
+directly and forwarded to a daemon (main.py serve)
+
+Run from the repository root with:
+    python -m benchmarks.startup [--runs N] [--output results.json] [--baseline results.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, "main.py")
+
+COMMANDS = {
+    "spend": ["spend", "-m", "1", "-a", "bench", "-c", "FOOD"],
+    "overview": ["overview"],
+    "expenses": ["expenses"],
+    "categories": ["categories"],
+    "accounts": ["accounts"],
+    "recurring": ["recurring"],
+}
+
+
+def import_times(runs: int):
+    """
+    Runs python -X importtime over the CLI module
+    :param runs: number of runs to take the median of
+    :return: dict of module to median cumulative import time in ms
+    """
+    samples = {}
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import moneytracker.cli"],
+                             cwd=ROOT, capture_output=True, text=True, check=True).stderr
+        for line in out.splitlines()[1:]:
+            _, cumulative, name = line.split("|")
+            if not name.startswith("     "):  # top level imports and their direct imports
+                samples.setdefault(name.strip(), []).append(int(cumulative) / 1000)
+
+    return {name: statistics.median(times) for name, times in samples.items()}
+
+
+def command_times(runs: int, db_dir: str):
+    """
+    Times each command run as a fresh process
+    :param runs: number of runs to take the median of
+    :param db_dir: working directory holding the database
+    :return: dict of command to median wall clock time in ms
+    """
+    if not os.path.exists(os.path.join(db_dir, "finances.db")):
+        subprocess.run([sys.executable, MAIN, "account", "bench"], cwd=db_dir, capture_output=True, check=True)
+
+    results = {}
+    for name, args in COMMANDS.items():
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, MAIN, *args], cwd=db_dir, capture_output=True, check=True)
+            times.append((time.perf_counter() - start) * 1000)
+        results[name] = statistics.median(times)
+
+    return results
+
+
+def daemon_times(runs: int, db_dir: str):
+    """
+    Times each command run as a fresh process forwarding it to a daemon
+    :param runs: number of runs to take the median of
+    :param db_dir: working directory holding the database
+    :return: dict of command to median wall clock time in ms
+    """
+    daemon = subprocess.Popen([sys.executable, MAIN, "serve"], cwd=db_dir, stdout=subprocess.PIPE, text=True)
+    try:
+        daemon.stdout.readline()  # listening
+        return command_times(runs, db_dir)
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results from a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before failing")
+    args = parser.parse_args()
+
+    imports = import_times(args.runs)
+    with tempfile.TemporaryDirectory() as db_dir:
+        commands = command_times(args.runs, db_dir)
+        daemon = daemon_times(args.runs, db_dir)
+
+    results = {"import_ms": imports.get("moneytracker.cli"), "modules_ms": imports, "commands_ms": commands,
+               "daemon_commands_ms": daemon}
+
+    print("import moneytracker.cli: {ms:.1f}ms".format(ms=results["import_ms"]))
+    for name, ms in sorted(imports.items(), key=lambda x: -x[1])[:8]:
+        print(f"    {name:<30} {ms:8.1f}ms")
+    for name, ms in commands.items():
+        print(f"{name:<34} {ms:8.1f}ms  (daemon {daemon[name]:.1f}ms)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = [(name, baseline["commands_ms"][name], ms) for name, ms in commands.items()
+                       if name in baseline["commands_ms"] and ms > baseline["commands_ms"][name] * (1 + args.tolerance)]
+        if results["import_ms"] > baseline["import_ms"] * (1 + args.tolerance):
+            regressions.append(("import", baseline["import_ms"], results["import_ms"]))
+
+        for name, old, new in regressions:
+            print(f"REGRESSION {name}: {old:.1f}ms -> {new:.1f}ms")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
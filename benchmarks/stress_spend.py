@@ -0,0 +1,110 @@
+"""
+Multi-process stress test of the spend path. Several processes record
+transactions against the same account at once, then the final balance is
+checked against the expected one to count lost updates
+
+Compares the original read/insert/change_balance path with
+record_transaction. Run from the repository root with:
+    python -m benchmarks.stress_spend [--processes N] [--transactions N]
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from moneytracker.db import db
+from moneytracker.model import Expense, ExpenseCategory
+
+ACCOUNT = "stress"
+AMOUNT = 1.0
+
+
+def legacy_spend():
+    # read the balance, insert the expense and write the balance back
+    acc = db.get_account_by_name(ACCOUNT)
+    db.insert_expense(Expense(-1, "stress", ExpenseCategory.GENERAL, datetime.datetime.now(), AMOUNT, acc))
+    db.change_balance(acc, -AMOUNT)
+
+
+def atomic_spend():
+    acc = db.get_account_by_name(ACCOUNT)
+    db.record_transaction(Expense(-1, "stress", ExpenseCategory.GENERAL, datetime.datetime.now(), AMOUNT, acc))
+
+
+PATHS = {"legacy": legacy_spend, "record_transaction": atomic_spend}
+
+
+def worker(path: str, db_file: str, transactions: int, start, errors):
+    db.set_db_path(db_file)
+    spend = PATHS[path]
+    start.wait()
+    for _ in range(transactions):
+        try:
+            spend()
+        except Exception:
+            with errors.get_lock():
+                errors.value += 1
+
+
+def run(path: str, processes: int, transactions: int):
+    """
+    Runs one spend path from several processes at once
+    :param path: name of the spend path in PATHS
+    :param processes: number of concurrent processes
+    :param transactions: transactions recorded by each process
+    :return: dict of results
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "stress.db")
+        db.set_db_path(db_file)
+        db.add_account(ACCOUNT, 0)
+        db.close_connection()
+
+        start = multiprocessing.Barrier(processes + 1)
+        errors = multiprocessing.Value("i", 0)
+        procs = [multiprocessing.Process(target=worker, args=(path, db_file, transactions, start, errors))
+                 for _ in range(processes)]
+        for p in procs:
+            p.start()
+
+        start.wait()
+        began = time.perf_counter()
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - began
+
+        db.set_db_path(db_file)
+        recorded = db.connection().execute("SELECT COUNT(*) FROM expenses").fetchone()[0]
+        balance = db.get_account_by_name(ACCOUNT).balance
+        db.close_connection()
+
+    return {"path": path, "recorded": recorded, "errors": errors.value,
+            "lost_updates": round(recorded + balance / AMOUNT),
+            "tx_per_sec": recorded / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--transactions", type=int, default=200, help="transactions per process")
+    args = parser.parse_args()
+
+    failed = False
+    rates = {}
+    for path in PATHS:
+        res = run(path, args.processes, args.transactions)
+        print("{path:<20} {tx_per_sec:8.0f} tx/s  recorded={recorded}  lost updates={lost_updates}  "
+              "errors={errors}".format(**res))
+        rates[path] = res["tx_per_sec"]
+        failed = failed or (path == "record_transaction" and (res["lost_updates"] or res["errors"]))
+
+    print("record_transaction runs at {:.0%} of the legacy path's rate".format(
+        rates["record_transaction"] / rates["legacy"]))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
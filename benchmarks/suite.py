@@ -0,0 +1,253 @@
+"""
+Times every function of the db layer and the commands of the CLI
+against a synthetic database (see benchmarks.generate). Functions that
+write run against a fresh copy of the database on each repeat so every
+run sees the same data
+
+Run from the repository root with:
+    python -m benchmarks.suite [--expenses N] [--db existing.db] [--repeat N] [--output results.json]
+        [--baseline results.json] [--tolerance 0.2]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from typer.testing import CliRunner
+
+from benchmarks.generate import generate
+from moneytracker.cli import app
+from moneytracker.db import db
+from moneytracker.importer import read_csv, with_import_keys
+from moneytracker.model import Expense, ExpenseCategory, TimeFrame
+
+CLI_COMMANDS = {
+    "overview": ["overview"],
+    "expenses": ["expenses"],
+    "categories": ["categories"],
+    "recurring": ["recurring"],
+    "accounts": ["accounts"],
+    "report": ["report", "--months", "0"],
+    "budget-status": ["budget-status", "--json"],
+    "forecast": ["forecast", "--months", "24", "--average", "3"],
+    "search": ["search", "tesco OR coffee", "-n", "100"],
+    "search account": ["search", "tes*", "--account", "account0", "-n", "100"],
+    "export csv": ["export", "-", "--format", "csv"],
+    "export jsonl file": ["export", "{scratch}/expenses.jsonl"],
+    "export account year": ["export", "{scratch}/expenses.csv", "--account", "account0",
+                            "--from", (datetime.date.today() - datetime.timedelta(days=365)).isoformat()],
+    "periods": ["periods"],
+    "periods week (52)": ["periods", "--period", "WEEK", "--count", "52"],
+}
+
+
+def db_cases():
+    """
+    Benchmarks of the db layer
+    :return: dict of name to (function taking the benchmark account, whether it writes)
+    """
+    now = datetime.datetime.now()
+    year_ago = now - datetime.timedelta(days=365)
+
+    def expense(acc):
+        return Expense(-1, "bench", ExpenseCategory.FOOD, now, 1.5, acc)
+
+    def import_unsorted(acc):
+        # identical rows with another day between them are both imported
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "statement.csv")
+            with open(path, "w") as f:
+                f.write("date,amount,reason\n2026-01-05,-4.50,coffee\n2026-01-06,-10,lunch\n2026-01-05,-4.50,coffee\n")
+            count = db.insert_expenses(with_import_keys(read_csv(path, acc)))
+        if count != 3:
+            raise RuntimeError(f"import of an unsorted statement inserted {count} of 3 rows")
+
+    def iter_pages(acc, pages=10, **kwargs):
+        return sum(1 for _ in zip(range(pages * 100), db.iter_expenses(100, **kwargs)))
+
+    return {
+        "insert_expense": (lambda acc: db.insert_expense(expense(acc)), True),
+        "record_transaction": (lambda acc: db.record_transaction(expense(acc)), True),
+        "insert_expenses (10k)": (lambda acc: db.insert_expenses(expense(acc) for _ in range(10000)), True),
+        "insert_expenses already imported (10k)": (lambda acc: db.insert_expenses(
+            Expense(-1, "bench", ExpenseCategory.FOOD, now, 1.5, acc, "bench") for _ in range(10000)), True),
+        "import unsorted statement": (import_unsorted, True),
+        "get_by_category": (lambda acc: db.get_by_category(ExpenseCategory.FOOD, TimeFrame.MONTH), False),
+        "get_overview": (lambda acc: db.get_overview(), False),
+        "set_budget": (lambda acc: db.set_budget(ExpenseCategory.FOOD, 300, TimeFrame.WEEK), True),
+        "get_budget": (lambda acc: db.get_budget(), False),
+        "get_budget_config": (lambda acc: (db.invalidate_budget_config(), db.get_budget_config()), False),
+        "get_budget_status": (lambda acc: db.get_budget_status(), False),
+        "get_budget_by_category": (lambda acc: db.get_budget_by_category(ExpenseCategory.FOOD), False),
+        "get_expenses (100)": (lambda acc: db.get_expenses(100), False),
+        "get_expenses_by_category (100)": (lambda acc: db.get_expenses_by_category(100, ExpenseCategory.FOOD), False),
+        "search_expenses (100)": (lambda acc: db.search_expenses("tesco OR coffee", 100), False),
+        "get_range_overview (1 year)": (lambda acc: db.get_range_overview(year_ago.date(), now.date()), False),
+        "get_period_totals (12 months)": (lambda acc: db.get_period_totals(TimeFrame.MONTH, year_ago.date(),
+                                                                           now.date()), False),
+        "iter_export": (lambda acc: sum(len(rows) for rows in db.iter_export("expenses")), False),
+        "iter_expenses (10 pages)": (iter_pages, False),
+        "iter_expenses category (10 pages)": (lambda acc: iter_pages(acc, ecat=ExpenseCategory.FOOD), False),
+        "get_timeframe": (lambda acc: db.get_timeframe(ExpenseCategory.FOOD), False),
+        "verify_daily_totals": (lambda acc: db.verify_daily_totals(), False),
+        "rebuild_daily_totals": (lambda acc: db.rebuild_daily_totals(), True),
+        "get_account_totals": (lambda acc: db.get_account_totals(TimeFrame.MONTH), False),
+        "clear_all": (lambda acc: db.clear_all(), True),
+        "clear_by_category": (lambda acc: db.clear_by_category(ExpenseCategory.FOOD), True),
+        "reset_default_budgets": (lambda acc: db.reset_default_budgets(), True),
+        "get_accounts": (lambda acc: db.get_accounts(), False),
+        "get_account_by_id": (lambda acc: db.get_account_by_id(acc.id), False),
+        "get_account_by_name": (lambda acc: db.get_account_by_name(acc.account_name), False),
+        "add_account": (lambda acc: db.add_account("bench", 10), True),
+        "change_balance": (lambda acc: db.change_balance(acc, -1), True),
+        "get_balance_at": (lambda acc: db.get_balance_at(acc.id, year_ago), False),
+        "get_balance_history (365 days)": (lambda acc: db.get_balance_history(acc.id, year_ago.date()), False),
+        "reconcile_balances": (lambda acc: db.reconcile_balances(), False),
+        "setup_recurring_payment": (lambda acc: db.setup_recurring_payment(
+            db.get_recurring_payments()[0].expense, TimeFrame.WEEK), True),
+        "get_recurring_payments": (lambda acc: db.get_recurring_payments(), False),
+        "run_recurring_payments (1 year)": (lambda acc: db.run_recurring_payments(now + datetime.timedelta(days=365)),
+                                            True),
+    }
+
+
+def summarise(times: list):
+    return {"min_ms": min(times), "median_ms": statistics.median(times), "mean_ms": statistics.mean(times)}
+
+
+def use_db(path: str):
+    db.set_db_path(path)
+    db.invalidate_budget_config()
+
+
+def time_db(path: str, repeat: int, scratch: str):
+    """
+    Times each db layer benchmark
+    :param path: the synthetic database
+    :param repeat: number of runs of each benchmark
+    :param scratch: directory for the copies written to
+    :return: dict of benchmark name to timings
+    """
+    use_db(path)
+    acc = db.get_accounts()[0]
+    db.close_connection()
+
+    results = {}
+    for name, (call, writes) in db_cases().items():
+        times = []
+        for _ in range(repeat):
+            target = path
+            if writes:
+                target = os.path.join(scratch, "copy.db")
+                shutil.copyfile(path, target)
+            use_db(target)
+            db.connection()
+
+            start = time.perf_counter()
+            call(acc)
+            times.append((time.perf_counter() - start) * 1000)
+            db.close_connection()
+
+        results[name] = summarise(times)
+
+    return results
+
+
+def time_cli(path: str, repeat: int, scratch: str):
+    """
+    Times each CLI command, run in process so start up time isn't included
+    (see benchmarks.startup for that)
+    :param path: the synthetic database
+    :param repeat: number of runs of each command
+    :param scratch: directory the commands write files to
+    :return: dict of command name to timings
+    """
+    runner = CliRunner()
+    results = {}
+    for name, args in CLI_COMMANDS.items():
+        args = [arg.format(scratch=scratch) for arg in args]
+        times = []
+        for _ in range(repeat):
+            use_db(path)
+            start = time.perf_counter()
+            res = runner.invoke(app, ["--db", path, *args])
+            times.append((time.perf_counter() - start) * 1000)
+            if res.exit_code != 0:
+                raise RuntimeError(f"{name} failed: {res.output}") from res.exception
+
+        results[name] = summarise(times)
+    db.close_connection()
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """
+    Finds the benchmarks whose median got slower than the baseline allows
+    :return: list of (group, name, baseline ms, new ms)
+    """
+    return [(group, name, baseline[group][name]["median_ms"], res["median_ms"])
+            for group in ("db", "cli") for name, res in results[group].items()
+            if name in baseline.get(group, {})
+            and res["median_ms"] > baseline[group][name]["median_ms"] * (1 + tolerance)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--expenses", type=int, default=100000, help="size of the generated database")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", help="benchmark a copy of this database instead of generating one")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results from a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before failing")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        if args.db:
+            src = sqlite3.connect(args.db)
+            with sqlite3.connect(path) as dst:
+                src.backup(dst)
+            src.close()
+            dataset = {"source": args.db}
+        else:
+            dataset = generate(path, args.expenses, seed=args.seed)
+        use_db(path)
+        dataset["expenses"] = db.connection().execute("SELECT COUNT(*) FROM expenses").fetchone()[0]
+        db.close_connection()
+
+        results = {
+            "meta": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                     "repeat": args.repeat, "dataset": dataset},
+            "db": time_db(path, args.repeat, tmp),
+            "cli": time_cli(path, args.repeat, tmp),
+        }
+
+    for group in ("db", "cli"):
+        for name, res in results[group].items():
+            print(f"{group:<4}{name:<38} {res['median_ms']:10.2f}ms  (min {res['min_ms']:.2f}ms)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for group, name, old, new in regressions:
+            print(f"REGRESSION {group} {name}: {old:.2f}ms -> {new:.2f}ms")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,13 @@
-from moneytracker.cli import app
+import sys
+
+from moneytracker.client import forward
 
 if __name__ == "__main__":
+    # hand the command to a running daemon (see the serve command) if there
+    # is one, before paying for the CLI's imports
+    code = forward(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+
+    from moneytracker.cli import app
     app()
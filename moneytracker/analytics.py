@@ -0,0 +1,406 @@
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+
+from moneytracker.db.db import *
+
+# Columnar analytics over expenses. Columns are pulled out of SQLite as one
+# space separated string each (group_concat over a single scan, so the
+# columns stay aligned) and parsed straight into numpy arrays, skipping the
+# per row Expense objects of parse_expense_rows. Everything after the load
+# is vectorised.
+
+# Categories are decoded from the first few characters of their names,
+# as many as it takes to tell them apart
+_PREFIX = next(k for k in range(1, 16)
+               if len({name[:k] for name in ExpenseCategory.__members__}) == len(ExpenseCategory))
+
+
+def _prefix_code(chars: np.ndarray):
+    # packs each row of an (n, _PREFIX) uint8 array into one integer
+    code = np.zeros(len(chars), dtype=np.int64)
+    for j in range(_PREFIX):
+        code = (code << 8) | chars[:, j]
+    return code
+
+
+_CATEGORY_CODES = _prefix_code(np.array([list(name[:_PREFIX].ljust(_PREFIX).encode("ascii"))
+                                         for name in ExpenseCategory.__members__], dtype=np.uint8))
+_CATEGORY_ORDER = np.argsort(_CATEGORY_CODES)
+_CATEGORY_VALUES = np.array([ecat.value for ecat in ExpenseCategory])
+
+
+@dataclass
+class ExpenseColumns:
+    datetime: np.ndarray  # epoch seconds
+    amount: np.ndarray  # pence
+    category: np.ndarray  # ExpenseCategory values, 0 if unknown
+
+    def __len__(self):
+        return len(self.amount)
+
+
+@dataclass
+class Report:
+    months: np.ndarray  # datetime64[M] of each row of the totals
+    categories: list  # ExpenseCategory of each column of the totals
+    totals: np.ndarray  # months x categories
+    rolling: np.ndarray  # rolling average of totals
+    counts: np.ndarray  # number of expenses per category
+    percentiles: dict  # percentile to array of amounts per category
+    outliers: list  # (datetime, category, amount, score), largest score first
+
+
+def decode_categories(names: str):
+    """
+    Converts space separated category names into ExpenseCategory values
+    :param names: output of group_concat(category, ' ')
+    :return: int64 array of values, 0 for names that aren't categories
+    """
+    if not names:
+        return np.zeros(0, dtype=np.int64)
+
+    buf = np.frombuffer((names + " " * _PREFIX).encode("ascii"), dtype=np.uint8)
+    starts = np.concatenate(([0], np.flatnonzero(buf[:-_PREFIX] == ord(" ")) + 1))
+    code = _prefix_code(buf[starts[:, None] + np.arange(_PREFIX)])
+
+    pos = np.searchsorted(_CATEGORY_CODES, code, sorter=_CATEGORY_ORDER).clip(0, len(_CATEGORY_ORDER) - 1)
+    pos = _CATEGORY_ORDER[pos]
+    return np.where(_CATEGORY_CODES[pos] == code, _CATEGORY_VALUES[pos], 0)
+
+
+def load_columns(start: datetime = None, end: datetime = None):
+    """
+    Loads the expenses in a window as columns
+    :param start: (optional) oldest time included
+    :param end: (optional) newest time included
+    :return: ExpenseColumns
+    """
+    params = {"start": OLDEST if start is None else to_epoch(start),
+              "end": 2**63 - 1 if end is None else to_epoch(end)}
+
+    with connection() as conn:
+        column = window_column(conn, start, end)
+        cur = conn.execute(f"""
+            SELECT group_concat(datetime, ' '), group_concat(amount, ' '), group_concat(category, ' ')
+            FROM expenses
+            WHERE {column} BETWEEN :start AND :end
+        """, params)
+    timestamps, amounts, categories = cur.fetchone()
+
+    return ExpenseColumns(np.fromstring(timestamps or "", dtype=np.int64, sep=" "),
+                          np.fromstring(amounts or "", dtype=np.int64, sep=" "),
+                          decode_categories(categories))
+
+
+def local_offsets(timestamps: np.ndarray):
+    """
+    Gets the local UTC offset in force at each timestamp, so summer time is
+    applied as SQLite's 'localtime' does. The offset only changes a few
+    times a year: it is looked up once a day across the range and the days
+    it changed on are bisected down to the second of the change
+    :param timestamps: epoch seconds
+    :return: int64 array of offsets in seconds
+    """
+    if len(timestamps) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    def offset(ts: int):
+        return time.localtime(ts).tm_gmtoff
+
+    lo, hi = int(timestamps.min()), int(timestamps.max())
+    changes, offsets = [], [offset(lo)]
+    before = lo
+    for ts in [*range(lo + 86400, hi, 86400), hi]:
+        if offset(ts) != offsets[-1]:
+            # offset(before) is the current offset, offset(after) isn't
+            after = ts
+            while after - before > 1:
+                mid = (before + after) // 2
+                before, after = (mid, after) if offset(mid) == offsets[-1] else (before, mid)
+            changes.append(after)
+            offsets.append(offset(after))
+        before = ts
+
+    return np.array(offsets, dtype=np.int64)[np.searchsorted(changes, timestamps, side="right")]
+
+
+def to_months(timestamps: np.ndarray):
+    """
+    Converts epoch seconds into local calendar months
+    :param timestamps: epoch seconds
+    :return: datetime64[M] array
+    """
+    return (timestamps + local_offsets(timestamps)).astype("datetime64[s]").astype("datetime64[M]")
+
+
+def grouped_percentiles(values: np.ndarray, groups: np.ndarray, n_groups: int, qs: list):
+    """
+    Percentiles of each group with linear interpolation. Groups and values
+    are packed into one integer key so a single plain sort orders both
+    :param values: integer values
+    :param groups: group index of each value, 0 to n_groups - 1
+    :param n_groups: number of groups
+    :param qs: percentiles to compute (0-100)
+    :return: dict of percentile to array of n_groups values (nan for empty groups)
+    """
+    low = values.min() if len(values) else 0
+    shift = max(int(values.max() - low).bit_length() if len(values) else 0, 1)
+    keys = (groups.astype(np.int64) << shift) | (values - low)
+    keys.sort()
+    ordered = (keys & ((1 << shift) - 1)) + low
+
+    counts = np.bincount(groups, minlength=n_groups)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    present = counts > 0
+
+    res = {}
+    for q in qs:
+        pos = (offsets + (counts - 1).clip(0) * (q / 100))[present]
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        out = np.full(n_groups, np.nan)
+        out[present] = ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+        res[q] = out
+
+    return res
+
+
+def rolling_mean(totals: np.ndarray, window: int):
+    """
+    Trailing mean over the rows of a matrix, shorter at the start
+    :param totals: rows x columns
+    :param window: number of rows averaged
+    :return: matrix of the same shape
+    """
+    sums = np.cumsum(totals, axis=0, dtype=np.float64)
+    sums[window:] = sums[window:] - sums[:-window]
+    n = np.minimum(np.arange(1, len(totals) + 1), window)
+    return sums / n[:, None]
+
+
+def build_report(cols: ExpenseColumns, window: int = 3, qs: list = (50, 90, 99), top: int = 10):
+    """
+    Monthly totals, rolling averages, percentiles and outliers per category
+    :param cols: the expenses
+    :param window: months in the rolling average
+    :param qs: percentiles of expense amounts to compute
+    :param top: number of outliers
+    :return: Report
+    """
+    categories = list(ExpenseCategory)
+    n_cat = max(ecat.value for ecat in categories) + 1
+    cat = cols.category
+
+    months = to_months(cols.datetime)
+    first = months.min() if len(cols) else np.datetime64("today", "M")
+    last = months.max() if len(cols) else first
+    month_idx = (months - first).astype(np.int64)
+    n_months = int((last - first).astype(np.int64)) + 1
+
+    totals = np.bincount(month_idx * n_cat + cat, weights=cols.amount, minlength=n_months * n_cat)
+    totals = totals.reshape(n_months, n_cat)
+
+    percentiles = grouped_percentiles(cols.amount, cat, n_cat, list(qs) + [50])
+
+    # robust z-score: distance from the category median over the scaled
+    # median absolute deviation. Doubled so a median halfway between two
+    # pence stays an integer
+    median2 = np.nan_to_num(percentiles[50] * 2).astype(np.int64)
+    deviation2 = np.abs(cols.amount * 2 - median2[cat])
+    mad2 = grouped_percentiles(deviation2, cat, n_cat, [50])[50] * 1.4826
+    with np.errstate(divide="ignore", invalid="ignore"):
+        score = np.where(mad2[cat] > 0, deviation2 / mad2[cat], 0)
+
+    top = min(top, len(cols))
+    outliers = []
+    if top > 0:
+        idx = np.argpartition(-score, top - 1)[:top]
+        idx = idx[np.argsort(-score[idx])]
+        outliers = [(from_epoch(int(cols.datetime[i])), ExpenseCategory(int(cat[i])), from_pence(int(cols.amount[i])),
+                     float(score[i])) for i in idx]
+
+    values = [ecat.value for ecat in categories]
+    return Report(
+        months=first + np.arange(n_months), categories=categories, totals=totals[:, values] / 100,
+        rolling=rolling_mean(totals, window)[:, values] / 100, counts=np.bincount(cat, minlength=n_cat)[values],
+        percentiles={q: percentiles[q][values] / 100 for q in qs}, outliers=outliers
+    )
+
+
+# FORECAST
+
+# Balances are projected from the recurring payment schedules, expanded into
+# one array of occurrences and binned by day, plus optionally the average
+# daily spend of each category and account outside of recurring payments
+
+
+@dataclass
+class Schedules:
+    last_paid: np.ndarray  # epoch seconds
+    step: np.ndarray  # seconds between payments
+    amount: np.ndarray  # pence
+    account_id: np.ndarray
+    category: np.ndarray  # ExpenseCategory values
+    first_paid: np.ndarray  # epoch seconds of the expense the schedule repeats
+
+    def __len__(self):
+        return len(self.amount)
+
+
+@dataclass
+class Forecast:
+    days: np.ndarray  # datetime64[D] of each row, today first
+    accounts: list  # Account of each column
+    balances: np.ndarray  # days x accounts, balance at the end of each day
+    recurring: np.ndarray  # days x accounts, recurring payments made each day
+    categories: list  # ExpenseCategory of each row of the averages
+    averages: np.ndarray  # categories x accounts, modelled spend per day, zero without the model
+
+
+def to_days(timestamps: np.ndarray):
+    """
+    Converts epoch seconds into local calendar days
+    :param timestamps: epoch seconds
+    :return: datetime64[D] array
+    """
+    return (timestamps + local_offsets(timestamps)).astype("datetime64[s]").astype("datetime64[D]")
+
+
+def day_start(day: np.datetime64):
+    """
+    Converts a local calendar day into the epoch seconds of its midnight
+    :param day: datetime64[D]
+    :return: epoch seconds
+    """
+    return int(time.mktime(day.item().timetuple()))
+
+
+def load_schedules():
+    """
+    Loads every recurring payment that repeats (not FOREVER) as columns
+    :return: Schedules
+    """
+    steps = {tf.name: tf.value * 86400 for tf in TimeFrame if tf is not TimeFrame.FOREVER}
+    with connection() as conn:
+        rows = conn.execute("""
+            SELECT recurring_payments.last_paid, recurring_payments.time_frame, expenses.amount,
+                   expenses.account_id, expenses.category, expenses.datetime
+            FROM recurring_payments
+            INNER JOIN expenses ON expenses.id = recurring_payments.expense_id
+            WHERE recurring_payments.time_frame != 'FOREVER'
+        """).fetchall()
+
+    last_paid, time_frames, amounts, account_ids, categories, first_paid = zip(*rows) if rows else [()] * 6
+    return Schedules(np.array(last_paid, dtype=np.int64), np.array([steps[tf] for tf in time_frames], dtype=np.int64),
+                     np.array(amounts, dtype=np.int64), np.array(account_ids, dtype=np.int64),
+                     decode_categories(" ".join(categories)), np.array(first_paid, dtype=np.int64))
+
+
+def expand_schedules(schedules: Schedules, end: int):
+    """
+    Lists every payment the schedules will make after they were last paid,
+    as run_recurring_payments would make them
+    :param schedules: the recurring payments
+    :param end: epoch seconds of the last time included
+    :return: (epoch of each payment, index of its schedule)
+    """
+    counts = np.maximum((end - schedules.last_paid) // schedules.step, 0)
+    idx = np.repeat(np.arange(len(schedules)), counts)
+    k = np.arange(len(idx)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    return schedules.last_paid[idx] + k * schedules.step[idx], idx
+
+
+def paid_between(schedules: Schedules, start: int, end: int):
+    """
+    Counts the payments each schedule has already made in a time range:
+    the expense it repeats and every payment up to when it was last paid
+    :param schedules: the recurring payments
+    :param start: epoch seconds, inclusive
+    :param end: epoch seconds, exclusive
+    :return: int array of payments per schedule
+    """
+    # payments were made at last_paid - j * step for j >= 0, back to first_paid
+    lo = np.maximum(start, schedules.first_paid)
+    newest = np.where(schedules.last_paid >= end, (schedules.last_paid - end) // schedules.step + 1, 0)
+    oldest = np.where(schedules.last_paid >= lo, (schedules.last_paid - lo) // schedules.step, -1)
+    return np.maximum(oldest - newest + 1, 0)
+
+
+def category_averages(schedules: Schedules, account_ids: np.ndarray, today: np.datetime64, days: int):
+    """
+    Average spend per day of each category and account over the days
+    before today, read from the daily_totals rollup. Payments made by the
+    recurring schedules are taken out, as the forecast adds them itself
+    :param schedules: the recurring payments
+    :param account_ids: sorted account ids, the columns of the result
+    :param today: first day not included
+    :param days: number of days averaged over
+    :return: categories x accounts array of pence per day, rows by ExpenseCategory value
+    """
+    n_cat = max(ecat.value for ecat in ExpenseCategory) + 1
+    first = today - days
+    with connection() as conn:
+        cur = conn.execute("""
+            SELECT group_concat(account_id, ' '), group_concat(amount, ' '), group_concat(category, ' ')
+            FROM (
+                SELECT account_id, SUM(amount) AS amount, category
+                FROM daily_totals
+                WHERE day >= :first AND day < :today
+                GROUP BY account_id, category
+            )
+        """, {"first": str(first), "today": str(today)})
+    ids, amounts, categories = cur.fetchone()
+
+    totals = np.zeros((n_cat, len(account_ids)))
+    ids = np.fromstring(ids or "", dtype=np.int64, sep=" ")
+    known = np.isin(ids, account_ids)
+    np.add.at(totals, (decode_categories(categories)[known], np.searchsorted(account_ids, ids[known])),
+              np.fromstring(amounts or "", dtype=np.int64, sep=" ")[known])
+
+    paid = paid_between(schedules, day_start(first), day_start(today)) * schedules.amount
+    known = np.isin(schedules.account_id, account_ids)
+    np.add.at(totals, (schedules.category[known], np.searchsorted(account_ids, schedules.account_id[known])),
+              -paid[known])
+
+    return totals / days
+
+
+def build_forecast(accounts: list, schedules: Schedules, days: int, average_days: int = 0):
+    """
+    Projects the balance of each account at the end of each day, from its
+    current balance less the recurring payments due (those already due are
+    made today) and optionally less the average daily spend of each category
+    :param accounts: the accounts to forecast
+    :param schedules: the recurring payments
+    :param days: number of days projected, today first
+    :param average_days: days before today the averages are learnt from, 0 to leave them out
+    :return: Forecast
+    """
+    accounts = sorted(accounts, key=lambda acc: acc.id)
+    account_ids = np.array([acc.id for acc in accounts], dtype=np.int64)
+    today = np.datetime64("today", "D")
+    n_acc = len(accounts)
+
+    end = day_start(today + days) - 1
+    times, idx = expand_schedules(schedules, end)
+    cols = np.searchsorted(account_ids, schedules.account_id[idx]).clip(0, max(n_acc - 1, 0))
+    keep = (account_ids[cols] == schedules.account_id[idx]) if n_acc else np.zeros(len(idx), dtype=bool)
+    day = np.maximum((to_days(times[keep]) - today).astype(np.int64), 0)
+    recurring = np.bincount(day * n_acc + cols[keep], weights=schedules.amount[idx[keep]],
+                            minlength=days * n_acc).reshape(days, n_acc)
+
+    averages = np.zeros((max(ecat.value for ecat in ExpenseCategory) + 1, n_acc))
+    if average_days > 0:
+        averages = category_averages(schedules, account_ids, today, average_days)
+
+    # today's spending has already been recorded, so the averages start tomorrow
+    spend = recurring.copy()
+    spend[1:] += averages.sum(axis=0)
+    balances = np.array([to_pence(acc.balance) for acc in accounts], dtype=np.float64) - np.cumsum(spend, axis=0)
+
+    values = [ecat.value for ecat in ExpenseCategory]
+    return Forecast(days=today + np.arange(days), accounts=accounts, balances=balances / 100,
+                    recurring=recurring / 100, categories=list(ExpenseCategory), averages=averages[values] / 100)
@@ -2,19 +2,84 @@ import typer
 from typing import Optional, List
 
 from rich.console import Console
-from rich.prompt import Confirm
-from rich.table import Table
-from rich.progress_bar import ProgressBar
 
 from moneytracker.db.db import *
 
-from dateutil.parser import isoparse
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import islice
+import os
+import sys
+import time
 
 console = Console()
 app = typer.Typer()
 
 
+def parse_date_range(date_from: str = None, date_to: str = None):
+    """
+    Parses the --from and --to options of a command. A date without a time
+    as the end of the range includes the whole of that day
+    :param date_from: (optional) ISO date or datetime of the start
+    :param date_to: (optional) ISO date or datetime of the end
+    :return: (start, end) datetimes, None where not given
+    """
+    from dateutil.parser import isoparse
+
+    start = None if date_from is None else isoparse(date_from)
+    end = None if date_to is None else isoparse(date_to)
+    if end is not None and len(date_to) <= 10:
+        end += timedelta(days=1, seconds=-1)  # the whole day
+
+    return start, end
+
+
+def print_budget_alerts(before: list, after: list):
+    """
+    Warns about the budget alerts reached between two budget statuses
+    :param before: budget statuses from before some expenses were added
+    :param after: budget statuses from after
+    :return: void
+    """
+    previous = {status.category: status for status in before}
+    for status in after:
+        crossed = status.crossed(previous[status.category]) if status.category in previous else []
+        if crossed:
+            colour = "red1" if crossed[-1] >= 1 else "yellow1"
+            console.print("[bold {colour}]{category} has reached {alert:.0%} of its £{budget:.2f} {tf} budget "
+                          "(£{spent:.2f} spent)[/bold {colour}]"
+                          .format(colour=colour, category=status.category.name, alert=crossed[-1],
+                                  budget=status.budget, tf=status.time_frame.name, spent=status.amount_spent))
+
+
+@app.callback()
+def main(ctx: typer.Context,
+         db: Optional[str] = typer.Option(None, "--db", envvar=DB_PATH_ENV,
+                                          help="Path of the database [default: ./finances.db]"),
+         run_recurring_on_start: bool = typer.Option(False, "--run-recurring",
+                                                     envvar="MONEYTRACKER_RUN_RECURRING",
+                                                     help="Make due recurring payments before the command"),
+         profile: bool = typer.Option(False, "--profile", envvar="MONEYTRACKER_PROFILE",
+                                      help="Print the queries run and where the time went"),
+         profile_output: Optional[str] = typer.Option(None, "--profile-output",
+                                                      help="Also write the profile as a JSON trace to this file")):
+    """
+    Moneytracker: track your finances from the command line
+    """
+    if profile or profile_output:
+        from moneytracker import profiling
+
+        profiling.enable(console, sys.modules[__name__])
+        if profile:
+            ctx.call_on_close(lambda: profiling.print_summary(console))
+        if profile_output:
+            ctx.call_on_close(lambda: profiling.write_trace(profile_output))
+
+    if db is not None:
+        set_db_path(db)
+    if run_recurring_on_start:
+        run_recurring_payments()
+
+
 @app.command(short_help="Document an expense")
 def spend(amount: float = typer.Option(..., "--amount", "-m", help="How much was spent"),
           account_name: str = typer.Option(..., "--account", "-a", help="Which account it was taken from"),
@@ -29,15 +94,16 @@ def spend(amount: float = typer.Option(..., "--amount", "-m", help="How much was
     :return: void
     """
     acc = get_account_by_name(account_name)
-    insert_expense(
-        Expense(-1, reason, ExpenseCategory[category], datetime.now(), amount, acc))
-    new_balance = change_balance(acc, -1*amount)
+    ecat = ExpenseCategory[category]
+    before = get_budget_status([ecat])
+    _, new_balance = record_transaction(Expense(-1, reason, ecat, datetime.now(), amount, acc))
 
     console.print("Adding expense {amount:.2f} for {reason} to {name}"
                   .format(amount=amount, reason=category, name=account_name))
     console.print("Account [bold green]{name}[/bold green]'s balance changed [bold red]{old:.2f}[/bold red] -> "
                   "[bold blue]{new:.2f}[/bold blue]"
-                  .format(name=acc.account_name, old=acc.balance, new=new_balance))
+                  .format(name=acc.account_name, old=new_balance + amount, new=new_balance))
+    print_budget_alerts(before, get_budget_status([ecat]))
 
 
 @app.command(short_help="Document a deposit")
@@ -54,25 +120,192 @@ def deposit(amount: float = typer.Option(..., "--amount", "-m", help="How much w
     :return: void
     """
     acc = get_account_by_name(account_name)
-    insert_expense(
-        Expense(-1*amount, ExpenseCategory[category], reason, datetime.now(), acc))
-    new_balance = change_balance(acc, amount)
+    _, new_balance = record_transaction(
+        Expense(-1, reason, ExpenseCategory[category], datetime.now(), -1*amount, acc))
 
     console.print("Adding deposit {amount:.2f} for {reason} to {name}"
                   .format(amount=amount, reason=category, name=account_name))
+    console.print("Account [bold green]{name}[/bold green]'s balance changed [bold red]{old:.2f}[/bold red] -> "
+                  "[bold blue]{new:.2f}[/bold blue]"
+                  .format(name=acc.account_name, old=new_balance - amount, new=new_balance))
+
+
+@app.command(name="import", short_help="Import transactions from a statement file")
+def import_transactions(
+        path: str,
+        account_name: str = typer.Option(..., "--account", "-a", help="Which account the transactions belong to"),
+        file_format: Optional[str] = typer.Option(None, "--format", "-f",
+                                                  help="csv, qif or ofx (defaults to the file extension)"),
+        category: Optional[str] = typer.Option("GENERAL", "--category", "-c",
+                                               help="Category used when the file doesn't give one"),
+        date_col: Optional[str] = typer.Option("date", "--date-col", help="CSV column holding the date"),
+        amount_col: Optional[str] = typer.Option("amount", "--amount-col", help="CSV column holding the amount"),
+        reason_col: Optional[str] = typer.Option("reason", "--reason-col", help="CSV column holding the reason"),
+        category_col: Optional[str] = typer.Option(None, "--category-col", help="CSV column holding the category"),
+        id_col: Optional[str] = typer.Option(None, "--id-col", help="CSV column holding the bank's transaction id"),
+        date_format: Optional[str] = typer.Option(None, "--date-format",
+                                                  help="strptime format of the dates (e.g. %d/%m/%Y)"),
+        expenses_positive: bool = typer.Option(False, "--expenses-positive",
+                                               help="Money out is positive in the file"),
+        batch_size: Optional[int] = typer.Option(5000, "--batch-size", help="Rows written per batch")):
+    """
+    Import transactions from a CSV, QIF or OFX file in a single transaction.
+    Transactions already imported into the account are skipped\n
+    :param path: the statement file
+    :param account_name: Name of the account the transactions belong to
+    :param file_format: csv, qif or ofx
+    :param category: default category of imported transactions
+    :param date_col: CSV date column
+    :param amount_col: CSV amount column
+    :param reason_col: CSV reason column
+    :param category_col: (optional) CSV category column
+    :param id_col: (optional) CSV transaction id column, transactions are matched by content otherwise
+    :param date_format: (optional) format of the dates, isoformat otherwise
+    :param expenses_positive: whether money out is positive in the file
+    :param batch_size: number of rows written per batch
+    :return: void
+    """
+    from moneytracker.importer import READERS, with_import_keys
+
+    acc = get_account_by_name(account_name)
+    if acc is None:
+        console.print(f"[red]Account {account_name} does not exist[/red]")
+        raise typer.Exit(1)
+
+    file_format = (file_format or os.path.splitext(path)[1].lstrip(".")).lower()
+    if file_format not in READERS:
+        console.print(f"[red]Unsupported file format '{file_format}'[/red]")
+        raise typer.Exit(1)
+
+    options = {"category": ExpenseCategory[category], "expenses_positive": expenses_positive}
+    if date_format is not None:
+        options["date_format"] = date_format
+    if file_format == "csv":
+        options.update(date_col=date_col, amount_col=amount_col, reason_col=reason_col, category_col=category_col,
+                       id_col=id_col)
+
+    before = get_budget_status()
+    start = time.perf_counter()
+    count = insert_expenses(with_import_keys(READERS[file_format](path, acc, **options)), batch_size)
+    elapsed = time.perf_counter() - start
+
+    new_balance = get_account_by_id(acc.id).balance
+    console.print("[bold green]Imported {count} transactions into {name} in {secs:.2f}s "
+                  "({rate:.0f} rows/sec)[/bold green]"
+                  .format(count=count, name=acc.account_name, secs=elapsed, rate=count / elapsed if elapsed else 0))
     console.print("Account [bold green]{name}[/bold green]'s balance changed [bold red]{old:.2f}[/bold red] -> "
                   "[bold blue]{new:.2f}[/bold blue]"
                   .format(name=acc.account_name, old=acc.balance, new=new_balance))
+    print_budget_alerts(before, get_budget_status())
+
+
+@app.command(short_help="Export expenses, budgets or recurring payments")
+def export(
+        path: str,
+        table: Optional[str] = typer.Option("expenses", "--table", "-t",
+                                            help="expenses, budgets or recurring_payments"),
+        file_format: Optional[str] = typer.Option(None, "--format", "-f",
+                                                  help="csv, jsonl or parquet (defaults to the file extension)"),
+        date_from: Optional[str] = typer.Option(None, "--from", help="ISO date of the oldest expense included"),
+        date_to: Optional[str] = typer.Option(None, "--to", help="ISO date of the newest expense included"),
+        category: Optional[List[str]] = typer.Option(None, "--category", "-c", help="Only these categories"),
+        account_name: Optional[str] = typer.Option(None, "--account", "-a", help="Only this account"),
+        batch_size: Optional[int] = typer.Option(10000, "--batch-size", help="Rows fetched and written per batch")):
+    """
+    Streams a table to a CSV, JSON lines or Parquet file (- for stdout)\n
+    :param path: the file to write
+    :param table: expenses, budgets or recurring_payments
+    :param file_format: csv, jsonl or parquet
+    :param date_from: (optional) ISO date, oldest day included
+    :param date_to: (optional) ISO date, newest day included
+    :param category: (optional) categories to include
+    :param account_name: (optional) account to include
+    :param batch_size: number of rows per batch
+    :return: void
+    """
+    from moneytracker.export import WRITERS
+
+    status = Console(stderr=True) if path == "-" else console
+    file_format = (file_format or os.path.splitext(path)[1].lstrip(".")).lower()
+    if file_format not in WRITERS or (path == "-" and file_format == "parquet"):
+        status.print(f"[red]Unsupported export format '{file_format}'[/red]")
+        raise typer.Exit(1)
+    if table not in EXPORT_COLUMNS:
+        status.print(f"[red]Can't export '{table}', choose from {', '.join(EXPORT_COLUMNS)}[/red]")
+        raise typer.Exit(1)
+
+    acc = None
+    if account_name is not None:
+        if "account_id" not in EXPORT_COLUMNS[table]:
+            status.print(f"[red]{table} don't belong to an account, --account only filters expenses and "
+                         f"recurring_payments[/red]")
+            raise typer.Exit(1)
+        acc = get_account_by_name(account_name)
+        if acc is None:
+            status.print(f"[red]Account {account_name} does not exist[/red]")
+            raise typer.Exit(1)
+
+    start, end = parse_date_range(date_from, date_to)
+
+    batches = iter_export(table, start, end, [ExpenseCategory[c] for c in category or []],
+                          None if acc is None else acc.id, iso_dates=file_format != "parquet",
+                          batch_size=batch_size)
+
+    # write next to the target and move it into place once finished, so a failed export neither leaves a
+    # partial file behind nor touches a file that was already there
+    out = path if path == "-" else f"{path}.{os.getpid()}.tmp"
+    started = time.perf_counter()
+    try:
+        if file_format == "parquet":
+            try:
+                count = WRITERS[file_format](out, EXPORT_COLUMNS[table], batches)
+            except ImportError:
+                status.print("[red]Parquet export needs pyarrow (pip install pyarrow)[/red]")
+                raise typer.Exit(1)
+        elif path == "-":
+            count = WRITERS[file_format](sys.stdout, EXPORT_COLUMNS[table], batches)
+        else:
+            with open(out, "w", newline="", encoding="utf-8") as f:
+                count = WRITERS[file_format](f, EXPORT_COLUMNS[table], batches)
+        if out != path:
+            os.replace(out, path)
+    except BaseException:
+        if out != path and os.path.exists(out):
+            os.remove(out)
+        raise
+    elapsed = time.perf_counter() - started
+
+    status.print("[bold green]Exported {count} {table} rows in {secs:.2f}s ({rate:.0f} rows/sec)[/bold green]"
+                 .format(count=count, table=table, secs=elapsed, rate=count / elapsed if elapsed else 0))
 
 
 @app.command(short_help="Gives an overview by category")
-def overview():
+def overview(date_from: Optional[str] = typer.Option(None, "--from", help="ISO date of the first day included"),
+             date_to: Optional[str] = typer.Option(None, "--to", help="ISO date of the last day included")):
     """
-    Gives an overview of categories and their expenses
+    Gives an overview of categories and their expenses, within each budget's
+    time frame or between two dates with budgets prorated to the range\n
+    :param date_from: (optional) ISO date, first day included
+    :param date_to: (optional) ISO date, last day included [default = today]
     :return: void
     """
+    from rich.progress_bar import ProgressBar
+    from rich.table import Table
+
+    if date_from is None and date_to is not None:
+        console.print("[red]--to needs a --from date[/red]")
+        raise typer.Exit(1)
+
+    title = "Overview"
+    overviews = get_overview
+    if date_from is not None:
+        start, end = parse_date_range(date_from, date_to)
+        end = datetime.now() if end is None else end
+        title = f"Overview {start.date()} to {end.date()}"
+        overviews = lambda: get_range_overview(start.date(), end.date())
+
     table = Table(show_header=True, header_style="bold magenta", show_edge=False,
-                  title="Overview", title_style="bold green")
+                  title=title, title_style="bold green")
     table.add_column("Category", width=8)
     table.add_column("Net", width=10)
     table.add_column("Budget", width=25)
@@ -92,13 +325,8 @@ def overview():
         else:
             return "green"
 
-    for ecat in list(ExpenseCategory):
-        tf = get_timeframe(ecat)
-        res = get_by_category(ecat, tf)
-
-        if res is None:
-            continue
-
+    for res in overviews():
+        ecat = res.category
         colour = get_colour_from_category(ecat)
         progress = ProgressBar(
             total=res.budget if res.budget > 0 else 1,
@@ -114,34 +342,301 @@ def overview():
     console.print(table)
 
 
+@app.command(short_help="Monthly totals, percentiles and outliers by category")
+def report(months: Optional[int] = typer.Option(12, "--months", "-n", help="Months covered, 0 for everything"),
+           window: Optional[int] = typer.Option(3, "--window", "-w", help="Months in the rolling average"),
+           top: Optional[int] = typer.Option(10, "--top", help="Number of outliers to show")):
+    """
+    Analyses expenses in bulk: monthly totals per category, a rolling average,
+    amount percentiles and the most unusual expenses\n
+    :param months: (optional) number of months back to analyse
+    :param window: (optional) months in the rolling average
+    :param top: (optional) number of outliers to list
+    :return: void
+    """
+    try:
+        from moneytracker.analytics import load_columns, build_report
+    except ImportError:
+        console.print("[red]The report command needs numpy (pip install numpy)[/red]")
+        raise typer.Exit(1)
+    from rich.table import Table
+
+    started = time.perf_counter()
+    start = None if months == 0 else datetime.now() - timedelta(days=months * 365 / 12)
+    cols = load_columns(start)
+    res = build_report(cols, window, top=top)
+    elapsed = time.perf_counter() - started
+
+    table = Table(show_header=True, header_style="bold blue", show_edge=False,
+                  title="Monthly Totals", title_style="bold green1")
+    table.add_column("Month", width=7)
+    for ecat in res.categories:
+        table.add_column(ecat.name.capitalize(), justify="right")
+    table.add_column("Total", justify="right")
+    for month, totals in zip(res.months, res.totals):
+        table.add_row(str(month), *["{amount:.0f}".format(amount=t) for t in totals],
+                      "[bold]{amount:.0f}[/bold]".format(amount=totals.sum()))
+    console.print(table)
+
+    table = Table(show_header=True, header_style="bold blue", show_edge=False,
+                  title="By Category", title_style="bold green1")
+    table.add_column("Category", width=8)
+    table.add_column("Count", justify="right")
+    for q in res.percentiles:
+        table.add_column(f"P{q}", justify="right")
+    table.add_column(f"{window}m Avg", justify="right")
+    for i, ecat in enumerate(res.categories):
+        if res.counts[i] == 0:
+            continue
+        table.add_row(ecat.name, str(res.counts[i]),
+                      *["£{amount:.2f}".format(amount=p[i]) for p in res.percentiles.values()],
+                      "£{amount:.2f}".format(amount=res.rolling[-1, i]))
+    console.print(table)
+
+    table = Table(show_header=True, header_style="bold blue", show_edge=False,
+                  title="Outliers", title_style="bold green1")
+    table.add_column("Date", width=16)
+    table.add_column("Category", width=8)
+    table.add_column("Amount", justify="right")
+    table.add_column("Score", justify="right")
+    for date, ecat, amount, score in res.outliers:
+        table.add_row(date.strftime("%d/%m/%Y %H:%M"), ecat.name, "£{amount:.2f}".format(amount=amount),
+                      "{score:.1f}".format(score=score))
+    console.print(table)
+
+    console.print("[italic]Analysed {n} expenses in {ms:.0f}ms[/italic]".format(n=len(cols), ms=elapsed * 1000))
+
+
+@app.command(short_help="Project account balances from recurring payments")
+def forecast(months: Optional[int] = typer.Option(3, "--months", "-n", help="Months projected"),
+             average: Optional[int] = typer.Option(0, "--average", "-k",
+                                                   help="Also spend each category's average over the last K months"),
+             account_name: Optional[List[str]] = typer.Option([], "--account", "-a", help="Only these accounts")):
+    """
+    Projects each account's balance day by day from its recurring payments,
+    and optionally its average spending by category\n
+    :param months: (optional) number of months to project
+    :param average: (optional) months of history the category averages are taken from, 0 for none
+    :param account_name: (optional) only forecast these accounts
+    :return: void
+    """
+    try:
+        from moneytracker.analytics import load_schedules, build_forecast
+        import numpy as np
+    except ImportError:
+        console.print("[red]The forecast command needs numpy (pip install numpy)[/red]")
+        raise typer.Exit(1)
+    from dateutil.relativedelta import relativedelta
+    from rich.table import Table
+
+    accounts = get_accounts()
+    if account_name:
+        accounts = [acc for acc in accounts if acc.account_name in account_name]
+        missing = set(account_name) - {acc.account_name for acc in accounts}
+        if missing:
+            console.print("[red]Account {names} does not exist[/red]".format(names=", ".join(sorted(missing))))
+            raise typer.Exit(1)
+
+    started = time.perf_counter()
+    today = datetime.now().date()
+    schedules = load_schedules()
+    res = build_forecast(accounts, schedules, (today + relativedelta(months=months) - today).days + 1,
+                         ((today - (today - relativedelta(months=average))).days))
+    elapsed = time.perf_counter() - started
+
+    # the end of each month and the last day projected
+    rows = np.flatnonzero(np.append(res.days[1:].astype("datetime64[M]") != res.days[:-1].astype("datetime64[M]"),
+                                    True))
+    table = Table(show_header=True, header_style="bold blue", show_edge=False,
+                  title="Forecast Balances", title_style="bold green1")
+    table.add_column("Date", width=10)
+    for acc in res.accounts:
+        table.add_column(acc.account_name, justify="right")
+    for i in rows:
+        table.add_row(str(res.days[i]), *["£{amount:.2f}".format(amount=b) for b in res.balances[i]])
+    console.print(table)
+
+    table = Table(show_header=True, header_style="bold blue", show_edge=False,
+                  title="By Account", title_style="bold green1")
+    table.add_column("Account", width=12)
+    table.add_column("Now", justify="right")
+    table.add_column("Recurring", justify="right")
+    table.add_column("Average", justify="right")
+    table.add_column("End", justify="right")
+    table.add_column("Lowest", justify="right")
+    for j, acc in enumerate(res.accounts):
+        low = int(np.argmin(res.balances[:, j])) if len(res.days) else 0
+        colour = "red1" if res.balances[low, j] < 0 else "green"
+        table.add_row(acc.account_name, "£{amount:.2f}".format(amount=acc.balance),
+                      "£{amount:.2f}".format(amount=res.recurring[:, j].sum()),
+                      "£{amount:.2f}/day".format(amount=res.averages[:, j].sum()),
+                      "£{amount:.2f}".format(amount=res.balances[-1, j]),
+                      "[{colour}]£{amount:.2f} on {day}[/{colour}]".format(colour=colour, amount=res.balances[low, j],
+                                                                           day=res.days[low]))
+    console.print(table)
+
+    console.print("[italic]Projected {n} recurring payments over {days} days in {ms:.0f}ms[/italic]"
+                  .format(n=len(schedules), days=len(res.days), ms=elapsed * 1000))
+
+
+@app.command(short_help="Budgets against spending for each calendar period")
+def periods(period: Optional[str] = typer.Option("MONTH", "--period", "-p", help="DAY, WEEK, MONTH or YEAR"),
+            count: Optional[int] = typer.Option(12, "--count", "-n", help="Number of periods up to the current one"),
+            date_from: Optional[str] = typer.Option(None, "--from", help="ISO date of the first day included"),
+            date_to: Optional[str] = typer.Option(None, "--to", help="ISO date of the last day included"),
+            category: Optional[List[str]] = typer.Option([], "--category", "-c", help="Only these categories")):
+    """
+    Shows the spending of each category in every calendar period alongside
+    its budget for that period\n
+    :param period: (optional) length of each period [default = MONTH]
+    :param count: (optional) number of periods back from the current one, ignored with --from
+    :param date_from: (optional) ISO date, first day included
+    :param date_to: (optional) ISO date, last day included [default = today]
+    :param category: (optional) categories to show
+    :return: void
+    """
+    from rich.table import Table
+
+    tf = TimeFrame[period]
+    if tf not in PERIOD_START:
+        console.print(f"[red]{period} is not a calendar period, choose from DAY, WEEK, MONTH or YEAR[/red]")
+        raise typer.Exit(1)
+
+    start, end = parse_date_range(date_from, date_to)
+    end = datetime.now().date() if end is None else end.date()
+    start = period_start(tf, end, count - 1) if start is None else start.date()
+
+    shown = [ExpenseCategory[ecat] for ecat in category] or [ecat for ecat in ExpenseCategory
+                                                               if ecat is not ExpenseCategory.WAGE]
+    totals = {}
+    for res in get_period_totals(tf, start, end):
+        if res.category in shown:
+            totals.setdefault(res.period, {})[res.category] = res
+
+    table = Table(show_header=True, header_style="bold blue", show_edge=False,
+                  title=f"Budgets by {tf.name.lower()}", title_style="bold green1")
+    table.add_column("Period", width=10)
+    for ecat in shown:
+        colour = get_colour_from_category(ecat)
+        table.add_column(f"[{colour}]{ecat.name.capitalize()}[/{colour}]", justify="right")
+    table.add_column("Spent", justify="right")
+    table.add_column("Budget", justify="right")
+
+    def cell(res: PeriodTotal):
+        if res is None:
+            return "[dim]-[/dim]"
+        colour = "red1" if 0 < res.budget < res.amount_spent else "green"
+        return f"[{colour}]{res.amount_spent:.0f}[/{colour}]" if res.budget > 0 else f"{res.amount_spent:.0f}"
+
+    for day, row in totals.items():
+        table.add_row(day.isoformat(), *[cell(row.get(ecat)) for ecat in shown],
+                      "[bold]£{amount:.2f}[/bold]".format(amount=sum(r.amount_spent for r in row.values())),
+                      "£{amount:.2f}".format(amount=sum(r.budget for r in row.values())))
+
+    console.print(table)
+
+
 @app.command(short_help="Set a budget")
 def budget(category: str = typer.Option(..., "--category", "-c", help="Which category you're updating"),
            amount: float = typer.Option(..., "--amount", "-m", help="The new budget for this category"),
            timeframe: Optional[str] =
-           typer.Option("MONTH", "--time-frame", "-t",
-                        help="The length of time an expense is considered part of the budget")):
+           typer.Option(None, "--time-frame", "-t",
+                        help="The length of time an expense is considered part of the budget "
+                             "[default: unchanged, MONTH for a new budget]"),
+           calendar: Optional[bool] =
+           typer.Option(None, "--calendar/--rolling",
+                        help="Budget the current calendar week/month/year, or the last N days "
+                             "[default: unchanged, rolling for a new budget]"),
+           alert: Optional[List[float]] = typer.Option([], "--alert",
+                                                       help="Warn when this fraction of the budget is spent "
+                                                            "[default: 0.8 and 1]")):
     """
     Set the budget of a given category\n
-    :param timeframe: Time period for which a budget lasts
+    :param timeframe: (optional) Time period for which a budget lasts, unchanged if not given
     :param category: the category to update
     :param amount: the new budget
+    :param calendar: (optional) the budget resets at the start of each calendar period, unchanged if not given
+    :param alert: (optional) fractions of the budget to warn at, replacing the current ones
     :return: void
     """
     ecat = ExpenseCategory[category]
-    tf = TimeFrame[timeframe]
-    old = set_budget(ecat, amount, tf)
+    tf = None if timeframe is None else TimeFrame[timeframe]
+    current = get_budget_config().get(ecat.name)
+    old = set_budget(ecat, amount, tf, calendar, tuple(alert) or None)
+    new = get_budget_config()[ecat.name]
+    colour = get_colour_from_category(ecat)
+
+    def covers(b: Budget):
+        return f"{b.time_frame} (calendar)" if b.calendar else b.time_frame
+
+    covered = None if current is None else covers(current)
     if old is None:
         console.print("[bold green]Set {category} budget to {amount:.2f}[/bold green]"
                       .format(category=category, amount=amount))
-    else:
-        if old == amount:
-            console.print("Category [bold {colour}]{category}[/bold {colour}] is already [bold red1]"
-                          "{amount:.2f}[/bold red1]"
-                          .format(category=category, colour=get_colour_from_category(ecat), amount=amount))
-        else:
-            console.print("Updating [bold {colour}]{category}[/bold {colour}] budget from [bold orange]"
-                          "{old:.2f}[/bold orange] to [bold green]{new:.2f}[/bold green]"
-                          .format(category=category, old=old, new=amount, colour=get_colour_from_category(ecat)))
+    elif old != amount:
+        console.print("Updating [bold {colour}]{category}[/bold {colour}] budget from [bold orange]"
+                      "{old:.2f}[/bold orange] to [bold green]{new:.2f}[/bold green]"
+                      .format(category=category, old=old, new=amount, colour=colour))
+    elif covered == covers(new) and current.alerts == new.alerts:
+        console.print("Category [bold {colour}]{category}[/bold {colour}] is already [bold red1]"
+                      "{amount:.2f}[/bold red1]".format(category=category, colour=colour, amount=amount))
+
+    if covered is not None and covered != covers(new):
+        console.print("Category [bold {colour}]{category}[/bold {colour}] now covers [bold green]{tf}[/bold green]"
+                      " instead of [bold orange]{old}[/bold orange]"
+                      .format(category=category, colour=colour, tf=covers(new), old=covered))
+    if current is not None and current.alerts != new.alerts:
+        console.print("Category [bold {colour}]{category}[/bold {colour}] now warns at [bold green]{alerts}"
+                      "[/bold green]".format(category=category, colour=colour,
+                                             alerts=", ".join(f"{a:.0%}" for a in new.alerts) or "nothing"))
+
+
+@app.command(name="budget-status", short_help="How much of each budget has been spent")
+def budget_status(
+        category: Optional[List[str]] = typer.Option([], "--category", "-c", help="Only these categories"),
+        as_json: bool = typer.Option(False, "--json", help="Print the statuses as JSON")):
+    """
+    Shows the spending of each budget within its time frame, read from
+    running totals so it is cheap to poll\n
+    :param category: (optional) only show these categories
+    :param as_json: print a JSON list for scripts instead of a table
+    :return: void
+    """
+    statuses = get_budget_status([ExpenseCategory[ecat] for ecat in category])
+
+    if as_json:
+        import json
+
+        print(json.dumps([{
+            "category": s.category.name, "spent": s.amount_spent, "budget": s.budget,
+            "remaining": round(s.budget - s.amount_spent, 2), "used": s.used, "time_frame": s.time_frame.name,
+            "calendar": s.calendar, "window_start": s.window_start and s.window_start.isoformat(), "alerts": list(s.alerts),
+            "alerts_reached": [a for a in s.alerts if s.budget > 0 and s.amount_spent >= a * s.budget]
+        } for s in statuses]))
+        return
+
+    from rich.table import Table
+
+    table = Table(show_header=True, header_style="bold blue", show_edge=False,
+                  title="Budget Status", title_style="bold green1")
+    table.add_column("Category", width=10)
+    table.add_column("Spent", width=10, justify="right")
+    table.add_column("Budget", width=10, justify="right")
+    table.add_column("Used", width=6, justify="right")
+    table.add_column("Time Frame", width=16, justify="right")
+    table.add_column("Since", width=17, justify="right")
+
+    for s in statuses:
+        ecat_colour = get_colour_from_category(s.category)
+        used = "-" if s.used is None else "{used:.0%}".format(used=s.used)
+        if s.used is not None and any(s.used >= a for a in s.alerts):
+            used = f"[bold red1]{used}[/bold red1]" if s.used >= 1 else f"[bold yellow1]{used}[/bold yellow1]"
+        table.add_row(f"[bold {ecat_colour}]{s.category.name}[/bold {ecat_colour}]",
+                      "£{amount:.2f}".format(amount=s.amount_spent), "£{amount:.2f}".format(amount=s.budget), used,
+                      f"{s.time_frame.name} (calendar)" if s.calendar else s.time_frame.name,
+                      "-" if s.window_start is None else s.window_start.strftime("%d/%m/%Y %H:%M"))
+
+    console.print(table)
 
 
 @app.command(short_help="Show a list of categories and their budget")
@@ -150,20 +645,26 @@ def categories():
     Gives a rundown of all categories, their budget and purpose
     :return: void
     """
+    from rich.table import Table
+
     budgets = get_budget()
+    spent = {o.category.name: o.amount_spent for o in get_overview()}
     table = Table(show_header=True, header_style="bold blue", show_edge=False,
                   title="Your Budget", title_style="bold green1")
     table.add_column("Category", width=10)
     table.add_column("Description", width=40)
     table.add_column("Budget", width=10, justify="right")
-    table.add_column("Time Frame", width=10, justify="right")
+    table.add_column("Spent", width=10, justify="right")
+    table.add_column("Time Frame", width=14, justify="right")
 
     for row in budgets:
         ecat = ExpenseCategory[row.category]
         ecat_colour = get_colour_from_category(ecat)
         table.add_row(f"[bold {ecat_colour}]{row.category}[/bold {ecat_colour}]",
                       f"[italic]{ecat.description()}[/italic]",
-                      "[bold]£{amount:.2f}[/bold]".format(amount=row.amount), row.time_frame)
+                      "[bold]£{amount:.2f}[/bold]".format(amount=row.amount),
+                      "£{amount:.2f}".format(amount=spent.get(row.category, 0)),
+                      f"{row.time_frame} (calendar)" if row.calendar else row.time_frame)
 
     console.print(table)
 
@@ -171,23 +672,41 @@ def categories():
 @app.command(short_help="List of expenses")
 def expenses(
         category: Optional[List[str]] = typer.Option([], "--category", "-c",  help="Filter by category"),
+        account_name: Optional[List[str]] = typer.Option([], "--account", "-a", help="Filter by account"),
         n: Optional[int] = typer.Option(10, "--record-count", "-n", help="The number of results wanted"),
-        start_date: Optional[str] = typer.Option(None, "--start-date", "-t",
-                                                 help="List relevant transactions from this date")):
+        start_date: Optional[str] = typer.Option(None, "--start-date", "--from", "-t",
+                                                 help="List transactions from this date"),
+        end_date: Optional[str] = typer.Option(None, "--to", help="List transactions up to this date"),
+        page: Optional[int] = typer.Option(1, "--page", "-p", help="Which page of n results to show"),
+        after: Optional[str] = typer.Option(None, "--after",
+                                            help="Continue after this cursor from a previous listing")):
     """
-    Generates a table of expenses\n
+    Generates a table of expenses, within their budget's time frame unless
+    a date range is given\n
     :param start_date: Will only fetch transactions from this date (in isoformat)
-    :param category: (optional) filter by category
+    :param end_date: Will only fetch transactions up to this date (in isoformat)
+    :param category: (optional) filter by category, can be repeated
+    :param account_name: (optional) filter by account, can be repeated
     :param n: (optional) only show last n expenses [default = 10]
+    :param page: (optional) page of n expenses to show [default = 1]
+    :param after: (optional) cursor printed by a previous listing
     :return: void
     """
-    if len(category) == 0:
-        res = get_expenses(n, None if start_date is None else isoparse(start_date))
-    else:
-        res_ls = [get_expenses_by_category(n, ExpenseCategory[ecat]) for ecat in category]
-        res = []
-        for each_cat in res_ls:
-            res += each_cat
+    from rich.table import Table
+
+    start, end = parse_date_range(start_date, end_date)
+    ranged = start is not None or end is not None
+    key = None if after is None else tuple(int(x) for x in after.split(":"))
+    categories = [ExpenseCategory[ecat] for ecat in category]
+    accounts = [get_account_by_name(name) for name in account_name]
+    for name, acc in zip(account_name, accounts):
+        if acc is None:
+            console.print(f"[red]Account {name} does not exist[/red]")
+            raise typer.Exit(1)
+
+    rows = iter_expenses(n, key, start_date=start, in_time_frame=not ranged, end_date=end,
+                         categories=categories, account_ids=[acc.id for acc in accounts])
+    res = list(islice(rows, (page - 1) * n, page * n))
 
     table = Table(show_header=True, header_style="bold blue", show_edge=False,
                   title="Your Expenses", title_style="bold green1")
@@ -199,11 +718,6 @@ def expenses(
     table.add_column("Reason", width=30)
 
     for row in res:
-        tf = get_timeframe(row.category)
-
-        if not is_within_time_frame(tf, row.date):
-            continue
-
         ecat_colour = get_colour_from_category(row.category)
         table.add_row(f"[bold {ecat_colour}]{row.category.name}[/bold {ecat_colour}]",
                       "[bold]£{amount:.2f}[/bold]".format(amount=row.amount), row.account.account_name,
@@ -212,6 +726,62 @@ def expenses(
                       f"[dim italic]{row.reason}[/dim italic]")
 
     console.print(table)
+    if len(res) == n:
+        console.print(f"[dim]Next page: --after {to_epoch(res[-1].date)}:{res[-1].id}[/dim]")
+
+
+@app.command(short_help="Search expenses by reason")
+def search(
+        query: str,
+        category: Optional[List[str]] = typer.Option([], "--category", "-c", help="Filter by category"),
+        n: Optional[int] = typer.Option(20, "--record-count", "-n", help="The number of results wanted"),
+        date_from: Optional[str] = typer.Option(None, "--from", help="ISO date of the oldest expense included"),
+        date_to: Optional[str] = typer.Option(None, "--to", help="ISO date of the newest expense included"),
+        account_name: Optional[str] = typer.Option(None, "--account", "-a", help="Only this account")):
+    """
+    Full text search of expense reasons, e.g. tesco, "car repair", tes* or coffee OR lunch\n
+    :param query: the search terms
+    :param category: (optional) filter by category
+    :param n: (optional) max number of results [default = 20]
+    :param date_from: (optional) ISO date, oldest day included
+    :param date_to: (optional) ISO date, newest day included
+    :param account_name: (optional) only search this account
+    :return: void
+    """
+    import sqlite3
+    from rich.table import Table
+
+    acc = None
+    if account_name is not None:
+        acc = get_account_by_name(account_name)
+        if acc is None:
+            console.print(f"[red]Account {account_name} does not exist[/red]")
+            raise typer.Exit(1)
+
+    start, end = parse_date_range(date_from, date_to)
+
+    try:
+        res = search_expenses(query, n, [ExpenseCategory[ecat] for ecat in category], start, end,
+                              None if acc is None else acc.id)
+    except sqlite3.OperationalError as e:
+        console.print(f"[red]Invalid search '{query}': {e}[/red]")
+        raise typer.Exit(1)
+
+    table = Table(show_header=True, header_style="bold blue", show_edge=False,
+                  title=f"Expenses matching {query}", title_style="bold green1")
+    table.add_column("Category", width=10)
+    table.add_column("Amount", width=8, justify="right")
+    table.add_column("Account", width=12)
+    table.add_column("Date", width=10, justify="right")
+    table.add_column("Reason", width=30)
+
+    for row in res:
+        ecat_colour = get_colour_from_category(row.category)
+        table.add_row(f"[bold {ecat_colour}]{row.category.name}[/bold {ecat_colour}]",
+                      "[bold]£{amount:.2f}[/bold]".format(amount=row.amount), row.account.account_name,
+                      f"{row.date.day}/{row.date.month}/{row.date.year}", f"[dim italic]{row.reason}[/dim italic]")
+
+    console.print(table)
 
 
 @app.command(short_help="Clears/resets all expense and budget data.")
@@ -221,6 +791,8 @@ def clear(category: Optional[str] = typer.Option(None, "--category", "-c")):
     :param category: (optional) remove records of a certain category
     :return: void
     """
+    from rich.prompt import Confirm
+
     console.print("[bold red]Clearing will remove all of your expense data.[/bold red]")
     ask = Confirm.ask("Are you sure you want to clear? ")
 
@@ -235,12 +807,29 @@ def clear(category: Optional[str] = typer.Option(None, "--category", "-c")):
         console.print(f"[italic]Clearing {category} data[/italic]")
         clear_by_category(ExpenseCategory[category])
 
-    create_expenses()
-    create_budgets()
-    load_default_budget_data()
+    reset_default_budgets()
     console.print("[green]Data cleared[/green]")
 
 
+@app.command(name="rebuild-totals", short_help="Regenerate the daily totals rollup")
+def rebuild_totals():
+    """
+    Checks the daily totals rollup against the expenses it summarises and
+    regenerates it from scratch
+    :return: void
+    """
+    drift = verify_daily_totals()
+    if drift == 0:
+        console.print("[green]Daily totals match the expense records[/green]")
+    else:
+        console.print(f"[bold red]{drift} daily totals differ from the expense records[/bold red]")
+
+    rows = rebuild_daily_totals()
+    drift = verify_daily_totals()
+    console.print("[bold {colour}]Rebuilt {rows} daily totals, {drift} differences remaining[/bold {colour}]"
+                  .format(rows=rows, drift=drift, colour="green" if drift == 0 else "red"))
+
+
 # ACCOUNTS
 
 @app.command(short_help="Add a new account")
@@ -261,24 +850,108 @@ def account(name: str, balance: Optional[float] = typer.Option(0, "--balance", "
 
 
 @app.command(short_help="List accounts")
-def accounts():
+def accounts(time_frame: Optional[str] = typer.Option("FOREVER", "--time-frame", "-t",
+                                                      help="Period covered by the in/out totals")):
     """
-    Outputs a list of accounts
+    Outputs a list of accounts with the money in and out of each\n
+    :param time_frame: (optional) only total whole days within this time frame
     :return: void
     """
+    from rich.table import Table
+
     account_list = get_accounts()
+    totals = get_account_totals(TimeFrame[time_frame])
     table = Table(show_header=True, header_style="bold blue", show_edge=False,
                   title="Your Accounts", title_style="bold green1")
     table.add_column("Account Name", width=12)
     table.add_column("Balance", width=10, justify="right")
+    table.add_column("In", width=10, justify="right")
+    table.add_column("Out", width=10, justify="right")
 
     for acc in account_list:
+        money_in, money_out = totals.get(acc.id, (0, 0))
         table.add_row(f"[bold]{acc.account_name}[/bold]",
-                      "£{balance:.2f}".format(balance=acc.balance))
+                      "£{balance:.2f}".format(balance=acc.balance),
+                      "[green]£{amount:.2f}[/green]".format(amount=money_in),
+                      "[red]£{amount:.2f}[/red]".format(amount=money_out))
 
     console.print(table)
 
 
+@app.command(short_help="Show an account's balance at a point in time")
+def balance(account_name: str,
+            at: Optional[str] = typer.Option(None, "--at", help="ISO date/time, defaults to now")):
+    """
+    Outputs an account's balance at a point in time\n
+    :param account_name: Name of the account
+    :param at: (optional) ISO date or datetime
+    :return: void
+    """
+    from dateutil.parser import isoparse
+
+    acc = get_account_by_name(account_name)
+    when = datetime.now() if at is None else isoparse(at)
+    console.print("[bold green]{name}[/bold green]'s balance at {when:%Y-%m-%d %H:%M}: "
+                  "[bold blue]£{balance:.2f}[/bold blue]"
+                  .format(name=acc.account_name, when=when, balance=get_balance_at(acc.id, when)))
+
+
+@app.command(name="balance-history", short_help="Show an account's daily closing balance")
+def balance_history(account_name: str,
+                    days: Optional[int] = typer.Option(30, "--days", "-d", help="Number of days to show")):
+    """
+    Outputs an account's balance at the end of each of the last few days\n
+    :param account_name: Name of the account
+    :param days: (optional) number of days to show
+    :return: void
+    """
+    from rich.table import Table
+
+    acc = get_account_by_name(account_name)
+    today = datetime.now().date()
+    history = get_balance_history(acc.id, today - timedelta(days=days - 1), today)
+
+    table = Table(show_header=True, header_style="bold blue", show_edge=False,
+                  title=f"{acc.account_name} Balance History", title_style="bold green1")
+    table.add_column("Day", width=12)
+    table.add_column("Balance", width=10, justify="right")
+    for day, bal in history:
+        table.add_row(day.isoformat(), "£{balance:.2f}".format(balance=bal))
+
+    console.print(table)
+
+
+@app.command(short_help="Check account balances against their transactions")
+def reconcile(fix: bool = typer.Option(False, "--fix", help="Replace drifted balances with the ledger balance")):
+    """
+    Recomputes each account's balance from its opening balance and transactions
+    and reports any that have drifted from the stored balance\n
+    :param fix: (optional) correct the drifted balances
+    :return: void
+    """
+    from rich.table import Table
+
+    results = reconcile_balances(fix)
+    table = Table(show_header=True, header_style="bold blue", show_edge=False,
+                  title="Reconciliation", title_style="bold green1")
+    table.add_column("Account Name", width=12)
+    table.add_column("Balance", width=10, justify="right")
+    table.add_column("Ledger", width=10, justify="right")
+    table.add_column("Drift", width=10, justify="right")
+
+    for r in results:
+        colour = "green" if r.drift == 0 else "red"
+        table.add_row(f"[bold]{r.account.account_name}[/bold]",
+                      "£{balance:.2f}".format(balance=r.account.balance),
+                      "£{balance:.2f}".format(balance=r.ledger_balance),
+                      f"[{colour}]£{r.drift:.2f}[/{colour}]")
+
+    console.print(table)
+    drifted = sum(1 for r in results if r.drift != 0)
+    if fix and drifted:
+        console.print(f"[bold green]Corrected {drifted} account balance(s)[/bold green]")
+
+
 @app.command(short_help="Add a recurring payment")
 def recur(
         amount: float,
@@ -289,15 +962,38 @@ def recur(
 ):
     acc = get_account_by_name(account_name)
     expense = Expense(-1, reason, ExpenseCategory[category], datetime.now(), amount, acc)
-    expense.id = insert_expense(expense)
-    change_balance(acc, -1 * amount)
+    expense.id, _ = record_transaction(expense)
     setup_recurring_payment(expense, TimeFrame[time_frame])
     console.print("[bold green]Setup recurring payment to {acc} for {amount:.2f} every {tf}[/bold green]"
                   .format(acc=acc.account_name, amount=amount, tf=time_frame))
 
 
+@app.command(name="run-recurring", short_help="Make any recurring payments that are due")
+def run_recurring():
+    """
+    Makes every recurring payment that has come due since it was last paid
+    :return: void
+    """
+    before = get_budget_status()
+    made = run_recurring_payments()
+    if len(made) == 0:
+        console.print("[italic]No recurring payments are due[/italic]")
+        return
+
+    for re, payments in made:
+        console.print("Paid [bold]£{amount:.2f}[/bold] from [bold green]{acc}[/bold green] for {reason} "
+                      "[bold]{n}[/bold] time(s)"
+                      .format(amount=re.expense.amount, acc=re.expense.account.account_name,
+                              reason=re.expense.reason or re.expense.category.name, n=payments))
+    console.print("[bold green]Made {n} recurring payments[/bold green]"
+                  .format(n=sum(payments for _, payments in made)))
+    print_budget_alerts(before, get_budget_status())
+
+
 @app.command(short_help="Outputs recurring payments")
 def recurring():
+    from rich.table import Table
+
     recurring_ls = get_recurring_payments()
     table = Table(show_header=True, header_style="bold blue", show_edge=False,
                   title="Your Payments", title_style="bold green1")
@@ -319,3 +1015,21 @@ def recurring():
         )
 
     console.print(table)
+
+
+@app.command(short_help="Run a daemon that other commands are forwarded to")
+def serve(socket_path: Optional[str] = typer.Option(None, "--socket", "-s", envvar="MONEYTRACKER_SOCKET",
+                                                    help="Socket to listen on [default: the database path + .sock]")):
+    """
+    Keeps the database connection and caches warm in one process and runs
+    commands forwarded to it by main.py, until stopped with Ctrl-C\n
+    :param socket_path: (optional) Unix socket to listen on
+    :return: void
+    """
+    from moneytracker.server import serve as run_daemon
+
+    try:
+        run_daemon(socket_path, lambda path: console.print(f"[bold green]Listening on {path}[/bold green]"))
+    except RuntimeError as e:
+        console.print(f"[red]{e}[/red]")
+        raise typer.Exit(1)
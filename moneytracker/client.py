@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+import socket
+import sys
+
+# Thin client for the daemon started with `main.py serve`. It only uses the
+# standard library so a forwarded command skips importing typer, rich and
+# the db layer: the daemon runs the command against its open connection and
+# streams the output back. Commands are run directly when no daemon is
+# listening for the database.
+
+SOCKET_ENV = "MONEYTRACKER_SOCKET"
+
+# Commands and options that always run in this process: serve itself,
+# commands that prompt on stdin and profiling, which instruments the
+# process it runs in
+DIRECT_COMMANDS = {"serve", "clear"}
+DIRECT_OPTIONS = {"--profile", "--profile-output"}
+DIRECT_ENV = {"MONEYTRACKER_PROFILE"}
+
+# Options before the command that take a value as the next argument
+VALUE_OPTIONS = {"--db", "--profile-output"}
+
+# Environment variables passed on to the daemon for the command
+FORWARDED_ENV = {"MONEYTRACKER_RUN_RECURRING", "NO_COLOR"}
+
+
+def db_arg(argv: list):
+    """
+    Finds the database a command runs against, the same way the CLI does
+    (--db, then MONEYTRACKER_DB, then ./finances.db)
+    :param argv: command line arguments
+    :return: absolute database path
+    """
+    path = os.environ.get("MONEYTRACKER_DB") or "./finances.db"
+    for i, arg in enumerate(argv):
+        if arg == "--db" and i + 1 < len(argv):
+            path = argv[i + 1]
+        elif arg.startswith("--db="):
+            path = arg[len("--db="):]
+
+    return os.path.abspath(path)
+
+
+def socket_path(db: str):
+    """
+    Gets the socket a daemon for a database listens on: MONEYTRACKER_SOCKET
+    if set, else the database path with .sock appended
+    :param db: absolute database path
+    :return: socket path
+    """
+    return os.environ.get(SOCKET_ENV) or db + ".sock"
+
+
+def strip_db(argv: list):
+    """
+    Removes the --db option, the daemon only serves its own database
+    :param argv: command line arguments
+    :return: the other arguments
+    """
+    res = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == "--db":
+            skip = True
+        elif not arg.startswith("--db="):
+            res.append(arg)
+
+    return res
+
+
+def runs_directly(argv: list):
+    """
+    Checks whether a command has to run in this process. Only the options
+    before the command and the command itself are looked at, so arguments
+    such as `search serve` are still forwarded
+    :param argv: command line arguments
+    :return: True to skip the daemon
+    """
+    if any(os.environ.get(name) for name in DIRECT_ENV):
+        return True
+
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg.split("=")[0] in DIRECT_OPTIONS:
+            return True
+        elif arg in VALUE_OPTIONS:
+            skip = True
+        elif not arg.startswith("-"):
+            return arg in DIRECT_COMMANDS
+
+    return True
+
+
+def forward(argv: list):
+    """
+    Runs a command on the daemon for its database if one is listening,
+    copying its output to stdout and stderr
+    :param argv: command line arguments
+    :return: the command's exit code, None if there is no daemon to run it
+    """
+    if runs_directly(argv):
+        return None
+
+    path = socket_path(db_arg(argv))
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None  # stale socket, the daemon has gone
+
+    tty = sys.stdout.isatty()
+    request = {"argv": strip_db(argv), "cwd": os.getcwd(), "tty": tty,
+               "width": shutil.get_terminal_size().columns if tty else None,
+               "env": {name: os.environ[name] for name in FORWARDED_ENV if name in os.environ}}
+
+    with sock, sock.makefile("rb") as replies:
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        for line in replies:
+            reply = json.loads(line)
+            if "out" in reply:
+                sys.stdout.write(reply["out"])
+            elif "err" in reply:
+                sys.stderr.write(reply["err"])
+            elif "exit" in reply:
+                sys.stdout.flush()
+                return reply["exit"]
+
+    sys.stderr.write("The moneytracker daemon stopped before the command finished\n")
+    return 1
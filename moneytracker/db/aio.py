@@ -0,0 +1,183 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable
+
+from moneytracker.db import db
+from moneytracker.db.db import *
+
+# Async counterpart of the db layer for asyncio services. Each call runs the
+# sync function on an executor thread, and connections are per thread (see
+# create.connection) so every worker keeps its own open connection. Reads
+# run on a pool of threads at once, which WAL allows; writes all go through
+# a single thread so they are applied one at a time in the order they were
+# awaited instead of contending for SQLite's write lock.
+
+# Reader threads used when configure hasn't been called
+READERS = 4
+
+_readers = None
+_writer = None
+
+
+def configure(readers: int = READERS):
+    """
+    Sets up the reader pool and the writer thread, replacing any existing
+    ones (see shutdown)
+    :param readers: number of reader threads, each with a connection
+    :return: void
+    """
+    global _readers, _writer
+    shutdown()
+    _readers = ThreadPoolExecutor(readers, thread_name_prefix="moneytracker-read")
+    _writer = ThreadPoolExecutor(1, thread_name_prefix="moneytracker-write")
+
+
+def shutdown(wait: bool = True):
+    """
+    Stops the executor threads once their queued calls finish. Each
+    thread's connection is closed when the thread exits
+    :param wait: block until the threads have exited
+    :return: void
+    """
+    global _readers, _writer
+    for executor in (_readers, _writer):
+        if executor is not None:
+            executor.shutdown(wait)
+    _readers = _writer = None
+
+
+def set_db_path(path: str):
+    """
+    Changes the database used by the async API, closing the worker
+    connections to the old one
+    :param path: path of the database
+    :return: void
+    """
+    shutdown()
+    db.set_db_path(path)
+
+
+async def _read(func, *args, **kwargs):
+    # runs a sync db function on a reader thread
+    if _readers is None:
+        configure()
+    return await asyncio.get_running_loop().run_in_executor(_readers, functools.partial(func, *args, **kwargs))
+
+
+async def _write(func, *args, **kwargs):
+    # runs a sync db function on the writer thread, after earlier writes
+    if _writer is None:
+        configure()
+    return await asyncio.get_running_loop().run_in_executor(_writer, functools.partial(func, *args, **kwargs))
+
+
+# EXPENSES
+
+
+async def insert_expense(expense: Expense):
+    return await _write(db.insert_expense, expense)
+
+
+async def record_transaction(expense: Expense):
+    return await _write(db.record_transaction, expense)
+
+
+async def insert_expenses(expenses: Iterable[Expense], batch_size: int = 5000):
+    # the expenses are consumed on the writer thread
+    return await _write(db.insert_expenses, expenses, batch_size)
+
+
+async def get_expenses(n: int, start_date: datetime = None):
+    return await _read(db.get_expenses, n, start_date)
+
+
+async def get_expenses_by_category(n: int, ecat: ExpenseCategory, start_date: datetime = None):
+    return await _read(db.get_expenses_by_category, n, ecat, start_date)
+
+
+async def iter_expenses(batch_size: int = 1000, **kwargs):
+    """
+    Lazily yields expenses newest first, fetching a page at a time on a
+    reader thread. Takes the same filters as db.iter_expenses
+    :param batch_size: number of records fetched per page
+    :return: async generator of expense objects
+    """
+    rows = db.iter_expenses(batch_size, **kwargs)
+    while True:
+        page = await _read(lambda: list(islice(rows, batch_size)))
+        for expense in page:
+            yield expense
+        if len(page) < batch_size:
+            return
+
+
+async def search_expenses(query: str, n: int = 20, **kwargs):
+    return await _read(db.search_expenses, query, n, **kwargs)
+
+
+# BUDGETS
+
+
+async def get_by_category(ecat: ExpenseCategory, tf: TimeFrame = None):
+    return await _read(db.get_by_category, ecat, tf)
+
+
+async def get_overview():
+    return await _read(db.get_overview)
+
+
+async def get_budget():
+    return await _read(db.get_budget)
+
+
+async def set_budget(ecat: ExpenseCategory, amount: float, tf: TimeFrame = None, calendar: bool = None,
+                     alerts: tuple = None):
+    return await _write(db.set_budget, ecat, amount, tf, calendar, alerts)
+
+
+async def get_budget_status(categories: list = None):
+    return await _read(db.get_budget_status, categories)
+
+
+# ACCOUNTS
+
+
+async def get_accounts():
+    return await _read(db.get_accounts)
+
+
+async def get_account_by_id(acc_id: int):
+    return await _read(db.get_account_by_id, acc_id)
+
+
+async def get_account_by_name(name: str):
+    return await _read(db.get_account_by_name, name)
+
+
+async def add_account(name: str, balance: float):
+    return await _write(db.add_account, name, balance)
+
+
+async def change_balance(account: Account, add_to: float):
+    return await _write(db.change_balance, account, add_to)
+
+
+async def get_balance_at(account_id: int, at: datetime):
+    return await _read(db.get_balance_at, account_id, at)
+
+
+# Recurring Payments
+
+
+async def setup_recurring_payment(expense: Expense, time_frame: TimeFrame):
+    return await _write(db.setup_recurring_payment, expense, time_frame)
+
+
+async def get_recurring_payments():
+    return await _read(db.get_recurring_payments)
+
+
+async def run_recurring_payments(now: datetime = None):
+    return await _write(db.run_recurring_payments, now)
@@ -1,77 +1,179 @@
+import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 from moneytracker.model import *
 
-conn = sqlite3.connect("./finances.db")
-c = conn.cursor()
+DB_PATH = "./finances.db"
+DB_PATH_ENV = "MONEYTRACKER_DB"
+
+# Applied to every connection. WAL lets readers carry on while another
+# process writes, and NORMAL sync only fsyncs at checkpoints under WAL
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,  # KiB
+    "mmap_size": 256 * 1024 * 1024,
+    "busy_timeout": 5000,  # ms
+}
+
+# Class of the connections opened by connect, swapped out by profiling
+connection_class = sqlite3.Connection
+
+_db_path = None
+_local = threading.local()
+
+
+def db_path():
+    """
+    Gets the path of the database: the path set with set_db_path, else the
+    MONEYTRACKER_DB environment variable, else ./finances.db
+    :return: the database path
+    """
+    return _db_path or os.environ.get(DB_PATH_ENV) or DB_PATH
+
+
+def set_db_path(path: str):
+    """
+    Changes the database used by connections opened from now on
+    :param path: path of the database
+    :return: void
+    """
+    global _db_path
+    _db_path = path
+    close_connection()
+
+
+def connect(path: str = None):
+    """
+    Opens and configures a new connection, bringing the schema up to date
+    if its version is behind. Foreign keys are enforced once migrated
+    :param path: (optional) database path, see db_path
+    :return: the sqlite3 connection
+    """
+    from moneytracker.db.migrations import migrate
+
+    conn = sqlite3.connect(db_path() if path is None else path, factory=connection_class)
+    try:
+        for pragma, value in PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        migrate(conn)
+        conn.execute("PRAGMA foreign_keys = ON")
+    except sqlite3.Error:
+        conn.close()
+        raise
+
+    return conn
+
+
+def connection():
+    """
+    Gets this thread's database connection, opening it on first use
+    :return: the sqlite3 connection
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = connect()
+
+    return conn
+
+
+@contextmanager
+def write_transaction():
+    """
+    Runs a block in a transaction that takes the write lock up front
+    (BEGIN IMMEDIATE), so it waits for other writers instead of failing
+    to upgrade a read lock part way through. Commits when the block
+    finishes and rolls back if it raises
+    :return: context manager giving this thread's connection
+    """
+    conn = connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def close_connection():
+    """
+    Closes this thread's database connection if it is open
+    :return: void
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
 
 # Expenses
+# The create functions below are the original (version 1) schema used by
+# the first migration, they don't commit so the migration stays atomic
 
 
-def create_expenses():
+def create_expenses(conn: sqlite3.Connection):
     # expenses table with expenses
-    with conn:
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS expenses (
-                id INTEGER PRIMARY KEY NOT NULL,
-                reason TEXT,
-                category TEXT,
-                datetime TEXT NOT NULL,
-                amount REAL NOT NULL,
-                account_id INTEGER NOT NULL,
-                FOREIGN KEY(account_id) REFERENCES accounts(id)
-            )
-        """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER PRIMARY KEY NOT NULL,
+            reason TEXT,
+            category TEXT,
+            datetime TEXT NOT NULL,
+            amount REAL NOT NULL,
+            account_id INTEGER NOT NULL,
+            FOREIGN KEY(account_id) REFERENCES accounts(id)
+        )
+    """)
 
 
 # Budget
 
 
-def create_budgets():
+def create_budgets(conn: sqlite3.Connection):
     # Given budgets for a given time period
-    with conn:
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS budgets (
-                category TEXT PRIMARY KEY NOT NULL,
-                budget REAL NOT NULL,
-                time_frame TEXT NOT NULL
-            )
-        """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS budgets (
+            category TEXT PRIMARY KEY NOT NULL,
+            budget REAL NOT NULL,
+            time_frame TEXT NOT NULL
+        )
+    """)
 
 
-def load_default_budget_data():
+def load_default_budget_data(conn: sqlite3.Connection):
     # Set all default budgets to £0
-    with conn:
-        for cat in list(ExpenseCategory):
-            c.execute("""
-                INSERT OR IGNORE INTO budgets (category, budget, time_frame)
-                VALUES (:cat, :default_budget, :tf)
-            """, {"cat": cat.name, "default_budget": 0, "tf": TimeFrame.MONTH.name})
+    for cat in list(ExpenseCategory):
+        conn.execute("""
+            INSERT OR IGNORE INTO budgets (category, budget, time_frame)
+            VALUES (:cat, :default_budget, :tf)
+        """, {"cat": cat.name, "default_budget": 0, "tf": TimeFrame.MONTH.name})
 
 
 # Account
 
-def create_accounts():
-    with conn:
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS accounts (
-                id INTEGER PRIMARY KEY NOT NULL,
-                account_name TEXT NOT NULL UNIQUE,
-                balance REAL NOT NULL
-            )
-        """)
-        
-        
+def create_accounts(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS accounts (
+            id INTEGER PRIMARY KEY NOT NULL,
+            account_name TEXT NOT NULL UNIQUE,
+            balance REAL NOT NULL
+        )
+    """)
+
+
 # Recurring Payments
 
 
-def create_recurring_payments():
-    with conn:
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS recurring_payments (
-                id INTEGER PRIMARY KEY NOT NULL,
-                expense_id INTEGER NOT NULL,
-                time_frame TEXT NOT NULL,
-                last_paid TEXT NOT NULL,
-                FOREIGN KEY (expense_id) REFERENCES expenses(id)
-            )        
-        """)
+def create_recurring_payments(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS recurring_payments (
+            id INTEGER PRIMARY KEY NOT NULL,
+            expense_id INTEGER NOT NULL,
+            time_frame TEXT NOT NULL,
+            last_paid TEXT NOT NULL,
+            FOREIGN KEY (expense_id) REFERENCES expenses(id)
+        )
+    """)
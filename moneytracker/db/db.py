@@ -1,160 +1,874 @@
 from moneytracker.db.create import *
 import datetime
-from dateutil.parser import isoparse
+import time
+from itertools import islice
+from typing import Iterable
 
-# CREATE TABLE
+# Lower bound for epoch comparisons when no start date is given
+OLDEST = -2 ** 63
 
-create_accounts()
-create_expenses()
-create_budgets()
-load_default_budget_data()
-create_recurring_payments()
+# Date modifiers taking a local date to the first day of its calendar period
+PERIOD_START = {
+    TimeFrame.DAY: "",
+    TimeFrame.WEEK: ", 'weekday 0', '-6 days'",
+    TimeFrame.MONTH: ", 'start of month'",
+    TimeFrame.YEAR: ", 'start of year'",
+}
+
+# Date modifier from the first day of a calendar period to the next period
+PERIOD_NEXT = {
+    TimeFrame.DAY: "'+1 day'",
+    TimeFrame.WEEK: "'+7 days'",
+    TimeFrame.MONTH: "'+1 month'",
+    TimeFrame.YEAR: "'+1 year'",
+}
+
+# Average length in days of each calendar period
+CALENDAR_DAYS = {TimeFrame.DAY: 1, TimeFrame.WEEK: 7, TimeFrame.MONTH: 30.436875, TimeFrame.YEAR: 365.2425}
+
+
+def _period_start_sql(tf: TimeFrame):
+    # epoch of local midnight at the start of the current calendar period
+    if tf not in PERIOD_START:
+        return str(OLDEST)
+    return f"CAST(strftime('%s', date('now', 'localtime'{PERIOD_START[tf]}), 'utc') AS INTEGER)"
+
+
+# Every time frame with its length in days (rolling and calendar) and the
+# start of its current calendar period, joined against budgets.time_frame
+TIME_FRAMES_CTE = "time_frames (time_frame, days, calendar_days, period_start) AS (VALUES {values})".format(
+    values=", ".join(f"('{tf.name}', {tf.value}, {CALENDAR_DAYS.get(tf, tf.value)}, {_period_start_sql(tf)})"
+                     for tf in TimeFrame))
+
+# Oldest datetime within a budget's time frame, exclusive, for use alongside
+# TIME_FRAMES_CTE and budgets. Calendar budgets start at their period start
+WINDOW_START = f"""CASE
+    WHEN time_frames.days < 0 THEN {OLDEST}
+    WHEN COALESCE(budgets.calendar, 0) THEN time_frames.period_start - 1
+    ELSE CAST(strftime('%s', 'now') AS INTEGER) - time_frames.days * 86400
+END"""
+
+# Budget configuration by category name, see get_budget_config
+_budget_cache = None
+
+# Seconds between rolls of a category's running budget total by a process,
+# and when this process last rolled each category, see _roll_budget_totals
+ROLL_INTERVAL = 60
+_rolled_at = {}
+
+# (database, account id, checkpoint time) of the checkpoints this process
+# has already taken or found, so record_transaction only looks for a
+# checkpoint the first time it writes to an interval. Checkpoints only
+# speed up get_balance_at, so a missing one is never wrong
+_checkpointed = set()
 
 
 # DATABASE INTERACTIONS
 
 
+# Inserts an expense, or nothing when its account already has an expense
+# with the same import_key
+INSERT_EXPENSE_SQL = """
+    INSERT INTO expenses (reason, category, datetime, amount, account_id, import_key)
+    VALUES (:reason, :cat, :date, :amount, :acc, :key)
+    ON CONFLICT DO NOTHING
+"""
+
+
+def expense_params(expense: Expense):
+    return {"reason": expense.reason, "cat": expense.category.name, "date": to_epoch(expense.date),
+            "amount": to_pence(expense.amount), "acc": expense.account.id, "key": expense.import_key}
+
+
 def insert_expense(expense: Expense):
-    expense_id = hash(expense)
-    with conn:
-        c.execute("INSERT INTO expenses VALUES (:id, :reason, :cat, :date, :amount, :acc)",
-                  {"id": expense_id, "reason": expense.reason, "cat": expense.category.name,
-                   "amount": expense.amount, "date": expense.date.isoformat(), "acc": expense.account.id})
-    return expense_id
+    """
+    Inserts an expense without changing its account's balance
+    :param expense: the expense
+    :return: id of the expense, None if its import_key was already imported
+    """
+    with connection() as conn:
+        cur = conn.execute(INSERT_EXPENSE_SQL, expense_params(expense))
+    return cur.lastrowid if cur.rowcount else None
+
+
+def record_transaction(expense: Expense):
+    """
+    Records an expense and applies it to its account's balance in one
+    write transaction. The balance is changed in SQL rather than from a
+    previously read value so concurrent writers can't lose updates
+    :param expense: the expense, negative amounts are deposits
+    :return: (id of the expense or None if its import_key was already imported, new balance of the account)
+    """
+    # everything that doesn't need the database is worked out before taking
+    # the write lock, which other writers wait on
+    params = expense_params(expense)
+    checkpoint = (db_path(), params["acc"], params["date"] - params["date"] % CHECKPOINT_INTERVAL - 1)
+
+    with write_transaction() as conn:
+        _roll_budget_totals(conn, [params["cat"]])
+        cur = conn.execute(INSERT_EXPENSE_SQL, params)
+        if cur.rowcount == 0:
+            balance = conn.execute("SELECT balance FROM accounts WHERE id = ?", (params["acc"],)).fetchall()
+            return None, from_pence(balance[0][0])
+
+        balance = conn.execute("""
+            UPDATE accounts
+            SET balance = balance - :amount
+            WHERE id = :acc
+            RETURNING balance
+        """, params).fetchall()
+        if checkpoint not in _checkpointed:
+            _checkpoint_due(conn, [(params["acc"], params["date"], params["date"])])
+
+    _checkpointed.add(checkpoint)
+    return cur.lastrowid, from_pence(balance[0][0])
+
+
+def insert_expenses(expenses: Iterable[Expense], batch_size: int = 5000):
+    """
+    Bulk inserts expenses in a single transaction. Rows are consumed lazily
+    and written in batches, and each account's balance is updated once
+    with the net change at the end
+    :param expenses: iterable of expenses to insert
+    :param batch_size: number of rows written per executemany call
+    :return: number of expenses inserted
+    """
+    with write_transaction() as conn:
+        return _write_expenses(conn, expenses, batch_size)
+
+
+def _write_expenses(conn: sqlite3.Connection, expenses: Iterable[Expense], batch_size: int):
+    # batched insert and balance update for insert_expenses, the caller
+    # owns the transaction. Expenses whose import_key is already taken are
+    # skipped, so the balances are changed by the rows inserted, those after
+    # the newest id from before the insert (new rows take the next rowid)
+    expenses = iter(expenses)
+    newest = conn.execute("SELECT COALESCE(MAX(id), 0) FROM expenses").fetchone()[0]
+    count = 0
+    categories = set()
+
+    while True:
+        batch = list(islice(expenses, batch_size))
+        if len(batch) == 0:
+            break
+
+        cur = conn.executemany(INSERT_EXPENSE_SQL, [expense_params(e) for e in batch])
+        count += cur.rowcount
+        categories.update(e.category.name for e in batch)
+
+    if count == 0:
+        return 0
+
+    _roll_budget_totals(conn, categories)
+
+    conn.execute("""
+        UPDATE accounts
+        SET balance = balance - deltas.amount
+        FROM (
+            SELECT account_id, SUM(amount) AS amount FROM expenses WHERE id > :newest GROUP BY account_id
+        ) AS deltas
+        WHERE accounts.id = deltas.account_id
+    """, {"newest": newest})
+    _checkpoint_due(conn, conn.execute("""
+        SELECT account_id, MIN(datetime), MAX(datetime) FROM expenses WHERE id > :newest GROUP BY account_id
+    """, {"newest": newest}).fetchall())
+
+    return count
 
 
 def get_by_category(ecat: ExpenseCategory, tf: TimeFrame = None):
     if tf is None:
         tf = TimeFrame.FOREVER
 
-    oldest_t = oldest_time(tf)
+    oldest_t = OLDEST if tf is TimeFrame.FOREVER else to_epoch(oldest_time(tf))
 
-    with conn:
-        c.execute("""
+    with connection() as conn:
+        cur = conn.execute("""
             SELECT budgets.category, SUM(expenses.amount) AS amount, budget 
             FROM budgets 
             INNER JOIN expenses 
             ON expenses.category = budgets.category
             WHERE expenses.datetime > :oldest AND expenses.category=:ecat
             GROUP BY budgets.category
-        """, {"oldest": oldest_t.isoformat(), "ecat": ecat.name})
+        """, {"oldest": oldest_t, "ecat": ecat.name})
 
-    res = c.fetchone()
-    return None if res is None else ExpenseCategoryOverview(*res)
+    res = cur.fetchone()
+    return None if res is None else ExpenseCategoryOverview(res[0], from_pence(res[1]), from_pence(res[2]))
 
 
-def set_budget(ecat: ExpenseCategory, amount: float, tf: TimeFrame):
-    old = get_budget_by_category(ecat)
+def get_overview():
+    """
+    Totals the spending of every category within its own budget time frame
+    using a single query. Whole days are read from the daily_totals rollup
+    and only the partial day at the start of each window from expenses
+    :return: list of category overviews for categories with expenses
+    """
+    with connection() as conn:
+        cur = conn.execute(f"""
+            WITH {TIME_FRAMES_CTE},
+            windows AS (
+                SELECT budgets.category, budgets.budget, time_frames.days, {WINDOW_START} AS oldest
+                FROM budgets
+                CROSS JOIN time_frames ON time_frames.time_frame = budgets.time_frame
+            ),
+            bounds AS (
+                SELECT category, budget, oldest,
+                       CASE WHEN days < 0 THEN '' ELSE date(oldest, 'unixepoch', 'localtime') END AS oldest_day,
+                       CASE WHEN days < 0 THEN oldest ELSE CAST(strftime(
+                           '%s', date(oldest, 'unixepoch', 'localtime'), '+1 day', 'utc') AS INTEGER)
+                       END AS next_day
+                FROM windows
+            ),
+            totals AS (
+                SELECT bounds.category, bounds.budget, SUM(daily_totals.amount) AS amount,
+                       SUM(daily_totals.count) AS count
+                FROM bounds
+                INNER JOIN daily_totals
+                ON daily_totals.category = bounds.category AND daily_totals.day > bounds.oldest_day
+                GROUP BY bounds.category
+                UNION ALL
+                SELECT bounds.category, bounds.budget, SUM(expenses.amount), COUNT(*)
+                FROM bounds
+                INNER JOIN expenses
+                ON expenses.category = bounds.category
+                AND expenses.datetime > bounds.oldest AND expenses.datetime < bounds.next_day
+                GROUP BY bounds.category
+            )
+            SELECT category, SUM(amount), budget
+            FROM totals
+            GROUP BY category
+            HAVING SUM(count) > 0
+        """)
+
+    res = cur.fetchall()
+    overview = [ExpenseCategoryOverview(ExpenseCategory[r[0]], from_pence(r[1]), from_pence(r[2])) for r in res]
+    return sorted(overview, key=lambda o: o.category.value)
+
+
+def set_budget(ecat: ExpenseCategory, amount: float, tf: TimeFrame = None, calendar: bool = None,
+               alerts: tuple = None):
+    """
+    Sets a category's budget. The time frame, calendar flag and alerts that
+    aren't given keep their stored values (MONTH, rolling and
+    DEFAULT_ALERTS for a new budget)
+    :param ecat: the ExpenseCategory
+    :param amount: the new budget
+    :param tf: (optional) the TimeFrame the budget covers
+    :param calendar: (optional) True for the current calendar period, False for the last N days
+    :param alerts: (optional) fractions of the budget to warn at
+    :return: the previous budget amount, None if the category had none
+    """
+    old = get_budget_config().get(ecat.name)
+    if tf is None:
+        tf = TimeFrame.MONTH if old is None else TimeFrame[old.time_frame]
+    if calendar is None:
+        calendar = False if old is None else old.calendar
+    if alerts is None:
+        alerts = DEFAULT_ALERTS if old is None else old.alerts
     if old is not None:
-        if old[0] == amount:
-            return old[1]
+        if (old.amount == amount and old.time_frame == tf.name and old.calendar == calendar
+                and old.alerts == tuple(alerts)):
+            return old.amount
 
-    with conn:
-        c.execute("""
-            INSERT INTO budgets (category, budget, time_frame)
-            VALUES (:cat, :amount, :tf)
+    with connection() as conn:
+        conn.execute("""
+            INSERT INTO budgets (category, budget, time_frame, calendar, alerts)
+            VALUES (:cat, :amount, :tf, :calendar, :alerts)
             ON CONFLICT (category)
-            DO UPDATE SET budget=:amount
-        """, {"cat": ecat.name, "amount": amount, "tf": tf.name})
+            DO UPDATE SET budget=:amount, time_frame=:tf, calendar=:calendar, alerts=:alerts
+        """, {"cat": ecat.name, "amount": to_pence(amount), "tf": tf.name, "calendar": int(calendar),
+              "alerts": ",".join(f"{a:g}" for a in sorted(alerts))})
 
-    return None if old is None else old[1]
+    invalidate_budget_config()
+    return None if old is None else old.amount
 
 
 def get_budget():
-    with conn:
-        c.execute("""
+    with connection() as conn:
+        cur = conn.execute("""
             SELECT * 
             FROM budgets
         """)
 
-    res = c.fetchall()
-    return [Budget(*x) for x in res]
+    res = cur.fetchall()
+    return [Budget(x[0], from_pence(x[1]), x[2], bool(x[3]), parse_alerts(x[4])) for x in res]
+
+
+def parse_alerts(alerts: str):
+    # budgets.alerts is a comma separated list of fractions of the budget
+    return tuple(float(a) for a in alerts.split(",") if a)
+
+
+def get_budget_config():
+    """
+    Gets the budget configuration, loaded once per process and reloaded
+    after it is invalidated by a change to the budgets table
+    :return: dict of category name to budget
+    """
+    global _budget_cache
+    if _budget_cache is None:
+        _budget_cache = {b.category: b for b in get_budget()}
+
+    return _budget_cache
+
+
+def invalidate_budget_config():
+    """
+    Drops the cached budget configuration. Changing a budget's time frame
+    also drops its running total, so every category is rolled again on its
+    next write
+    :return: void
+    """
+    global _budget_cache
+    _budget_cache = None
+    _rolled_at.clear()
+
+
+# Each budget's spending within its window: the running total from
+# budget_totals less the expenses its window has moved past since the total
+# was last rolled forward, or the window summed from expenses when the
+# budget has no total yet
+BUDGET_STATUS_SQL = f"""
+    WITH {TIME_FRAMES_CTE},
+    windows AS (
+        SELECT budgets.category, budgets.budget, budgets.time_frame, budgets.calendar, budgets.alerts,
+               {WINDOW_START} AS oldest
+        FROM budgets
+        CROSS JOIN time_frames ON time_frames.time_frame = budgets.time_frame
+    )
+    SELECT windows.category, windows.oldest, CASE
+        WHEN budget_totals.window_start <= windows.oldest THEN budget_totals.spent - COALESCE((
+            SELECT SUM(amount) FROM expenses
+            WHERE expenses.category = windows.category
+            AND datetime > budget_totals.window_start AND datetime <= windows.oldest
+        ), 0)
+        ELSE COALESCE((
+            SELECT SUM(amount) FROM expenses
+            WHERE expenses.category = windows.category AND datetime > windows.oldest
+        ), 0)
+    END AS spent, windows.budget, windows.time_frame, windows.calendar, windows.alerts
+    FROM windows
+    LEFT JOIN budget_totals ON budget_totals.category = windows.category
+"""
+
+
+def get_budget_status(categories: list = None):
+    """
+    Gets how much of each budget has been spent within its time frame.
+    Reads the running totals kept in budget_totals, so the cost doesn't
+    grow with the number of expenses in the window
+    :param categories: (optional) only these ExpenseCategories
+    :return: list of budget statuses
+    """
+    params = {}
+    sql = BUDGET_STATUS_SQL
+    if categories:
+        sql += "WHERE windows.category IN " + in_list(params, "cat", [ecat.name for ecat in categories])
+
+    with connection() as conn:
+        cur = conn.execute(sql, params)
+
+    res = [BudgetStatus(ExpenseCategory[r[0]], from_pence(r[2]), from_pence(r[3]), TimeFrame[r[4]], bool(r[5]),
+                        parse_alerts(r[6]), None if r[1] == OLDEST else from_epoch(r[1])) for r in cur.fetchall()]
+    return sorted(res, key=lambda s: s.category.value)
+
+
+def _roll_budget_totals(conn: sqlite3.Connection, categories: Iterable[str]):
+    # moves the running totals of the categories being written up to their
+    # budget's current window, so reads only subtract what left the window
+    # since. Reads are right however stale a total is, so each category is
+    # rolled at most once per ROLL_INTERVAL to keep the write lock short.
+    # The caller owns the transaction
+    now = time.monotonic()
+    categories = [c for c in categories if now - _rolled_at.get(c, -ROLL_INTERVAL) >= ROLL_INTERVAL]
+    if not categories:
+        return
+    _rolled_at.update((c, now) for c in categories)
+
+    params = {}
+    conn.execute(f"""
+        INSERT INTO budget_totals (category, window_start, spent)
+        SELECT category, oldest, spent
+        FROM ({BUDGET_STATUS_SQL} WHERE windows.category IN {in_list(params, "cat", list(categories))})
+        WHERE true
+        ON CONFLICT (category) DO UPDATE SET window_start = excluded.window_start, spent = excluded.spent
+    """, params)
 
 
 def get_budget_by_category(ecat: ExpenseCategory):
-    with conn:
-        c.execute("SELECT * FROM budgets WHERE category=:cat", {"cat": ecat.name})
-    return c.fetchone()
+    with connection() as conn:
+        cur = conn.execute("SELECT * FROM budgets WHERE category=:cat", {"cat": ecat.name})
+    return cur.fetchone()
 
 
-def get_expenses(n: int, start_date: datetime = None):
+def in_list(params: dict, name: str, values: list):
     """
-    Collects expenses by a specific category
-    :param n: max number of records to fetch
-    :param start_date: oldest date of a record
-    :return: list of expense objects
+    Binds a list of values for an IN (...) condition
+    :param params: query parameters, the values are added as :name0, :name1, ...
+    :param name: parameter name prefix
+    :param values: the values
+    :return: the parenthesised list of parameters
     """
-    if start_date is None:
-        start_date = datetime.datetime(1, 1, 1)
+    params.update({f"{name}{i}": value for i, value in enumerate(values)})
+    return "({names})".format(names=", ".join(f":{name}{i}" for i in range(len(values))))
 
-    with conn:
-        c.execute("""
-            SELECT expenses.*, accounts.*
-            FROM expenses
-            INNER JOIN accounts ON expenses.account_id = accounts.id
-            WHERE datetime > :dt
-            ORDER BY datetime DESC
-            LIMIT :n
-        """, {"n": n, "dt": start_date.isoformat()})
 
-    res = c.fetchall()
-    return parse_expenses(res)
+def get_expenses(n: int, start_date: datetime = None, categories: list = None, account_ids: list = None):
+    """
+    Collects the most recent expenses within their category's time frame
+    :param n: max number of records to fetch
+    :param start_date: oldest date of a record
+    :param categories: (optional) only these ExpenseCategories
+    :param account_ids: (optional) only these accounts
+    :return: list of expense objects, newest first
+    """
+    return list(islice(iter_expenses(n, start_date=start_date, in_time_frame=True, categories=categories,
+                                     account_ids=account_ids), n))
 
 
 def get_expenses_by_category(n: int, ecat: ExpenseCategory, start_date: datetime = None):
     """
-    Collects expenses by a specific category
+    Collects the most recent expenses of a specific category within its time frame
     :param n: max number of records to fetch
     :param ecat: the category of records to select
     :param start_date: oldest date of a record
-    :return: list of expense objects
+    :return: list of expense objects, newest first
     """
-    if start_date is None:
-        start_date = datetime.datetime(1, 1, 1)
+    return get_expenses(n, start_date, [ecat])
+
+
+# Oldest datetime within the time frame of the category bound to :{param},
+# exclusive. A constant, so it can bound a range of an index on datetime
+CATEGORY_WINDOW_START = f"""(
+    SELECT {WINDOW_START}
+    FROM time_frames
+    LEFT JOIN budgets ON budgets.category = :{{param}}
+    WHERE time_frames.time_frame = COALESCE(budgets.time_frame, 'MONTH')
+)"""
 
-    with conn:
-        c.execute("""
-            SELECT expenses.*, accounts.*
+
+def newest_expenses_sql(arms: list, joins: str = ""):
+    """
+    Builds a query for the newest :n expenses matching any of several
+    conditions. Each arm reads the newest :n of its own index range, in
+    index order, and the arms are merged, so only n rows per arm are sorted
+    however many rows match. A single IN (...) can't do this once budgets
+    and time_frames are joined, SQLite then sorts every matching row
+    :param arms: WHERE conditions, one per arm
+    :param joins: (optional) joins needed by the conditions
+    :return: SQL, following WITH TIME_FRAMES_CTE
+    """
+    if len(arms) == 1:
+        return f"""
+            SELECT {EXPENSE_COLUMNS}
             FROM expenses
+            INNER JOIN accounts ON expenses.account_id = accounts.id {joins}
+            WHERE {arms[0]}
+            ORDER BY datetime DESC, expenses.id DESC
+            LIMIT :n"""
+
+    picked = " UNION ALL ".join(f"""
+                SELECT * FROM (
+                    SELECT expenses.id, datetime FROM expenses {joins}
+                    WHERE {arm}
+                    ORDER BY datetime DESC, expenses.id DESC
+                    LIMIT :n
+                )""" for arm in arms)
+    return f"""
+            SELECT {EXPENSE_COLUMNS}
+            FROM ({picked}) AS picked
+            INNER JOIN expenses ON expenses.id = picked.id
             INNER JOIN accounts ON expenses.account_id = accounts.id
-            WHERE category=:ecat AND datetime > :dt
-            LIMIT :n
-        """, {"n": n, "ecat": ecat.name, "dt": start_date.isoformat()})
+            ORDER BY picked.datetime DESC, picked.id DESC
+            LIMIT :n"""
+
+
+def iter_expenses(batch_size: int = 1000, after: tuple = None, ecat: ExpenseCategory = None,
+                  start_date: datetime = None, in_time_frame: bool = False, end_date: datetime = None,
+                  categories: list = None, account_ids: list = None):
+    """
+    Lazily yields expenses newest first. Pages are fetched with keyset
+    pagination on (datetime, id) so memory use doesn't grow with the ledger
+    :param batch_size: number of records fetched per page
+    :param after: (optional) (epoch, id) of the last expense already seen
+    :param ecat: (optional) only yield expenses of this category
+    :param start_date: oldest date of a record
+    :param in_time_frame: only yield expenses within their category's time frame
+    :param end_date: (optional) newest date of a record
+    :param categories: (optional) only yield expenses of these categories
+    :param account_ids: (optional) only yield expenses of these accounts
+    :return: generator of expense objects
+    """
+    params = {"n": batch_size, "dt": OLDEST if start_date is None else to_epoch(start_date),
+              "end": None if end_date is None else to_epoch(end_date)}
+    categories = ([] if categories is None else list(categories)) + ([] if ecat is None else [ecat])
+    joins = ""
+    conditions = "datetime > :dt"
+    if end_date is not None:
+        conditions += " AND datetime <= :end"
+
+    # one arm per category (or account), each over its own index
+    if categories:
+        params.update({f"cat{i}": c.name for i, c in enumerate(categories)})
+        arms = [f"expenses.category = :cat{i}" for i in range(len(categories))]
+        if in_time_frame:
+            arms = [f"{arm} AND datetime > {CATEGORY_WINDOW_START.format(param=f'cat{i}')}"
+                    for i, arm in enumerate(arms)]
+        if account_ids:
+            conditions += " AND expenses.account_id IN " + in_list(params, "acc", account_ids)
+    elif account_ids:
+        params.update({f"acc{i}": acc_id for i, acc_id in enumerate(account_ids)})
+        arms = [f"expenses.account_id = :acc{i}" for i in range(len(account_ids))]
+    else:
+        arms = ["1"]
+
+    if in_time_frame and not categories:
+        joins = """
+            LEFT JOIN budgets ON budgets.category = expenses.category
+            CROSS JOIN time_frames ON time_frames.time_frame = COALESCE(budgets.time_frame, 'MONTH')"""
+        conditions += f" AND datetime > {WINDOW_START}"
+    accounts = {}
+
+    while True:
+        keyset = "" if after is None else " AND (datetime, expenses.id) < (:after_dt, :after_id)"
+        if after is not None:
+            params.update(after_dt=after[0], after_id=after[1])
+
+        with connection() as conn:
+            cur = query_rows(conn, parse_expense_rows(accounts), f"""
+                WITH {TIME_FRAMES_CTE}
+                {newest_expenses_sql([f"{arm} AND {conditions}{keyset}" for arm in arms], joins)}
+            """, params)
+
+        res = cur.fetchall()
+        yield from res
 
-    res = c.fetchall()
-    return parse_expenses(res)
+        if len(res) < batch_size:
+            return
+        after = (to_epoch(res[-1].date), res[-1].id)
 
 
-def parse_expenses(expense_account_records):
+# Searches matching more expenses than this are ordered newest first rather
+# than by bm25 rank, as ranking has to score every match
+RANK_MAX_MATCHES = 10000
+
+
+def search_expenses(query: str, n: int = 20, categories: list = None, start: datetime = None,
+                    end: datetime = None, account_id: int = None):
     """
-    Takes the output of the joined expense-account table to objs
-    :param expense_account_records: List of expense-account records
+    Full text search of expense reasons, best matches first (or newest
+    first for very common terms). Supports the FTS5 query syntax: words,
+    "phrases", prefix* and AND/OR/NOT
+    :param query: the search
+    :param n: max number of records to fetch
+    :param categories: (optional) only these ExpenseCategories
+    :param start: (optional) oldest date of a record
+    :param end: (optional) newest date of a record
+    :param account_id: (optional) only this account
     :return: list of expense objects
     """
-    expenses = []
-    for r in expense_account_records:
-        acc = Account(*(r[-3:]))
-        expenses.append(Expense(
-            id=r[0], reason=r[1], category=ExpenseCategory[r[2]], date=isoparse(r[3]),
-            amount=r[4], account=acc
-        ))
+    params = {"query": query, "n": n, "acc_id": account_id,
+              "start": OLDEST if start is None else to_epoch(start),
+              "end": 2**63 - 1 if end is None else to_epoch(end)}
+    conditions = "expenses_fts MATCH :query AND datetime BETWEEN :start AND :end"
+    if categories:
+        conditions += " AND category IN " + in_list(params, "cat", [ecat.name for ecat in categories])
+    if account_id is not None:
+        conditions += " AND account_id = :acc_id"
 
-    return expenses
+    with connection() as conn:
+        matches = conn.execute("SELECT COUNT(*) FROM expenses_fts WHERE expenses_fts MATCH :query",
+                               params).fetchone()[0]
+        order = "expenses_fts.rank, datetime DESC" if matches <= RANK_MAX_MATCHES else "expenses_fts.rowid DESC"
+        cur = query_rows(conn, parse_expense_rows(), f"""
+            SELECT {EXPENSE_COLUMNS}
+            FROM expenses_fts
+            INNER JOIN expenses ON expenses.id = expenses_fts.rowid
+            INNER JOIN accounts ON accounts.id = expenses.account_id
+            WHERE {conditions}
+            ORDER BY {order}
+            LIMIT :n
+        """, params)
 
+    return cur.fetchall()
 
-def get_timeframe(ecat: ExpenseCategory):
-    with conn:
-        c.execute("""
-            SELECT time_frame
-            FROM budgets
-            WHERE category=:ecat
-        """, {"ecat": ecat.name})
 
-    res = c.fetchone()
+# Columns of an expense and its account, as read by parse_expense_rows
+EXPENSE_COLUMNS = """expenses.id, expenses.reason, expenses.category, expenses.datetime, expenses.amount,
+                     accounts.id, accounts.account_name, accounts.balance"""
+
+
+def query_rows(conn: sqlite3.Connection, row_factory, sql: str, params=()):
+    """
+    Runs a query on a cursor whose rows are built by a row factory
+    :param conn: the connection
+    :param row_factory: sqlite3 row factory, called with (cursor, row)
+    :param sql: the query
+    :param params: its parameters
+    :return: the cursor
+    """
+    cur = conn.cursor()
+    cur.row_factory = row_factory
+    return cur.execute(sql, params)
+
+
+def parse_expense_rows(accounts: dict = None):
+    """
+    Makes a row factory turning EXPENSE_COLUMNS rows into expense objects.
+    Accounts go through an identity map, so the expenses of one account
+    share a single account object
+    :param accounts: (optional) account id to account, to share between queries
+    :return: row factory
+    """
+    accounts = {} if accounts is None else accounts
+    categories = ExpenseCategory.__members__
+
+    def parse_row(cursor, row):
+        expense_id, reason, category, dt, amount, account_id, account_name, balance = row
+        acc = accounts.get(account_id)
+        if acc is None:
+            acc = accounts[account_id] = Account(account_id, account_name, from_pence(balance))
+        return Expense(expense_id, reason, categories[category], from_epoch(dt), from_pence(amount), acc)
+
+    return parse_row
+
+
+def get_timeframe(ecat: ExpenseCategory):
+    res = get_budget_config().get(ecat.name)
     if res is None:
         return TimeFrame.MONTH
 
-    return TimeFrame[res[0]]
+    return TimeFrame[res.time_frame]
+
+
+# DAILY TOTALS
+
+# daily_totals rows recomputed from the expenses table
+DAILY_TOTALS_SQL = """
+    SELECT date(datetime, 'unixepoch', 'localtime') AS day, category, account_id, SUM(amount) AS amount,
+           COUNT(*) AS count, SUM(MAX(-amount, 0)) AS money_in, SUM(MAX(amount, 0)) AS money_out
+    FROM expenses
+    GROUP BY 1, 2, 3
+"""
+
+
+def verify_daily_totals():
+    """
+    Compares the daily_totals rollup with totals computed from expenses
+    :return: number of rollup rows that are missing, extra or wrong
+    """
+    columns = "day, category, account_id, amount, count, money_in, money_out"
+    with connection() as conn:
+        cur = conn.execute(f"""
+            WITH raw AS ({DAILY_TOTALS_SQL})
+            SELECT (SELECT COUNT(*) FROM (SELECT {columns} FROM raw EXCEPT SELECT {columns} FROM daily_totals))
+                 + (SELECT COUNT(*) FROM (SELECT {columns} FROM daily_totals EXCEPT SELECT {columns} FROM raw))
+        """)
+
+    return cur.fetchone()[0]
+
+
+def rebuild_daily_totals():
+    """
+    Regenerates the daily_totals rollup from scratch, and the running
+    budget totals along with it
+    :return: number of rollup rows
+    """
+    with connection() as conn:
+        conn.execute("DELETE FROM daily_totals")
+        conn.execute("DELETE FROM budget_totals")  # refilled from expenses on the next write
+        _rolled_at.clear()
+        cur = conn.execute(f"INSERT INTO daily_totals (day, category, account_id, amount, count, money_in, money_out) "
+                           f"{DAILY_TOTALS_SQL}")
+
+    return cur.rowcount
+
+
+def get_account_totals(tf: TimeFrame = None):
+    """
+    Totals the money in and out of each account using the daily rollup
+    :param tf: (optional) only count whole days within this time frame
+    :return: dict of account id to (money in, money out)
+    """
+    oldest_day = "" if tf is None or tf is TimeFrame.FOREVER else oldest_time(tf).date().isoformat()
+    with connection() as conn:
+        cur = conn.execute("""
+            SELECT account_id, SUM(money_in), SUM(money_out)
+            FROM daily_totals
+            WHERE day > :oldest_day
+            GROUP BY account_id
+        """, {"oldest_day": oldest_day})
+
+    return {r[0]: (from_pence(r[1]), from_pence(r[2])) for r in cur.fetchall()}
+
+
+# DATE RANGES
+
+def get_range_overview(start: datetime.date, end: datetime.date):
+    """
+    Totals the spending of every category between two days from the daily
+    rollup. Budgets are prorated to the length of the range
+    :param start: first day included
+    :param end: last day included
+    :return: list of category overviews for categories with expenses
+    """
+    with connection() as conn:
+        cur = conn.execute(f"""
+            WITH {TIME_FRAMES_CTE},
+            totals AS (
+                SELECT category, SUM(amount) AS amount
+                FROM daily_totals
+                WHERE day BETWEEN :start AND :end
+                GROUP BY category
+            )
+            SELECT totals.category, totals.amount, CASE
+                WHEN budgets.budget IS NULL THEN 0
+                WHEN time_frames.days < 0 THEN budgets.budget
+                ELSE budgets.budget * (julianday(:end) - julianday(:start) + 1)
+                     / IIF(budgets.calendar, time_frames.calendar_days, time_frames.days)
+            END
+            FROM totals
+            LEFT JOIN budgets ON budgets.category = totals.category
+            LEFT JOIN time_frames ON time_frames.time_frame = budgets.time_frame
+        """, {"start": start.isoformat(), "end": end.isoformat()})
+
+    res = cur.fetchall()
+    overview = [ExpenseCategoryOverview(ExpenseCategory[r[0]], from_pence(r[1]), from_pence(round(r[2])))
+                for r in res]
+    return sorted(overview, key=lambda o: o.category.value)
+
+
+def get_period_totals(period: TimeFrame, start: datetime.date, end: datetime.date):
+    """
+    Totals the spending of every category in each calendar period (day,
+    week, month or year) between two days with a single grouped query over
+    the daily rollup. A budget applies whole to periods matching its time
+    frame and is prorated by length to any other period
+    :param period: DAY, WEEK, MONTH or YEAR
+    :param start: first day included
+    :param end: last day included
+    :return: list of period totals ordered by period then category
+    """
+    with connection() as conn:
+        cur = conn.execute(f"""
+            WITH {TIME_FRAMES_CTE},
+            totals AS (
+                SELECT date(day{PERIOD_START[period]}) AS period, category, SUM(amount) AS amount
+                FROM daily_totals
+                WHERE day BETWEEN :start AND :end
+                GROUP BY 1, 2
+            )
+            SELECT totals.period, totals.category, totals.amount, CASE
+                WHEN budgets.budget IS NULL THEN 0
+                WHEN time_frames.days < 0 OR budgets.time_frame = :period THEN budgets.budget
+                ELSE budgets.budget * (julianday(totals.period, {PERIOD_NEXT[period]}) - julianday(totals.period))
+                     / IIF(budgets.calendar, time_frames.calendar_days, time_frames.days)
+            END
+            FROM totals
+            LEFT JOIN budgets ON budgets.category = totals.category
+            LEFT JOIN time_frames ON time_frames.time_frame = budgets.time_frame
+            ORDER BY totals.period, totals.category
+        """, {"start": start.isoformat(), "end": end.isoformat(), "period": period.name})
+
+    return [PeriodTotal(datetime.date.fromisoformat(r[0]), ExpenseCategory[r[1]], from_pence(r[2]),
+                        from_pence(round(r[3]))) for r in cur.fetchall()]
+
+
+# Windows holding more than this share of the expenses are read with a table
+# scan, which beats walking the datetime index row by row
+INDEX_MAX_SHARE = 0.05
+
+
+def window_column(conn: sqlite3.Connection, start: datetime = None, end: datetime = None):
+    """
+    Picks how to filter a window of expenses on datetime: with the index for
+    small windows, or +datetime (index disabled) for large ones, sized from
+    the daily totals
+    :param conn: the connection
+    :param start: (optional) oldest time in the window
+    :param end: (optional) newest time in the window
+    :return: datetime or +datetime
+    """
+    days = {"start": "" if start is None else start.date().isoformat(),
+            "end": "9999-12-31" if end is None else end.date().isoformat()}
+    total, in_window = conn.execute("""
+        SELECT COALESCE(SUM(count), 0), COALESCE(SUM(count) FILTER (WHERE day BETWEEN :start AND :end), 0)
+        FROM daily_totals
+    """, days).fetchone()
+
+    return "datetime" if in_window <= total * INDEX_MAX_SHARE else "+datetime"
+
+
+# EXPORT
+
+EXPORT_COLUMNS = {
+    "expenses": ["id", "datetime", "category", "amount", "reason", "account_id", "account_name"],
+    "budgets": ["category", "budget", "time_frame", "calendar", "alerts"],
+    "recurring_payments": ["id", "time_frame", "last_paid", "expense_id", "category", "amount", "reason",
+                           "account_id", "account_name"],
+}
+
+
+def iter_export(table: str, start: datetime = None, end: datetime = None, categories: list = None,
+                account_id: int = None, iso_dates: bool = True, batch_size: int = 10000):
+    """
+    Streams the rows of a table for export in batches from a single cursor,
+    so memory use doesn't grow with the ledger. Filters are applied in SQL
+    :param table: expenses, budgets or recurring_payments
+    :param start: (optional) oldest expense (or last payment) included
+    :param end: (optional) newest expense (or last payment) included
+    :param categories: (optional) only these ExpenseCategories
+    :param account_id: (optional) only this account, not for budgets
+    :param iso_dates: datetimes as local "YYYY-MM-DD HH:MM:SS" text, epoch seconds otherwise
+    :param batch_size: number of rows fetched at a time
+    :return: generator of lists of rows, columns as in EXPORT_COLUMNS
+    """
+    if table not in EXPORT_COLUMNS:
+        raise ValueError(f"Can't export {table}")
+    if account_id is not None and "account_id" not in EXPORT_COLUMNS[table]:
+        raise ValueError(f"{table} don't belong to an account")
+
+    params = {"start": OLDEST if start is None else to_epoch(start),
+              "end": 2**63 - 1 if end is None else to_epoch(end),
+              "acc_id": account_id}
+    conditions = []
+    if categories:
+        conditions.append("category IN " + in_list(params, "cat", [ecat.name for ecat in categories]))
+    if account_id is not None:
+        conditions.append("account_id = :acc_id")
+
+    def date(column):
+        return f"datetime({column}, 'unixepoch', 'localtime')" if iso_dates else column
+
+    with connection() as conn:
+        if table == "expenses":
+            conditions.append(f"{window_column(conn, start, end)} BETWEEN :start AND :end")
+            sql = f"""
+                SELECT expenses.id, {date("datetime")}, category, amount / 100.0, reason, account_id, account_name
+                FROM expenses
+                INNER JOIN accounts ON accounts.id = expenses.account_id
+            """
+        elif table == "budgets":
+            sql = "SELECT category, budget / 100.0, time_frame, calendar, alerts FROM budgets"
+        elif table == "recurring_payments":
+            conditions.append("last_paid BETWEEN :start AND :end")
+            sql = f"""
+                SELECT recurring_payments.id, time_frame, {date("last_paid")}, expense_id, category,
+                       amount / 100.0, reason, account_id, account_name
+                FROM recurring_payments
+                INNER JOIN expenses ON expenses.id = recurring_payments.expense_id
+                INNER JOIN accounts ON accounts.id = expenses.account_id
+            """
+
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        cur = conn.execute(sql, params)
+
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if len(rows) == 0:
+            return
+        yield rows
 
 
 # CLEAR
@@ -165,8 +879,9 @@ def clear_all():
     Clears all data within all tables
     :return: void
     """
-    with conn:
-        c.execute("DROP TABLE IF EXISTS expenses")
+    with connection() as conn:
+        conn.execute("DELETE FROM recurring_payments")
+        conn.execute("DELETE FROM expenses")
 
 
 def clear_by_category(ecat: ExpenseCategory):
@@ -175,68 +890,282 @@ def clear_by_category(ecat: ExpenseCategory):
     :param ecat: the category to remove
     :return: void
     """
-    with conn:
-        c.execute("""
+    with connection() as conn:
+        conn.execute("""
+            DELETE FROM recurring_payments
+            WHERE expense_id IN (SELECT id FROM expenses WHERE category = :ecat)
+        """, {"ecat": ecat.name})
+        conn.execute("""
             DELETE FROM expenses
             WHERE category = :ecat
         """, {"ecat": ecat.name})
-        c.execute("""
+        conn.execute("""
             DELETE FROM budgets
             WHERE category = :ecat
         """, {"ecat": ecat.name})
 
+    invalidate_budget_config()
+
+
+def reset_default_budgets():
+    """
+    Gives every category without a budget the default £0 monthly budget
+    :return: void
+    """
+    with connection() as conn:
+        load_default_budget_data(conn)
+
+    invalidate_budget_config()
+
 
 # ACCOUNTS
 
 
+# Columns read by parse_account
+ACCOUNT_COLUMNS = "accounts.id, accounts.account_name, accounts.balance"
+
+
+def parse_account(cursor, row):
+    """
+    Row factory converting ACCOUNT_COLUMNS rows to account objects
+    :param cursor: the cursor
+    :param row: (id, account_name, balance) record
+    :return: account object
+    """
+    account_id, account_name, balance = row
+    return Account(account_id, account_name, from_pence(balance))
+
+
 def get_accounts():
-    with conn:
-        c.execute("SELECT * FROM accounts")
+    with connection() as conn:
+        cur = query_rows(conn, parse_account, f"SELECT {ACCOUNT_COLUMNS} FROM accounts")
 
-    res = c.fetchall()
-    return [Account(*x) for x in res]
+    return cur.fetchall()
 
 
 def get_account_by_id(acc_id: int):
-    with conn:
-        c.execute("SELECT * FROM accounts WHERE id=:acc_id", {"acc_id": acc_id})
+    with connection() as conn:
+        cur = query_rows(conn, parse_account, f"SELECT {ACCOUNT_COLUMNS} FROM accounts WHERE id=:acc_id",
+                    {"acc_id": acc_id})
 
-    res = c.fetchone()
-    return None if res is None else Account(*res)
+    return cur.fetchone()
 
 
 def get_account_by_name(name: str):
-    with conn:
-        c.execute("""
-            SELECT *
+    with connection() as conn:
+        cur = query_rows(conn, parse_account, f"""
+            SELECT {ACCOUNT_COLUMNS}
             FROM accounts
             WHERE account_name=:name
         """, {"name": name})
 
-    res = c.fetchone()
-    return None if res is None else Account(*res)
+    return cur.fetchone()
 
 
 def add_account(name: str, balance: float):
-    account_id = hash((name, balance, datetime.datetime.now()))
-    with conn:
-        c.execute("""
-            INSERT INTO accounts (id, account_name, balance)
-            VALUES (:id, :name, :balance)
-        """, {"id": account_id, "name": name, "balance": balance})
+    with connection() as conn:
+        account_id = conn.execute("""
+            INSERT INTO accounts (account_name, balance)
+            VALUES (:name, :balance)
+        """, {"name": name, "balance": to_pence(balance)}).lastrowid
+        # opening balance, the starting point when replaying the account
+        conn.execute("""
+            INSERT INTO balance_checkpoints (account_id, datetime, balance)
+            VALUES (:id, :now, :balance)
+        """, {"id": account_id, "now": to_epoch(datetime.datetime.now()), "balance": to_pence(balance)})
+    return account_id
 
 
 def change_balance(account: Account, add_to: float):
     new_balance = account.balance + add_to
-    with conn:
-        c.execute("""
+    with connection() as conn:
+        conn.execute("""
             UPDATE accounts
             SET balance = :balance
             WHERE id = :acc_id
-        """, {"balance": new_balance, "acc_id": account.id})
+        """, {"balance": to_pence(new_balance), "acc_id": account.id})
     return new_balance
 
 
+# BALANCE HISTORY
+
+# Ledger time between the automatic balance checkpoints of an account.
+# Checkpoints are taken one second before each multiple of the interval
+CHECKPOINT_INTERVAL = TimeFrame.MONTH.value * 86400
+
+
+def _checkpoint_due(conn: sqlite3.Connection, spans: Iterable[tuple]):
+    # checkpoints each account's balance on the CHECKPOINT_INTERVAL grid of
+    # ledger time covering the expenses just written, from the interval of
+    # the oldest to the newest, so a historical balance replays at most one
+    # interval. The trigger on expenses keeps existing checkpoints up to
+    # date. spans are (account_id, oldest, newest), the caller owns the
+    # transaction
+    for acc_id, oldest, newest in spans:
+        first = oldest - oldest % CHECKPOINT_INTERVAL - 1
+        taken = {at for at, in conn.execute("""
+            SELECT datetime
+            FROM balance_checkpoints
+            WHERE account_id = ? AND datetime BETWEEN ? AND ?
+        """, (acc_id, first, newest))}
+        due = [at for at in range(first, newest, CHECKPOINT_INTERVAL) if at not in taken]
+        balance = _balance_at(conn, acc_id, due[0]) if due else None
+        if balance is None:
+            continue
+
+        # expenses by the interval they fall in after the first checkpoint due
+        changes = dict(conn.execute("""
+            SELECT (datetime - :first - 1) / :interval, SUM(amount)
+            FROM expenses
+            WHERE account_id = :acc_id AND datetime > :first AND datetime <= :last
+            GROUP BY 1
+        """, {"acc_id": acc_id, "first": due[0], "last": due[-1], "interval": CHECKPOINT_INTERVAL}))
+
+        checkpoints = []
+        for i, at in enumerate(range(due[0], due[-1] + 1, CHECKPOINT_INTERVAL)):
+            balance -= changes.get(i - 1, 0)
+            if at not in taken:
+                checkpoints.append((acc_id, at, balance))
+        conn.executemany("INSERT OR IGNORE INTO balance_checkpoints (account_id, datetime, balance) VALUES (?, ?, ?)",
+                         checkpoints)
+
+
+def _balance_at(conn: sqlite3.Connection, account_id: int, at: int):
+    # balance in pence after every expense up to and including at, see
+    # get_balance_at
+    params = {"acc_id": account_id, "at": at}
+    before = conn.execute("""
+        SELECT datetime, balance
+        FROM balance_checkpoints
+        WHERE account_id = :acc_id AND datetime <= :at
+        ORDER BY datetime DESC
+        LIMIT 1
+    """, params).fetchone()
+
+    if before is not None:
+        cur = conn.execute("""
+            SELECT :balance - COALESCE(SUM(amount), 0)
+            FROM expenses
+            WHERE account_id = :acc_id AND datetime > :cp AND datetime <= :at
+        """, {**params, "cp": before[0], "balance": before[1]})
+    else:
+        # earlier than every checkpoint so replay backwards from the first,
+        # or from the current balance if the account has none
+        after = conn.execute("""
+            SELECT datetime, balance
+            FROM balance_checkpoints
+            WHERE account_id = :acc_id
+            ORDER BY datetime
+            LIMIT 1
+        """, params).fetchone()
+        if after is None:
+            after = conn.execute("SELECT :newest, balance FROM accounts WHERE id = :acc_id",
+                                 {**params, "newest": 2**63 - 1}).fetchone()
+        if after is None:
+            return None
+
+        cur = conn.execute("""
+            SELECT :balance + COALESCE(SUM(amount), 0)
+            FROM expenses
+            WHERE account_id = :acc_id AND datetime > :at AND datetime <= :cp
+        """, {**params, "cp": after[0], "balance": after[1]})
+
+    return cur.fetchone()[0]
+
+
+def get_balance_at(account_id: int, at: datetime.datetime):
+    """
+    Works out an account's balance at a point in time. Starts from the
+    nearest checkpoint and replays only the expenses between the two
+    :param account_id: the account
+    :param at: the point in time
+    :return: the balance after every expense up to and including at
+    """
+    with connection() as conn:
+        balance = _balance_at(conn, account_id, to_epoch(at))
+
+    return None if balance is None else from_pence(balance)
+
+
+def get_balance_history(account_id: int, start: datetime.date, end: datetime.date = None):
+    """
+    Gets an account's balance at the end of each day in a range, from one
+    historical balance and the daily totals after it
+    :param account_id: the account
+    :param start: first day
+    :param end: (optional) last day, defaults to today
+    :return: list of (day, balance)
+    """
+    end = datetime.date.today() if end is None else end
+    day_before = datetime.datetime.combine(start, datetime.time()) - datetime.timedelta(seconds=1)
+    balance = to_pence(get_balance_at(account_id, day_before) or 0)
+
+    with connection() as conn:
+        cur = conn.execute("""
+            SELECT day, SUM(amount)
+            FROM daily_totals
+            WHERE account_id = :acc_id AND day BETWEEN :start AND :end
+            GROUP BY day
+        """, {"acc_id": account_id, "start": start.isoformat(), "end": end.isoformat()})
+    changes = dict(cur.fetchall())
+
+    history = []
+    for i in range((end - start).days + 1):
+        day = start + datetime.timedelta(days=i)
+        balance -= changes.get(day.isoformat(), 0)
+        history.append((day, from_pence(balance)))
+
+    return history
+
+
+def reconcile_balances(fix: bool = False):
+    """
+    Recomputes each account's balance from its opening balance and every
+    expense since, and compares it to the stored balance
+    :param fix: replace drifted balances with the ledger balance
+    :return: list of reconciliations, one per account
+    """
+    def parse_row(cursor, row):
+        account_id, account_name, balance, ledger_balance = row
+        return Reconciliation(Account(account_id, account_name, from_pence(balance)), from_pence(ledger_balance))
+
+    with connection() as conn:
+        cur = query_rows(conn, parse_row, f"""
+            WITH opening AS (
+                SELECT account_id, MIN(datetime) AS datetime
+                FROM balance_checkpoints
+                GROUP BY account_id
+            )
+            SELECT {ACCOUNT_COLUMNS}, COALESCE(checkpoint.balance, 0) - COALESCE((
+                SELECT SUM(amount) FROM expenses
+                WHERE expenses.account_id = accounts.id AND expenses.datetime > COALESCE(opening.datetime, :oldest)
+            ), 0)
+            FROM accounts
+            LEFT JOIN opening ON opening.account_id = accounts.id
+            LEFT JOIN balance_checkpoints AS checkpoint
+            ON checkpoint.account_id = opening.account_id AND checkpoint.datetime = opening.datetime
+        """, {"oldest": OLDEST})
+        res = cur.fetchall()
+
+        if fix:
+            drifted = [{"acc_id": r.account.id, "balance": to_pence(r.ledger_balance)} for r in res if r.drift != 0]
+            conn.executemany("UPDATE accounts SET balance = :balance WHERE id = :acc_id", drifted)
+            # later checkpoints were taken from the drifted balance, take them
+            # again from the ledger
+            conn.executemany("""
+                DELETE FROM balance_checkpoints
+                WHERE account_id = :acc_id
+                AND datetime > (SELECT MIN(datetime) FROM balance_checkpoints WHERE account_id = :acc_id)
+            """, drifted)
+            spans = [conn.execute("""
+                SELECT account_id, MIN(datetime), MAX(datetime) FROM expenses WHERE account_id = :acc_id
+                GROUP BY account_id
+            """, d).fetchone() for d in drifted]
+            _checkpoint_due(conn, [span for span in spans if span is not None])
+
+    return res
+
+
 # Recurring Payments
 
 def setup_recurring_payment(expense: Expense, time_frame: TimeFrame):
@@ -244,15 +1173,24 @@ def setup_recurring_payment(expense: Expense, time_frame: TimeFrame):
     Adds a new recurring payment
     :param expense: the payment
     :param time_frame: how often to make the payment
-    :return: void
+    :return: id of the recurring payment
     """
-    expense_id = hash((expense, time_frame, datetime.datetime.now()))
-    with conn:
-        c.execute("""
-            INSERT INTO recurring_payments (id, expense_id, time_frame, last_paid)
-            VALUES (:id, :eid, :tf, :last_paid)
-        """, {"id": expense_id, "eid": expense.id, "tf": time_frame.name,
-              "last_paid": datetime.datetime.now().isoformat()})
+    with connection() as conn:
+        cur = conn.execute("""
+            INSERT INTO recurring_payments (expense_id, time_frame, last_paid)
+            VALUES (:eid, :tf, :last_paid)
+        """, {"eid": expense.id, "tf": time_frame.name, "last_paid": to_epoch(datetime.datetime.now())})
+    return cur.lastrowid
+
+
+# recurring payments joined with the expense they repeat and its account
+RECURRING_PAYMENTS_SQL = f"""
+    SELECT {EXPENSE_COLUMNS}, recurring_payments.id, recurring_payments.time_frame,
+           recurring_payments.last_paid
+    FROM recurring_payments
+    INNER JOIN expenses on expenses.id = recurring_payments.expense_id
+    INNER JOIN accounts on accounts.id = expenses.account_id
+"""
 
 
 def get_recurring_payments():
@@ -260,23 +1198,60 @@ def get_recurring_payments():
     Gets a list of all recurring payments
     :return: recurring payment list
     """
-    with conn:
-        c.execute("""
-            SELECT expenses.*, accounts.*, recurring_payments.id, recurring_payments.time_frame,
-                   recurring_payments.last_paid
-            FROM recurring_payments
-            INNER JOIN expenses on expenses.id = recurring_payments.expense_id
-            INNER JOIN accounts on accounts.id = expenses.account_id
-        """)
-    res = c.fetchall()
-    recurring_payments = []
-
-    for r in res:
-        acc = Account(id=r[6], account_name=r[7], balance=r[8])
-        exp = Expense(
-            id=r[0], reason=r[1], category=ExpenseCategory[r[2]], date=isoparse(r[3]),
-            amount=r[4], account=acc
-        )
-        recurring_payments.append(RecurringExpense(r[-3], exp, TimeFrame[r[-2]], isoparse(r[-1])))
-
-    return recurring_payments
+    with connection() as conn:
+        cur = query_rows(conn, parse_recurring_payments(), RECURRING_PAYMENTS_SQL)
+    return cur.fetchall()
+
+
+def parse_recurring_payments():
+    """
+    Makes a row factory turning RECURRING_PAYMENTS_SQL rows into recurring
+    expense objects, sharing account objects like parse_expense_rows
+    :return: row factory
+    """
+    parse_expense = parse_expense_rows()
+
+    def parse_row(cursor, row):
+        *expense, recurring_id, time_frame, last_paid = row
+        return RecurringExpense(recurring_id, parse_expense(cursor, expense), TimeFrame[time_frame],
+                                from_epoch(last_paid))
+
+    return parse_row
+
+
+def run_recurring_payments(now: datetime = None, batch_size: int = 5000):
+    """
+    Catches up every recurring payment by inserting each occurrence due
+    since it was last paid. All occurrences are written in one batched
+    insert, each account's balance changes once and last_paid is advanced
+    in the same write transaction as the schedules are read
+    :param now: (optional) time to catch up to, defaults to now
+    :param batch_size: number of rows written per executemany call
+    :return: list of (recurring payment, number of payments made)
+    """
+    now = to_epoch(datetime.datetime.now() if now is None else now)
+
+    with write_transaction() as conn:
+        due = []
+        for re in query_rows(conn, parse_recurring_payments(), RECURRING_PAYMENTS_SQL).fetchall():
+            if re.recur_every is TimeFrame.FOREVER:
+                continue
+
+            step = re.recur_every.value * 86400
+            last_paid = to_epoch(re.last_paid)
+            payments = (now - last_paid) // step
+            if payments > 0:
+                due.append((re, last_paid, step, payments))
+
+        def occurrences():
+            for re, last_paid, step, payments in due:
+                for i in range(1, payments + 1):
+                    at = last_paid + i * step
+                    yield Expense(-1, re.expense.reason, re.expense.category, from_epoch(at), re.expense.amount,
+                                  re.expense.account, f"recurring:{re.id}:{at}")
+
+        _write_expenses(conn, occurrences(), batch_size)
+        conn.executemany("UPDATE recurring_payments SET last_paid = ? WHERE id = ?",
+                         [(last_paid + payments * step, re.id) for re, last_paid, step, payments in due])
+
+    return [(re, payments) for re, _, _, payments in due]
@@ -0,0 +1,396 @@
+from moneytracker.db.create import *
+
+# Schema migrations. Each step upgrades the schema by one version and is
+# applied in order; the current version is tracked in PRAGMA user_version.
+# Steps must never be edited once released, add a new step instead.
+
+
+def _create_tables(conn: sqlite3.Connection):
+    create_accounts(conn)
+    create_expenses(conn)
+    create_budgets(conn)
+    load_default_budget_data(conn)
+    create_recurring_payments(conn)
+
+
+def _index_expenses(conn: sqlite3.Connection):
+    # listing by date, filtering by category and per-account history
+    conn.execute("CREATE INDEX IF NOT EXISTS expenses_datetime ON expenses (datetime)")
+    conn.execute("CREATE INDEX IF NOT EXISTS expenses_category_datetime ON expenses (category, datetime)")
+    conn.execute("CREATE INDEX IF NOT EXISTS expenses_account_datetime ON expenses (account_id, datetime)")
+
+
+def _integer_storage(conn: sqlite3.Connection):
+    # datetimes become epoch seconds and amounts become integer pence.
+    # SQLite can't change a column's type so each table is rebuilt
+    def epoch(col):
+        # naive isoformat strings are local time, offset-aware ones are not
+        return f"""CAST(CASE
+            WHEN {col} GLOB '*[+-][0-9][0-9]:[0-9][0-9]' OR {col} GLOB '*Z' THEN strftime('%s', {col})
+            ELSE strftime('%s', {col}, 'utc')
+        END AS INTEGER)"""
+
+    def pence(col):
+        return f"CAST(ROUND({col} * 100) AS INTEGER)"
+
+    conn.execute("""
+        CREATE TABLE accounts_new (
+            id INTEGER PRIMARY KEY NOT NULL,
+            account_name TEXT NOT NULL UNIQUE,
+            balance INTEGER NOT NULL
+        )
+    """)
+    conn.execute(f"INSERT INTO accounts_new SELECT id, account_name, {pence('balance')} FROM accounts")
+
+    conn.execute("""
+        CREATE TABLE expenses_new (
+            id INTEGER PRIMARY KEY NOT NULL,
+            reason TEXT,
+            category TEXT,
+            datetime INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            account_id INTEGER NOT NULL,
+            FOREIGN KEY(account_id) REFERENCES accounts(id)
+        )
+    """)
+    conn.execute(f"""
+        INSERT INTO expenses_new
+        SELECT id, reason, category, {epoch('datetime')}, {pence('amount')}, account_id FROM expenses
+    """)
+
+    conn.execute("""
+        CREATE TABLE budgets_new (
+            category TEXT PRIMARY KEY NOT NULL,
+            budget INTEGER NOT NULL,
+            time_frame TEXT NOT NULL
+        )
+    """)
+    conn.execute(f"INSERT INTO budgets_new SELECT category, {pence('budget')}, time_frame FROM budgets")
+
+    conn.execute("""
+        CREATE TABLE recurring_payments_new (
+            id INTEGER PRIMARY KEY NOT NULL,
+            expense_id INTEGER NOT NULL,
+            time_frame TEXT NOT NULL,
+            last_paid INTEGER NOT NULL,
+            FOREIGN KEY (expense_id) REFERENCES expenses(id)
+        )
+    """)
+    conn.execute(f"""
+        INSERT INTO recurring_payments_new
+        SELECT id, expense_id, time_frame, {epoch('last_paid')} FROM recurring_payments
+    """)
+
+    for table in ["recurring_payments", "expenses", "budgets", "accounts"]:
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+    _index_expenses(conn)
+
+
+def _daily_totals(conn: sqlite3.Connection):
+    # per day, category and account rollup of expenses, kept up to date by
+    # triggers so it changes in the same transaction as the expenses do
+    conn.execute("""
+        CREATE TABLE daily_totals (
+            day TEXT NOT NULL,
+            category TEXT NOT NULL,
+            account_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            money_in INTEGER NOT NULL,
+            money_out INTEGER NOT NULL,
+            PRIMARY KEY (category, day, account_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TRIGGER expenses_daily_totals_insert AFTER INSERT ON expenses
+        BEGIN
+            INSERT INTO daily_totals (day, category, account_id, amount, count, money_in, money_out)
+            VALUES (date(NEW.datetime, 'unixepoch', 'localtime'), NEW.category, NEW.account_id, NEW.amount, 1,
+                    MAX(-NEW.amount, 0), MAX(NEW.amount, 0))
+            ON CONFLICT (category, day, account_id) DO UPDATE SET
+                amount = amount + excluded.amount, count = count + 1,
+                money_in = money_in + excluded.money_in, money_out = money_out + excluded.money_out;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER expenses_daily_totals_delete AFTER DELETE ON expenses
+        BEGIN
+            UPDATE daily_totals SET
+                amount = amount - OLD.amount, count = count - 1,
+                money_in = money_in - MAX(-OLD.amount, 0), money_out = money_out - MAX(OLD.amount, 0)
+            WHERE category = OLD.category AND day = date(OLD.datetime, 'unixepoch', 'localtime')
+            AND account_id = OLD.account_id;
+            DELETE FROM daily_totals
+            WHERE category = OLD.category AND day = date(OLD.datetime, 'unixepoch', 'localtime')
+            AND account_id = OLD.account_id AND count = 0;
+        END
+    """)
+    conn.execute("""
+        INSERT INTO daily_totals
+        SELECT date(datetime, 'unixepoch', 'localtime'), category, account_id, SUM(amount), COUNT(*),
+               SUM(MAX(-amount, 0)), SUM(MAX(amount, 0))
+        FROM expenses
+        GROUP BY 1, 2, 3
+    """)
+
+
+def _balance_checkpoints(conn: sqlite3.Connection):
+    # balance of each account after every expense up to a point in time.
+    # Existing accounts get an opening checkpoint from before their first
+    # expense and backdated expenses shift any later checkpoints
+    conn.execute("""
+        CREATE TABLE balance_checkpoints (
+            account_id INTEGER NOT NULL,
+            datetime INTEGER NOT NULL,
+            balance INTEGER NOT NULL,
+            PRIMARY KEY (account_id, datetime),
+            FOREIGN KEY (account_id) REFERENCES accounts(id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        INSERT INTO balance_checkpoints (account_id, datetime, balance)
+        SELECT accounts.id,
+               COALESCE(MIN(expenses.datetime), CAST(strftime('%s', 'now') AS INTEGER)) - 1,
+               accounts.balance + COALESCE(SUM(expenses.amount), 0)
+        FROM accounts
+        LEFT JOIN expenses ON expenses.account_id = accounts.id
+        GROUP BY accounts.id
+    """)
+    conn.execute("""
+        CREATE TRIGGER expenses_balance_checkpoints_insert AFTER INSERT ON expenses
+        BEGIN
+            UPDATE balance_checkpoints SET balance = balance - NEW.amount
+            WHERE account_id = NEW.account_id AND datetime >= NEW.datetime;
+        END
+    """)
+    conn.execute("CREATE INDEX daily_totals_account_day ON daily_totals (account_id, day)")
+
+
+def _expenses_fts(conn: sqlite3.Connection):
+    # full text index of expense reasons. It is an external content table
+    # so the reasons aren't stored twice, triggers keep it in step
+    conn.execute("""
+        CREATE VIRTUAL TABLE expenses_fts USING fts5(
+            reason, content='expenses', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER expenses_fts_insert AFTER INSERT ON expenses
+        BEGIN
+            INSERT INTO expenses_fts (rowid, reason) VALUES (NEW.id, NEW.reason);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER expenses_fts_delete AFTER DELETE ON expenses
+        BEGIN
+            INSERT INTO expenses_fts (expenses_fts, rowid, reason) VALUES ('delete', OLD.id, OLD.reason);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER expenses_fts_update AFTER UPDATE OF reason ON expenses
+        BEGIN
+            INSERT INTO expenses_fts (expenses_fts, rowid, reason) VALUES ('delete', OLD.id, OLD.reason);
+            INSERT INTO expenses_fts (rowid, reason) VALUES (NEW.id, NEW.reason);
+        END
+    """)
+    conn.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+
+
+def _calendar_budgets(conn: sqlite3.Connection):
+    # budgets can cover the current calendar day/week/month/year instead
+    # of the last N days, and date range reports read daily_totals by day
+    conn.execute("ALTER TABLE budgets ADD COLUMN calendar INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX daily_totals_day ON daily_totals (day)")
+
+
+def _rebuild(conn: sqlite3.Connection, table: str, select: str):
+    # recreates a table from a query over the old one, keeping its schema,
+    # indexes and triggers. Legacy renames don't check the triggers of other
+    # tables, which refer to the table while it's dropped
+    create, *others = [sql for sql, in conn.execute("""
+        SELECT sql FROM sqlite_master
+        WHERE tbl_name = ? AND sql IS NOT NULL
+        ORDER BY type != 'table'
+    """, (table,))]
+    conn.execute(create.replace(table, f"{table}_new", 1))
+    conn.execute(f"INSERT INTO {table}_new {select}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute("PRAGMA legacy_alter_table = ON")
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    conn.execute("PRAGMA legacy_alter_table = OFF")
+    for sql in others:
+        conn.execute(sql)
+
+
+def _sequential_ids(conn: sqlite3.Connection):
+    # ids were hashes of the row and the time it was made: random 64 bit
+    # numbers that could collide and leave no room for the next rowid.
+    # Accounts, expenses (oldest first) and recurring payments are numbered
+    # from 1, and new rows take the next rowid. Expenses gain import_key, an
+    # optional natural key unique per account (e.g. a bank's transaction id)
+    # so importing a statement twice doesn't duplicate it
+    for table, order in [("accounts", "id"), ("expenses", "datetime, id"), ("recurring_payments", "id")]:
+        conn.execute(f"""
+            CREATE TEMP TABLE {table}_ids AS
+            SELECT id AS old, ROW_NUMBER() OVER (ORDER BY {order}) AS new FROM {table}
+        """)
+        conn.execute(f"CREATE UNIQUE INDEX temp.{table}_ids_old ON {table}_ids (old)")
+
+    def new_id(table, col):
+        return f"(SELECT new FROM {table}_ids WHERE old = {col})"
+
+    _rebuild(conn, "accounts", f"SELECT {new_id('accounts', 'id')}, account_name, balance FROM accounts")
+    _rebuild(conn, "expenses", f"""
+        SELECT {new_id('expenses', 'id')}, reason, category, datetime, amount, {new_id('accounts', 'account_id')}
+        FROM expenses
+    """)
+    _rebuild(conn, "recurring_payments", f"""
+        SELECT {new_id('recurring_payments', 'id')}, {new_id('expenses', 'expense_id')}, time_frame, last_paid
+        FROM recurring_payments
+    """)
+    _rebuild(conn, "daily_totals", f"""
+        SELECT day, category, {new_id('accounts', 'account_id')}, amount, count, money_in, money_out
+        FROM daily_totals
+    """)
+    _rebuild(conn, "balance_checkpoints", f"""
+        SELECT {new_id('accounts', 'account_id')}, datetime, balance FROM balance_checkpoints
+    """)
+    for table in ["accounts", "expenses", "recurring_payments"]:
+        conn.execute(f"DROP TABLE temp.{table}_ids")
+
+    conn.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+    conn.execute("ALTER TABLE expenses ADD COLUMN import_key TEXT")
+    conn.execute("""
+        CREATE UNIQUE INDEX expenses_import_key ON expenses (account_id, import_key)
+        WHERE import_key IS NOT NULL
+    """)
+
+
+def _budget_totals(conn: sqlite3.Connection):
+    # running spend within each budget's window, so alerts don't total the
+    # window on every insert. Triggers add expenses inside the window, the
+    # db layer moves window_start forward as the window moves and fills
+    # missing rows, which are dropped when a budget's time frame changes.
+    # Budgets gain the fractions of the budget to alert at
+    conn.execute("ALTER TABLE budgets ADD COLUMN alerts TEXT NOT NULL DEFAULT '0.8,1'")
+    conn.execute("""
+        CREATE TABLE budget_totals (
+            category TEXT PRIMARY KEY NOT NULL,
+            window_start INTEGER NOT NULL,
+            spent INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TRIGGER expenses_budget_totals_insert AFTER INSERT ON expenses
+        BEGIN
+            UPDATE budget_totals SET spent = spent + NEW.amount
+            WHERE category = NEW.category AND NEW.datetime > window_start;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER expenses_budget_totals_delete AFTER DELETE ON expenses
+        BEGIN
+            UPDATE budget_totals SET spent = spent - OLD.amount
+            WHERE category = OLD.category AND OLD.datetime > window_start;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER budgets_budget_totals_update AFTER UPDATE OF time_frame, calendar ON budgets
+        BEGIN
+            DELETE FROM budget_totals WHERE category = NEW.category;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER budgets_budget_totals_delete AFTER DELETE ON budgets
+        BEGIN
+            DELETE FROM budget_totals WHERE category = OLD.category;
+        END
+    """)
+
+
+def _ledger_checkpoints(conn: sqlite3.Connection):
+    # checkpoints move from the wall clock time of writes to a grid of
+    # ledger time, one second before each multiple of 28 days. Each account
+    # gets one in front of every interval holding any of its expenses,
+    # worked out from its opening checkpoint and the running total of the
+    # intervals before
+    interval = 28 * 86400
+    conn.execute(f"""
+        WITH opening AS MATERIALIZED (
+            SELECT checkpoint.account_id, checkpoint.balance + COALESCE((
+                SELECT SUM(amount) FROM expenses
+                WHERE expenses.account_id = checkpoint.account_id AND expenses.datetime <= checkpoint.datetime
+            ), 0) AS balance
+            FROM balance_checkpoints AS checkpoint
+            WHERE checkpoint.datetime = (
+                SELECT MIN(datetime) FROM balance_checkpoints WHERE account_id = checkpoint.account_id
+            )
+        ), intervals AS (
+            SELECT account_id, datetime - ((datetime % {interval}) + {interval}) % {interval} AS start,
+                   SUM(amount) AS amount
+            FROM expenses
+            GROUP BY 1, 2
+        )
+        INSERT OR IGNORE INTO balance_checkpoints (account_id, datetime, balance)
+        SELECT intervals.account_id, intervals.start - 1,
+               opening.balance - COALESCE(SUM(intervals.amount) OVER (
+                   PARTITION BY intervals.account_id ORDER BY intervals.start
+                   ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+               ), 0)
+        FROM intervals
+        INNER JOIN opening ON opening.account_id = intervals.account_id
+    """)
+
+
+MIGRATIONS = [
+    _create_tables,
+    _index_expenses,
+    _integer_storage,
+    _daily_totals,
+    _balance_checkpoints,
+    _expenses_fts,
+    _calendar_budgets,
+    _sequential_ids,
+    _budget_totals,
+    _ledger_checkpoints,
+]
+
+
+def schema_version(conn: sqlite3.Connection):
+    """
+    Gets the version of the schema stored in the database
+    :param conn: the database connection
+    :return: number of migrations applied
+    """
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection):
+    """
+    Applies every migration newer than the stored schema version. Each
+    step is applied in its own write transaction along with the version
+    bump, so concurrent processes can't apply the same step twice.
+    This is a single PRAGMA read when the schema is already up to date
+    :param conn: the database connection
+    :return: the new schema version
+    """
+    version = schema_version(conn)
+    while version < len(MIGRATIONS):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # another connection may have migrated while we waited for the lock
+            if schema_version(conn) == version:
+                MIGRATIONS[version](conn)
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+        version = schema_version(conn)
+
+    return version
@@ -0,0 +1,72 @@
+import csv
+import json
+from typing import Iterable, TextIO
+
+# Writers take the column names and the batches from iter_export and write
+# each batch as it arrives, so only one batch is ever held in memory.
+
+
+def write_csv(f: TextIO, columns: list, batches: Iterable[list]):
+    """
+    Writes batches of rows as CSV with a header row
+    :param f: text file to write to
+    :param columns: column names
+    :param batches: iterable of lists of rows
+    :return: number of rows written
+    """
+    writer = csv.writer(f)
+    writer.writerow(columns)
+
+    count = 0
+    for rows in batches:
+        writer.writerows(rows)
+        count += len(rows)
+
+    return count
+
+
+def write_jsonl(f: TextIO, columns: list, batches: Iterable[list]):
+    """
+    Writes batches of rows as JSON lines, one object per row
+    :param f: text file to write to
+    :param columns: column names
+    :param batches: iterable of lists of rows
+    :return: number of rows written
+    """
+    encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+    count = 0
+    for rows in batches:
+        f.write("".join(encode(dict(zip(columns, row))) + "\n" for row in rows))
+        count += len(rows)
+
+    return count
+
+
+def write_parquet(path: str, columns: list, batches: Iterable[list]):
+    """
+    Writes batches of rows to a Parquet file, one row group per batch.
+    Needs pyarrow. Datetime columns are expected as epoch seconds
+    :param path: file to write
+    :param columns: column names
+    :param batches: iterable of lists of rows
+    :return: number of rows written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {"datetime": pa.timestamp("s"), "last_paid": pa.timestamp("s"), "amount": pa.float64(),
+             "budget": pa.float64(), "id": pa.int64(), "expense_id": pa.int64(), "account_id": pa.int64(), "calendar": pa.int64()}
+    schema = pa.schema([(name, types.get(name, pa.string())) for name in columns])
+
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in batches:
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            count += len(rows)
+
+    return count
+
+
+WRITERS = {"csv": write_csv, "jsonl": write_jsonl, "parquet": write_parquet}
@@ -0,0 +1,178 @@
+import csv
+import hashlib
+import re
+from datetime import datetime
+from typing import Iterator, Optional
+
+from dateutil.parser import isoparse
+
+from moneytracker.model import *
+
+# Readers stream a statement file and yield one Expense per transaction
+# so that files of any size can be imported in constant memory.
+# Statement amounts are signed from the account's point of view
+# (negative = money out) and are flipped into expense amounts unless
+# expenses_positive is set. Transactions carry the bank's id as their
+# import_key when the file has one, see with_import_keys for the rest.
+
+# Days either side of the row being read that with_import_keys remembers
+# transactions for. Statements can be out of order within this window
+IMPORT_KEY_WINDOW = 366
+
+
+def parse_category(value: Optional[str], default: ExpenseCategory):
+    """
+    Maps a free text category onto an expense category
+    :param value: category text from the file
+    :param default: category used when the text isn't recognised
+    :return: the expense category
+    """
+    if not value:
+        return default
+
+    return ExpenseCategory.__members__.get(value.strip().upper(), default)
+
+
+def parse_date(value: str, date_format: Optional[str] = None):
+    """
+    Parses a date from a statement file
+    :param value: the date text
+    :param date_format: strptime format, isoformat is assumed if not given
+    :return: the datetime
+    """
+    value = value.strip()
+    return isoparse(value) if date_format is None else datetime.strptime(value, date_format)
+
+
+def parse_amount(value: str, expenses_positive: bool = False):
+    """
+    Converts a statement amount into an expense amount
+    :param value: the amount text (e.g. -1,234.56 or £12.00)
+    :param expenses_positive: whether money out is already positive
+    :return: amount spent (negative for income)
+    """
+    amount = float(re.sub(r"[^0-9.\-]", "", value))
+    return amount if expenses_positive else -amount
+
+
+def read_csv(path: str, account: Account, date_col: str = "date", amount_col: str = "amount",
+             reason_col: str = "reason", category_col: Optional[str] = None,
+             category: ExpenseCategory = ExpenseCategory.GENERAL, date_format: Optional[str] = None,
+             expenses_positive: bool = False, id_col: Optional[str] = None) -> Iterator[Expense]:
+    """
+    Streams expenses from a CSV file with a header row
+    :param path: the CSV file
+    :param account: account the transactions belong to
+    :param date_col: header of the date column
+    :param amount_col: header of the amount column
+    :param reason_col: header of the reason/description column
+    :param category_col: (optional) header of the category column
+    :param category: category used when no category is given
+    :param date_format: strptime format of the dates
+    :param expenses_positive: whether money out is positive in the file
+    :param id_col: (optional) header of the bank's transaction id column
+    :return: generator of expenses
+    """
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            yield Expense(
+                id=-1, reason=row.get(reason_col) or "",
+                category=parse_category(row.get(category_col) if category_col else None, category),
+                date=parse_date(row[date_col], date_format),
+                amount=parse_amount(row[amount_col], expenses_positive), account=account,
+                import_key=(row.get(id_col) or None) if id_col else None
+            )
+
+
+def read_qif(path: str, account: Account, category: ExpenseCategory = ExpenseCategory.GENERAL,
+             date_format: Optional[str] = "%d/%m/%Y", expenses_positive: bool = False,
+             **_) -> Iterator[Expense]:
+    """
+    Streams expenses from a QIF file
+    :param path: the QIF file
+    :param account: account the transactions belong to
+    :param category: category used when a record has no L line
+    :param date_format: strptime format of the D lines
+    :param expenses_positive: whether money out is positive in the file
+    :return: generator of expenses
+    """
+    record = {}
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if not line or line.startswith("!"):
+                continue
+
+            if line[0] != "^":
+                record.setdefault(line[0], line[1:])
+                continue
+
+            if "D" in record and ("T" in record or "U" in record):
+                yield Expense(
+                    id=-1, reason=record.get("P") or record.get("M") or "",
+                    category=parse_category(record.get("L"), category),
+                    date=parse_date(record["D"].replace("'", "/"), date_format),
+                    amount=parse_amount(record.get("T", record.get("U")), expenses_positive),
+                    account=account
+                )
+            record = {}
+
+
+def read_ofx(path: str, account: Account, category: ExpenseCategory = ExpenseCategory.GENERAL,
+             expenses_positive: bool = False, **_) -> Iterator[Expense]:
+    """
+    Streams expenses from an OFX file (SGML or XML flavour)
+    :param path: the OFX file
+    :param account: account the transactions belong to
+    :param category: category given to every transaction
+    :param expenses_positive: whether money out is positive in the file
+    :return: generator of expenses
+    """
+    tag = re.compile(r"<(/?)([A-Za-z0-9.]+)>([^<\r\n]*)")
+    record = None
+    with open(path, errors="replace") as f:
+        for line in f:
+            for closing, name, value in tag.findall(line):
+                name = name.upper()
+                if name == "STMTTRN":
+                    if not closing:
+                        record = {}
+                    elif record is not None:
+                        yield Expense(
+                            id=-1, reason=record.get("NAME") or record.get("MEMO") or "", category=category,
+                            date=datetime.strptime(record["DTPOSTED"][:14].ljust(14, "0"), "%Y%m%d%H%M%S"),
+                            amount=parse_amount(record["TRNAMT"], expenses_positive), account=account,
+                            import_key=record.get("FITID") or None
+                        )
+                        record = None
+                elif record is not None and not closing:
+                    record[name] = value.strip()
+
+
+def with_import_keys(expenses: Iterator[Expense]) -> Iterator[Expense]:
+    """
+    Gives expenses without an import_key one hashed from their date, amount
+    and reason, so importing an overlapping statement skips what was
+    already imported. Identical transactions in a file are numbered to keep
+    them apart, whatever order the file is in. Counts are only held for the
+    days within IMPORT_KEY_WINDOW of the row being read, so memory doesn't
+    grow with the length of the statement
+    :param expenses: expenses from a reader
+    :return: generator of the same expenses
+    """
+    counts, day = {}, None
+    for expense in expenses:
+        if expense.import_key is None:
+            if expense.date.date() != day:
+                day = expense.date.date()
+                for old in [d for d in counts if abs((d - day).days) > IMPORT_KEY_WINDOW]:
+                    del counts[old]
+            seen = counts.setdefault(day, {})
+            content = hashlib.sha1(f"{expense.date.isoformat()}|{to_pence(expense.amount)}|{expense.reason}"
+                                   .encode()).digest()
+            seen[content] = n = seen.get(content, 0) + 1
+            expense.import_key = f"{content.hex()}:{n}"
+        yield expense
+
+
+READERS = {"csv": read_csv, "qif": read_qif, "ofx": read_ofx}
@@ -1,6 +1,6 @@
 from enum import Enum, auto
 from dataclasses import dataclass
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 
 class ExpenseCategory(Enum):
@@ -49,14 +49,14 @@ def get_colour_from_category(cat: ExpenseCategory):
     return colours[cat.value % len(colours)]
 
 
-@dataclass
+@dataclass(slots=True)
 class Account:
     id: int
     account_name: str
     balance: float
 
 
-@dataclass
+@dataclass(slots=True)
 class Expense:
     id: int
     reason: str
@@ -64,26 +64,66 @@ class Expense:
     date: datetime
     amount: float
     account: Account
+    import_key: str = None  # natural key unique per account, e.g. a bank's transaction id
 
-    def __hash__(self):
-        return hash((self.amount, self.category, self.reason, datetime.now()))
+    # expenses are hashed by identity, ids come from the database
+    __hash__ = object.__hash__
 
 
-@dataclass
+# Fractions of a budget at which spending is alerted on by default
+DEFAULT_ALERTS = (0.8, 1.0)
+
+
+@dataclass(slots=True)
 class Budget:
     category: ExpenseCategory
     amount: float
     time_frame: TimeFrame
+    calendar: bool = False  # the current calendar period rather than the last N days
+    alerts: tuple = DEFAULT_ALERTS
 
 
-@dataclass
+@dataclass(slots=True)
 class ExpenseCategoryOverview:
     category: ExpenseCategory
     amount_spent: float
     budget: float
 
 
-@dataclass
+@dataclass(slots=True)
+class BudgetStatus:
+    category: ExpenseCategory
+    amount_spent: float
+    budget: float
+    time_frame: TimeFrame
+    calendar: bool
+    alerts: tuple
+    window_start: datetime  # spending after this counts towards the budget, None for FOREVER
+
+    @property
+    def used(self):
+        return self.amount_spent / self.budget if self.budget > 0 else None
+
+    def crossed(self, before: "BudgetStatus"):
+        """
+        Finds the alerts reached by spending since an earlier status
+        :param before: the earlier status of the same budget
+        :return: list of alert fractions, lowest first
+        """
+        if self.budget <= 0:
+            return []
+        return sorted(a for a in self.alerts if before.amount_spent < a * self.budget <= self.amount_spent)
+
+
+@dataclass(slots=True)
+class PeriodTotal:
+    period: date  # first day of the period
+    category: ExpenseCategory
+    amount_spent: float
+    budget: float
+
+
+@dataclass(slots=True)
 class RecurringExpense:
     id: int
     expense: Expense
@@ -91,6 +131,16 @@ class RecurringExpense:
     last_paid: datetime
 
 
+@dataclass(slots=True)
+class Reconciliation:
+    account: Account
+    ledger_balance: float
+
+    @property
+    def drift(self):
+        return round(self.account.balance - self.ledger_balance, 2)
+
+
 def is_within_time_frame(tf: TimeFrame, dt: datetime):
     delta = datetime.now() - dt
     return True if tf is TimeFrame.FOREVER else not delta.days > tf.value
@@ -102,3 +152,43 @@ def oldest_time(tf: TimeFrame):
         return now - now
 
     return now - timedelta(tf.value)
+
+
+def period_start(tf: TimeFrame, day: date, periods_back: int = 0):
+    """
+    Finds the first day of the calendar period (week from Monday, month or
+    year) containing a day
+    :param tf: the period, DAY, WEEK, MONTH or YEAR
+    :param day: a day within the period
+    :param periods_back: number of whole periods to step back
+    :return: date
+    """
+    match tf:
+        case TimeFrame.DAY: return day - timedelta(days=periods_back)
+        case TimeFrame.WEEK: return day - timedelta(days=day.weekday() + 7 * periods_back)
+        case TimeFrame.MONTH:
+            months = day.year * 12 + day.month - 1 - periods_back
+            return date(months // 12, months % 12 + 1, 1)
+        case TimeFrame.YEAR: return date(day.year - periods_back, 1, 1)
+
+    raise ValueError(f"{tf.name} is not a calendar period")
+
+
+# Storage conversions: the database keeps datetimes as integer epoch
+# seconds and amounts as integer pence
+
+
+def to_epoch(dt: datetime):
+    return int(dt.timestamp())
+
+
+def from_epoch(ts: int):
+    return datetime.fromtimestamp(ts)
+
+
+def to_pence(amount: float):
+    return round(amount * 100)
+
+
+def from_pence(pence: int):
+    return pence / 100
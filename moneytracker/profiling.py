@@ -0,0 +1,324 @@
+import functools
+import inspect
+import json
+import re
+import sqlite3
+import time
+from dataclasses import dataclass, asdict
+from types import ModuleType
+
+# Profiling of a single CLI command. Once enabled every connection records
+# the statements it runs (through sqlite3's trace callback) along with the
+# time spent executing and fetching them, and the functions of the db layer,
+# the parse_* functions and console rendering are timed. The summary splits
+# the command's time into sql, parse, render and other. Objects built by the
+# parse_* row factories are built while fetching, so they count as sql.
+
+# Repeats of one query within a command before it is reported as N+1
+REPEAT_WARNING = 10
+
+
+@dataclass
+class QueryStats:
+    sql: str
+    caller: str
+    calls: int = 0
+    rows: int = 0
+    seconds: float = 0
+
+
+@dataclass
+class FunctionStats:
+    name: str
+    category: str
+    calls: int = 0
+    seconds: float = 0
+    statements: int = 0
+
+
+_enabled = False
+_started = None
+_stack = []  # FunctionStats of the instrumented calls being run
+_queries = {}  # (caller, sql) to QueryStats
+_functions = {}  # name to FunctionStats
+_categories = {"sql": 0.0, "parse": 0.0, "render": 0.0}
+_trace = []  # events written to the JSON trace
+
+
+def _caller():
+    return _stack[-1].name if _stack else "<cli>"
+
+
+def _normalise(sql: str):
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def _query(sql: str):
+    key = (_caller(), _normalise(sql))
+    stats = _queries.get(key)
+    if stats is None:
+        stats = _queries[key] = QueryStats(key[1], key[0])
+    return stats
+
+
+def _on_statement(sql: str):
+    # trace callback, sees every statement including implicit BEGIN/COMMIT
+    # and the ones run by triggers
+    for frame in _stack:
+        frame.statements += 1
+    _trace.append({"event": "statement", "caller": _caller(), "sql": _normalise(sql),
+                   "at": time.perf_counter() - _started})
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """
+    Cursor recording the time spent executing and fetching each query and
+    the number of rows it returned
+    """
+    _stats = None
+
+    def _timed(self, call, *args):
+        start = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            _categories["sql"] += elapsed
+            if self._stats is not None:
+                self._stats.seconds += elapsed
+
+    def _fetched(self, rows):
+        if self._stats is not None:
+            self._stats.rows += rows
+
+    def execute(self, sql, parameters=()):
+        self._stats = _query(sql)
+        self._stats.calls += 1
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._stats = _query(sql)
+        self._stats.calls += 1
+        res = self._timed(super().executemany, sql, seq_of_parameters)
+        self._fetched(max(self.rowcount, 0))
+        return res
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        self._fetched(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(super().fetchmany, self.arraysize if size is None else size)
+        self._fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._fetched(len(rows))
+        return rows
+
+    def __next__(self):
+        row = self._timed(super().__next__)
+        self._fetched(1)
+        return row
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """
+    Connection whose cursors are ProfilingCursors and whose statements are
+    traced
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_trace_callback(_on_statement)
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _exit(stats: FunctionStats, start: float):
+    elapsed = time.perf_counter() - start
+    _stack.pop()
+    stats.seconds += elapsed
+    # only the outermost call counts towards its category
+    if stats.category in _categories and not any(f.category == stats.category for f in _stack):
+        _categories[stats.category] += elapsed
+
+
+def timed(func, category: str = "db"):
+    """
+    Wraps a function so its calls are counted and timed. Generators are
+    only timed while they are producing items
+    :param func: the function
+    :param category: what the time is spent on (db, parse or render)
+    :return: the wrapped function
+    """
+    name = getattr(func, "__qualname__", repr(func))
+
+    def stats():
+        res = _functions.get(name)
+        if res is None:
+            res = _functions[name] = FunctionStats(name, category)
+        res.calls += 1
+        return res
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            frame = stats()
+            items = func(*args, **kwargs)
+            while True:
+                _stack.append(frame)
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    _exit(frame, start)
+                yield item
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            frame = stats()
+            _stack.append(frame)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _exit(frame, start)
+
+    return wrapper
+
+
+def instrument(module: ModuleType, *namespaces: ModuleType):
+    """
+    Times every function defined in a module, replacing it in the module
+    and in any namespace that imported it (e.g. with import *)
+    :param module: module defining the functions
+    :param namespaces: modules that imported the functions
+    :return: void
+    """
+    for name, func in list(vars(module).items()):
+        if not callable(func) or isinstance(func, type) or getattr(func, "__module__", None) != module.__name__:
+            continue
+
+        wrapped = timed(func, "parse" if name.startswith("parse_") else "db")
+        for ns in (module, *namespaces):
+            if getattr(ns, name, None) is func:
+                setattr(ns, name, wrapped)
+
+
+def enable(console=None, *namespaces: ModuleType):
+    """
+    Starts profiling. Connections opened from now on are traced and the
+    functions of the db layer are timed
+    :param console: (optional) rich console whose rendering is timed
+    :param namespaces: modules that star imported the db layer
+    :return: void
+    """
+    global _enabled, _started
+    if _enabled:
+        return
+
+    from moneytracker.db import create, db
+
+    _enabled = True
+    _started = time.perf_counter()
+    create.close_connection()
+    create.connection_class = ProfilingConnection
+    instrument(create, db, *namespaces)
+    instrument(db, *namespaces)
+    if console is not None:
+        console.print = timed(console.print, "render")
+
+
+def is_enabled():
+    return _enabled
+
+
+def results():
+    """
+    Gets everything recorded so far
+    :return: dict of totals, functions and queries
+    """
+    total = time.perf_counter() - _started
+    totals = dict(_categories, total=total, other=total - sum(_categories.values()))
+    return {
+        "seconds": totals,
+        "statements": sum(1 for e in _trace if e["event"] == "statement"),
+        "functions": [asdict(f) for f in sorted(_functions.values(), key=lambda f: -f.seconds)],
+        "queries": [asdict(q) for q in sorted(_queries.values(), key=lambda q: -q.seconds)],
+    }
+
+
+def repeated_queries():
+    """
+    Finds queries run often enough in one command to be an N+1 pattern
+    :return: list of QueryStats
+    """
+    return [q for q in _queries.values() if q.calls >= REPEAT_WARNING]
+
+
+def write_trace(path: str):
+    """
+    Writes the results and every traced statement to a JSON file
+    :param path: file to write
+    :return: void
+    """
+    with open(path, "w") as f:
+        json.dump(dict(results(), trace=_trace), f, indent=2)
+
+
+def print_summary(console):
+    """
+    Prints the profile as tables
+    :param console: rich console to print to, this isn't timed
+    :return: void
+    """
+    from rich.table import Table
+
+    res = results()
+    print_ = getattr(console.print, "__wrapped__", console.print)
+
+    secs = res["seconds"]
+    table = Table(show_header=True, header_style="bold blue", show_edge=False,
+                  title="Profile", title_style="bold green1")
+    for name in ("total", "sql", "parse", "render", "other"):
+        table.add_column(name.capitalize(), width=10, justify="right")
+    table.add_column("Statements", width=10, justify="right")
+    table.add_row(*["{ms:.1f}ms".format(ms=secs[name] * 1000) for name in ("total", "sql", "parse", "render", "other")],
+                  str(res["statements"]))
+    print_(table)
+
+    table = Table(show_header=True, header_style="bold blue", show_edge=False)
+    table.add_column("Function", width=28)
+    table.add_column("Calls", width=6, justify="right")
+    table.add_column("Time", width=10, justify="right")
+    table.add_column("Statements", width=10, justify="right")
+    for f in res["functions"]:
+        table.add_row(f["name"], str(f["calls"]), "{ms:.2f}ms".format(ms=f["seconds"] * 1000), str(f["statements"]))
+    print_(table)
+
+    table = Table(show_header=True, header_style="bold blue", show_edge=False)
+    table.add_column("Caller", max_width=20, no_wrap=True)
+    table.add_column("Calls", min_width=5, justify="right")
+    table.add_column("Rows", min_width=6, justify="right")
+    table.add_column("Time", min_width=9, justify="right")
+    table.add_column("Query", max_width=36, no_wrap=True)
+    for q in res["queries"][:10]:
+        table.add_row(q["caller"], str(q["calls"]), str(q["rows"]), "{ms:.2f}ms".format(ms=q["seconds"] * 1000),
+                      q["sql"][:80])
+    print_(table)
+
+    for q in repeated_queries():
+        print_("[bold red]Possible N+1:[/bold red] {caller} ran this query {n} times: {sql}"
+               .format(caller=q.caller, n=q.calls, sql=q.sql[:80]))
@@ -0,0 +1,283 @@
+import codecs
+import io
+import json
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+from rich.console import Console
+
+from moneytracker.client import socket_path
+from moneytracker.db.db import *
+
+# Daemon behind `main.py serve`. It keeps one warm process holding the
+# imported CLI, the database connection (schema already migrated, page cache
+# filled) and the budget cache, and runs commands forwarded by
+# moneytracker.client one at a time, which is also the order SQLite would
+# apply their writes in. Output is streamed back as JSON lines:
+# {"out": text}, {"err": text} and finally {"exit": code}.
+# Each client's request is read in its own thread and queued, so a client
+# that connects and stalls doesn't hold up the others. Commands still run
+# on the main thread, which owns the warm connection and the process wide
+# stdout, working directory and environment they use.
+
+# Output is sent once this much has been written, or when the command ends
+OUTPUT_BUFFER = 64 * 1024
+
+# Seconds a client may take to send its request or to accept a chunk of
+# output before it is dropped
+CLIENT_TIMEOUT = 10
+
+
+class ReplyBuffer(io.RawIOBase):
+    """
+    Binary side of a ReplyStream, like sys.stdout.buffer, for writers such as
+    click.echo that send bytes to it
+    """
+
+    def __init__(self, stream: "ReplyStream"):
+        self._stream = stream
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._stream.write(self._decoder.decode(bytes(b)))
+        return len(b)
+
+    def flush(self):
+        self._stream.flush()
+
+
+class ReplyStream(io.TextIOBase):
+    """
+    Text stream sending what is written to the client as {key: text}
+    messages, so commands can write to it as stdout, stderr or a console
+    """
+
+    def __init__(self, sock: socket.socket, key: str, tty: bool = False):
+        self._sock = sock
+        self._key = key
+        self._tty = tty
+        self._buffer = []
+        self._size = 0
+        self.buffer = ReplyBuffer(self)
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return self._tty
+
+    def write(self, s: str):
+        if not isinstance(s, str):
+            raise TypeError(f"write() argument must be str, not {type(s).__name__}")
+        self._buffer.append(s)
+        self._size += len(s)
+        if self._size >= OUTPUT_BUFFER:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if self._size:
+            text = "".join(self._buffer)
+            self._buffer, self._size = [], 0
+            try:
+                self._sock.sendall(json.dumps({self._key: text}).encode() + b"\n")
+            except OSError:
+                # the client went away or stopped reading, so later sends
+                # fail straight away instead of waiting out the timeout again
+                try:
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                raise
+
+
+def run_command(command, argv: list, out: ReplyStream, err: ReplyStream, width: int = None):
+    """
+    Runs a CLI command in this process with its output sent to the client
+    :param command: the click command of the CLI app
+    :param argv: command line arguments, without --db
+    :param out: stream for stdout
+    :param err: stream for stderr
+    :param width: (optional) width of the client's terminal
+    :return: exit code
+    """
+    from moneytracker import cli
+
+    console = cli.console
+    cli.console = Console(file=out, width=width, force_terminal=out.isatty())
+    try:
+        with redirect_stdout(out), redirect_stderr(err):
+            command.main(args=argv, prog_name="main.py")
+        return 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        err.write(f"{e.code}\n")
+        return 1
+    except Exception:
+        err.write(traceback.format_exc())
+        return 1
+    finally:
+        cli.console = console
+        conn = connection()
+        if conn.in_transaction:
+            conn.rollback()
+
+
+def read_request(client: socket.socket, requests: queue.Queue):
+    """
+    Reads a client's request and queues it to be run, dropping the client
+    if it sends garbage or nothing within CLIENT_TIMEOUT
+    :param client: connected client socket
+    :param requests: queue of (client, request) the commands are run from
+    :return: void
+    """
+    try:
+        with client.makefile("rb") as f:
+            line = f.readline()
+        requests.put((client, json.loads(line)))
+    except (OSError, ValueError):
+        client.close()
+
+
+def accept(sock: socket.socket, requests: queue.Queue):
+    """
+    Accepts clients until the listening socket is shut down, reading each
+    one's request in its own thread
+    :param sock: listening socket
+    :param requests: queue of (client, request) the commands are run from
+    :return: void
+    """
+    while True:
+        try:
+            client, _ = sock.accept()
+        except OSError:
+            return
+        client.settimeout(CLIENT_TIMEOUT)
+        threading.Thread(target=read_request, args=(client, requests), daemon=True).start()
+
+
+def handle(command, client: socket.socket, request: dict):
+    """
+    Runs one client's request
+    :param command: the click command of the CLI app
+    :param client: connected client socket
+    :param request: the request read from the client
+    :return: void
+    """
+    out = ReplyStream(client, "out", request.get("tty", False))
+    err = ReplyStream(client, "err")
+    env = request.get("env", {})
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    os.chdir(request.get("cwd", "/"))
+    try:
+        code = run_command(command, request["argv"], out, err, request.get("width"))
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    out.flush()
+    err.flush()
+    client.sendall(json.dumps({"exit": code}).encode() + b"\n")
+
+
+def listen(path: str):
+    """
+    Binds the daemon's socket, replacing a stale one left by a daemon that
+    didn't shut down cleanly
+    :param path: socket path
+    :return: listening socket
+    """
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise RuntimeError(f"A daemon is already listening on {path}")
+        finally:
+            probe.close()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, 0o600)
+    sock.listen(128)
+    return sock
+
+
+def serve(path: str = None, on_ready=None):
+    """
+    Serves forwarded commands for the current database until interrupted
+    (Ctrl-C or SIGTERM)
+    :param path: (optional) socket path, see moneytracker.client.socket_path
+    :param on_ready: (optional) called with the socket path once listening
+    :return: void
+    """
+    import typer
+    from moneytracker import cli
+
+    db = os.path.abspath(db_path())
+    path = socket_path(db) if path is None else path
+    set_db_path(db)
+    # the daemon only serves this database, commands mustn't switch it
+    os.environ.pop(DB_PATH_ENV, None)
+
+    command = typer.main.get_command(cli.app)
+    conn = connection()
+    get_budget_config()
+    # data_version changes when another connection commits, e.g. a command
+    # run directly while the daemon is up
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+
+    sock = listen(path)
+    requests = queue.Queue()
+    threading.Thread(target=accept, args=(sock, requests), daemon=True).start()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if on_ready is not None:
+        on_ready(path)
+    try:
+        while True:
+            client, request = requests.get()
+            with client:
+                version = connection().execute("PRAGMA data_version").fetchone()[0]
+                if version != data_version:
+                    invalidate_budget_config()
+                    data_version = version
+                try:
+                    handle(command, client, request)
+                except OSError:
+                    pass  # the client went away or stopped reading, it gets no reply
+                except Exception:
+                    # one failing request mustn't stop the daemon, its client
+                    # gets the error instead
+                    error = traceback.format_exc()
+                    sys.stderr.write(error)
+                    try:
+                        client.sendall(json.dumps({"err": error}).encode() + b"\n"
+                                       + json.dumps({"exit": 1}).encode() + b"\n")
+                    except OSError:
+                        pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)  # wakes the accepting thread
+        except OSError:
+            pass
+        sock.close()
+        os.unlink(path)
+        close_connection()